@@ -1,7 +1,6 @@
 from __future__ import division, print_function
 import numpy as np
 import struct, os
-import numpy.matlib
 from scipy.io import savemat
 import mmap
 import contextlib
@@ -122,6 +121,12 @@ def get_setfile_parameter(parameter, set_filename):
                         return ' '.join(new_line[1:])
 
 
+def get_pos_record_dtype(bytes_per_timestamp=4, bytes_per_coord=2):
+    """The structured (big-endian) data type of a position sample: the timestamp followed by 8 words
+    (x1, y1, x2, y2, numpix1, numpix2, total_pix, unused)"""
+    return np.dtype([('t', '>i%d' % bytes_per_timestamp), ('coords', '>i%d' % bytes_per_coord, (8,))])
+
+
 def getpos(pos_fpath, arena, method='', flip_y=True):
     """
     getpos function:
@@ -135,44 +140,35 @@ def getpos(pos_fpath, arena, method='', flip_y=True):
     y: a column array of the y-values (in pixels)
     """
 
-    with open(pos_fpath, 'rb+') as f:  # opening the .pos file
-        headers = ''  # initializing the header string
+    with open(pos_fpath, 'rb') as f:  # opening the .pos file
+        data_offset = 0  # the number of bytes before the position data
         for line in f:  # reads line by line to read the header of the file
             # print(line)
             if 'data_start' in str(line):  # if it reads data_start that means the header has ended
-                headers += 'data_start'
+                data_offset += line.index(b'data_start') + len('data_start')
                 break  # break out of for loop once header has finished
-            elif 'duration' in str(line):
-                headers += line.decode(encoding='UTF-8')
-            elif 'num_pos_samples' in str(line):
+
+            data_offset += len(line)
+
+            if 'num_pos_samples' in str(line):
                 num_pos_samples = int(line.decode(encoding='UTF-8')[len('num_pos_samples '):])
-                headers += line.decode(encoding='UTF-8')
             elif 'bytes_per_timestamp' in str(line):
                 bytes_per_timestamp = int(line.decode(encoding='UTF-8')[len('bytes_per_timestamp '):])
-                headers += line.decode(encoding='UTF-8')
             elif 'bytes_per_coord' in str(line):
                 bytes_per_coord = int(line.decode(encoding='UTF-8')[len('bytes_per_coord '):])
-                headers += line.decode(encoding='UTF-8')
             elif 'timebase' in str(line):
                 timebase = (line.decode(encoding='UTF-8')[len('timebase '):]).split(' ')[0]
-                headers += line.decode(encoding='UTF-8')
             elif 'pixels_per_metre' in str(line):
                 ppm = float(line.decode(encoding='UTF-8')[len('pixels_per_metre '):])
-                headers += line.decode(encoding='UTF-8')
             elif 'min_x' in str(line) and 'window' not in str(line):
                 min_x = int(line.decode(encoding='UTF-8')[len('min_x '):])
-                headers += line.decode(encoding='UTF-8')
             elif 'max_x' in str(line) and 'window' not in str(line):
                 max_x = int(line.decode(encoding='UTF-8')[len('max_x '):])
-                headers += line.decode(encoding='UTF-8')
             elif 'min_y' in str(line) and 'window' not in str(line):
                 min_y = int(line.decode(encoding='UTF-8')[len('min_y '):])
-                headers += line.decode(encoding='UTF-8')
             elif 'max_y' in str(line) and 'window' not in str(line):
                 max_y = int(line.decode(encoding='UTF-8')[len('max_y '):])
-                headers += line.decode(encoding='UTF-8')
             elif 'pos_format' in str(line):
-                headers += line.decode(encoding='UTF-8')
                 if 't,x1,y1,x2,y2,numpix1,numpix2' in str(line):
                     two_spot = True
                 else:
@@ -181,23 +177,20 @@ def getpos(pos_fpath, arena, method='', flip_y=True):
 
             elif 'sample_rate' in str(line):
                 sample_rate = float(line.decode(encoding='UTF-8').split(' ')[1])
-                headers += line.decode(encoding='UTF-8')
-
-            else:
-                headers += line.decode(encoding='UTF-8')
 
-    if two_spot:
-        '''Run when two spot mode is on, (one_spot has the same format so it will also run here)'''
-        with open(pos_fpath, 'rb+') as f:
-            '''get_pos for one_spot'''
-            pos_data = f.read()  # all the position data values (including header)
-            pos_data = pos_data[len(headers):-12]  # removes the header values
+        if two_spot:
+            '''Run when two spot mode is on, (one_spot has the same format so it will also run here)'''
+            # t, x1, y1, x2, y2, numpix1, numpix2, total_pix, unused
+            pos_dtype = get_pos_record_dtype(bytes_per_timestamp, bytes_per_coord)
 
-            byte_string = 'i8h'
+            with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+                records = np.frombuffer(m, dtype=pos_dtype, count=num_pos_samples, offset=data_offset)
 
-            pos_data = np.asarray(struct.unpack('>%s' % (num_pos_samples * byte_string), pos_data))
-            pos_data = pos_data.astype(float).reshape((num_pos_samples, 9))  # there are 8 words and 1 time sample
+                # there are 8 words and 1 time sample
+                pos_data = np.hstack((records['t'].reshape((-1, 1)), records['coords'])).astype(float)
+                records = None
 
+    if two_spot:
         x = pos_data[:, 1]
         y = pos_data[:, 2]
         t = pos_data[:, 0]
@@ -209,7 +202,7 @@ def getpos(pos_fpath, arena, method='', flip_y=True):
         if method == 'raw':
             return x, y, t, sample_rate
 
-        t = np.divide(t, np.float(timebase))  # converting the frame number from Axona to the time value
+        t = np.divide(t, float(timebase))  # converting the frame number from Axona to the time value
 
         # values that are NaN are set to 1023 in Axona's system, replace these values by NaN's
 
@@ -377,14 +370,34 @@ def find_unit(tetrode_list):
     return cut_list
 
 
-def read_clu(filename):
+def read_clu(filename, header_only=False):
     """
     This will read in the .clu.N files that are provided by Tint. The .clu cell ID's go from 1 -> N
     instead of the traditional 0->N-1 for a .cut file. We will convert from the 1->N format to the
     0->N-1 format.
+
+    If header_only is True, this will return the number of clusters (the first value of the file) and the number of
+    spikes (the remaining lines) without parsing the cell ID's.
     """
 
-    data = np.loadtxt(filename)
+    if header_only:
+        with open(filename, 'rb') as f:
+            n_clusters = int(f.readline())
+
+            # every remaining (non-empty) line is a spike
+            n_spikes = 0
+            last = b'\n'
+            for block in iter(lambda: f.read(2 ** 20), b''):
+                n_spikes += block.count(b'\n')
+                last = block[-1:]
+
+            if last != b'\n':
+                n_spikes += 1
+
+        return n_clusters, n_spikes
+
+    with open(filename, 'r') as f:
+        data = np.fromstring(f.read(), dtype=float, sep=' ')
 
     # the first number in the file is simply the number of cells that were recorded, we must remove this
 
@@ -394,20 +407,33 @@ def read_clu(filename):
     return data[1:].flatten() - 1
 
 
-def read_cut(cut_filename):
-    """This function will read the given cut file, and output the """
+def read_cut(cut_filename, header_only=False):
+    """This function will read the given cut file, and output the cut values (the cell of each spike).
+
+    If header_only is True, this will return the n_clusters and the number of spikes of the cut file (from the
+    Exact_cut_for line) without reading the cut values, (None, None) if the cut file does not exist."""
     cut_values = None
+    if not os.path.exists(cut_filename) and header_only:
+        return None, None
+
     if os.path.exists(cut_filename):
-        extract_cut = False
+        n_clusters = None
         with open(cut_filename, 'r') as f:
             for line in f:
+                if 'n_clusters' in line:
+                    n_clusters = int(line.split(':')[1])
+
                 if 'Exact_cut' in line:  # finding the beginning of the cut values
-                    extract_cut = True
-                if extract_cut:  # read all the cut values
-                    cut_values = str(f.readlines())
-                    for string_val in ['\\n', ',', "'", '[', ']']:  # removing non base10 integer values
-                        cut_values = cut_values.replace(string_val, '')
-                    cut_values = [int(val) for val in cut_values.split()]
+                    if header_only:
+                        return n_clusters, int(line.split('spikes:')[1])
+
+                    # read all the cut values at once, they are separated by spaces/new lines
+                    cut_values = np.fromstring(f.read(), dtype=int, sep=' ')
+                    break
+
+        if header_only:
+            return n_clusters, None
+
         cut_values = np.asarray(cut_values)
     return cut_values
 
@@ -648,7 +674,7 @@ def bits2uV(data, data_fpath, set_fpath=''):
     return data_uV, scalar
 
 
-def getspikes(fullpath):
+def getspikes(fullpath, mmap=False):
     """
     This function will return the spike data, spike times, and spike parameters from Tint tetrode data.
 
@@ -658,6 +684,8 @@ def getspikes(fullpath):
 
     Args:
         fullpath (str): the fullpath to the Tint tetrode file you want to acquire the spike data from.
+        mmap (bool): if True the waveforms are read-only int8 views of the memory mapped file (see importspikes)
+            instead of float arrays that are read into memory.
 
     Returns:
         ts (ndarray): an Nx1 array for the spike times, where N is the number of spikes.
@@ -671,7 +699,7 @@ def getspikes(fullpath):
             and M is the chunk length.
         spikeparam (dict): a dictionary containing the header values from the tetrode file.
     """
-    spikes, spikeparam = importspikes(fullpath)
+    spikes, spikeparam = importspikes(fullpath, mmap=mmap)
     ts = spikes['t']
     nspk = spikeparam['num_spikes']
     spikelen = spikeparam['samples_per_spike']
@@ -684,73 +712,205 @@ def getspikes(fullpath):
     return ts, ch1, ch2, ch3, ch4, spikeparam
 
 
-def importspikes(filename):
-    """Reads through the tetrode file as an input and returns two things, a dictionary containing the following:
-    timestamps, ch1-ch4 waveforms, and it also returns a dictionary containing the spike parameters"""
+def read_tetrode_header(filename):
+    """
+    Reads the header of the tetrode file, returning a dictionary of the spike parameters and the byte offset of the
+    spike data (the first byte after data_start).
+    """
+
+    spikeparam = {}
+    offset = 0
+
+    keys = ['num_spikes', 'bytes_per_timestamp', 'samples_per_spike', 'bytes_per_sample', 'timebase', 'duration',
+            'sample_rate']
 
     with open(filename, 'rb') as f:
-        for line in f:
-            if 'data_start' in str(line):
-                spike_data = np.fromstring((line + f.read())[len('data_start'):-len('\r\ndata_end\r\n')], dtype='uint8')
+        for line in iter(f.readline, b''):
+            if b'data_start' in line:
+                offset += line.index(b'data_start') + len('data_start')
                 break
-            elif 'num_spikes' in str(line):
-                num_spikes = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'bytes_per_timestamp' in str(line):
-                bytes_per_timestamp = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'samples_per_spike' in str(line):
-                samples_per_spike = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'bytes_per_sample' in str(line):
-                bytes_per_sample = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'timebase' in str(line):
-                timebase = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'duration' in str(line):
-                duration = int(line.decode(encoding='UTF-8').split(" ")[1])
-            elif 'sample_rate' in str(line):
-                samp_rate = int(line.decode(encoding='UTF-8').split(" ")[1])
-
-                # calculating the big-endian and little endian matrices so we can convert from bytes -> decimal
-    big_endian_vector = 256 ** np.arange(bytes_per_timestamp - 1, -1, -1)
-    little_endian_matrix = np.arange(0, bytes_per_sample).reshape(bytes_per_sample, 1)
-    little_endian_matrix = 256 ** numpy.matlib.repmat(little_endian_matrix, 1, samples_per_spike)
-
-    number_channels = 4
-
-    # calculating the timestamps
-    t_start_indices = np.linspace(0, num_spikes * (bytes_per_sample * samples_per_spike * 4 +
-                                                   bytes_per_timestamp * 4), num=num_spikes, endpoint=False).astype(
-        int).reshape(num_spikes, 1)
-    t_indices = t_start_indices
-
-    for chan in np.arange(1, number_channels):
-        t_indices = np.hstack((t_indices, t_start_indices + chan))
-
-    t = spike_data[t_indices].reshape(num_spikes, bytes_per_timestamp)  # acquiring the time bytes
-    t = np.sum(np.multiply(t, big_endian_vector), axis=1) / timebase  # converting from bytes to float values
-    t_indices = None
-
-    waveform_data = np.zeros((number_channels, num_spikes, samples_per_spike))  # (dimensions, rows, columns)
-
-    bytes_offset = 0
-    # read the t,ch1,t,ch2,t,ch3,t,ch4
-
-    for chan in range(number_channels):  # only really care about the first time that gets written
-        chan_start_indices = t_start_indices + chan * samples_per_spike + bytes_per_timestamp + bytes_per_timestamp * chan
-        for spike_sample in np.arange(1, samples_per_spike):
-            chan_start_indices = np.hstack((chan_start_indices, t_start_indices +
-                                            chan * samples_per_spike + bytes_per_timestamp +
-                                            bytes_per_timestamp * chan + spike_sample))
-        waveform_data[chan][:][:] = spike_data[chan_start_indices].reshape(num_spikes, samples_per_spike).astype(
-            'int8')  # acquiring the channel bytes
-        waveform_data[chan][:][:][np.where(waveform_data[chan][:][:] > 127)] -= 256
-        waveform_data[chan][:][:] = np.multiply(waveform_data[chan][:][:], little_endian_matrix)
-
-    spikeparam = {'timebase': timebase, 'bytes_per_sample': bytes_per_sample, 'samples_per_spike': samples_per_spike,
-                  'bytes_per_timestamp': bytes_per_timestamp, 'duration': duration, 'num_spikes': num_spikes,
-                  'sample_rate': samp_rate}
-
-    return {'t': t.reshape(num_spikes, 1), 'ch1': np.asarray(waveform_data[0][:][:]),
-            'ch2': np.asarray(waveform_data[1][:][:]),
-            'ch3': np.asarray(waveform_data[2][:][:]), 'ch4': np.asarray(waveform_data[3][:][:])}, spikeparam
+
+            offset += len(line)
+
+            # the free text of the header (i.e. comments, experimenter) isn't necessarily UTF-8
+            values = line.decode(encoding='latin-1').split(" ")
+            if values[0] in keys:
+                spikeparam[values[0]] = int(values[1])
+        else:
+            raise ValueError('Could not find the data_start of the following tetrode file: %s' % filename)
+
+    return spikeparam, offset
+
+
+def get_spike_record_dtype(spikeparam, number_channels=4):
+    """The structured data type of a spike, the timestamp/waveform of each channel (t,ch1,t,ch2,t,ch3,t,ch4)"""
+    channel_dtype = [('t', '>i%d' % spikeparam['bytes_per_timestamp']),
+                     ('w', '<i%d' % spikeparam['bytes_per_sample'], (spikeparam['samples_per_spike'],))]
+
+    return np.dtype([('channel%d' % chan, channel_dtype) for chan in range(number_channels)])
+
+
+def read_spike_records(filename, spikeparam=None, offset=None):
+    """
+    Returns the spikes of the tetrode file as a memory mapped (read-only) structured array (see
+    get_spike_record_dtype), nothing is read until the records are accessed.
+    """
+
+    if spikeparam is None or offset is None:
+        spikeparam, offset = read_tetrode_header(filename)
+
+    record_dtype = get_spike_record_dtype(spikeparam)
+
+    if spikeparam['num_spikes'] == 0:
+        return np.zeros(0, dtype=record_dtype)
+
+    return np.memmap(filename, dtype=record_dtype, mode='r', offset=offset, shape=(spikeparam['num_spikes'],))
+
+
+def importspikes(filename, timestamps_only=False, mmap=False):
+    """Reads through the tetrode file as an input and returns two things, a dictionary containing the following:
+    timestamps, ch1-ch4 waveforms, and it also returns a dictionary containing the spike parameters.
+
+    The waveforms are (num_spikes, samples_per_spike) float arrays in memory. If mmap is True they are instead
+    read-only int8 views of the memory mapped file, so nothing is read until they are used (the file stays open
+    while the views exist). If timestamps_only is True only the timestamps (in seconds) are returned."""
+
+    spikeparam, offset = read_tetrode_header(filename)
+
+    records = read_spike_records(filename, spikeparam=spikeparam, offset=offset)
+
+    num_spikes = spikeparam['num_spikes']
+
+    # only really care about the first time that gets written, converting from big-endian ints to float values
+    t = np.asarray(records['channel0']['t']) / spikeparam['timebase']
+
+    spikes = {'t': t.reshape(num_spikes, 1)}
+
+    if not timestamps_only:
+        for chan in range(4):
+            waveform = records['channel%d' % chan]['w']
+
+            if not mmap:
+                waveform = np.array(waveform, dtype=float)
+
+            spikes['ch%d' % (chan + 1)] = waveform
+
+    return spikes, spikeparam
+
+
+class TetrodeFile:
+    """
+    A Tint tetrode (.N) file that is memory mapped, only the spikes that are requested are read. The cell of each
+    spike comes from the matching .cut file.
+
+    Example:
+        tetrode = TetrodeFile('C:\\example\\tetrode_1.1')
+        waveforms = tetrode.waveforms(cells=[1, 2], t_start=60, t_stop=120)  # (4, n spikes, samples_per_spike)
+
+    Args:
+        filename (str): the fullpath of the tetrode file
+        cut_filename (str): (optional) the fullpath of the .cut file, defaults to the basename_tetrode.cut file in
+            the same directory (see find_unit).
+    """
+
+    def __init__(self, filename, cut_filename=None):
+        self.filename = filename
+
+        try:
+            self.tetrode = int(os.path.splitext(filename)[1][1:])
+        except ValueError:
+            raise ValueError("The following file is invalid: %s" % filename)
+
+        if cut_filename is None:
+            cut_filename = '%s_%d.cut' % (os.path.splitext(filename)[0], self.tetrode)
+
+        self.cut_filename = cut_filename
+
+        self.header, self.offset = read_tetrode_header(filename)
+        self.records = read_spike_records(filename, spikeparam=self.header, offset=self.offset)
+
+        self._timestamps = None
+        self._timestamps_sorted = None
+        self._cut = None
+
+    @property
+    def num_spikes(self):
+        return self.header['num_spikes']
+
+    @property
+    def samples_per_spike(self):
+        return self.header['samples_per_spike']
+
+    @property
+    def timebase(self):
+        return self.header['timebase']
+
+    @property
+    def sample_rate(self):
+        return self.header['sample_rate']
+
+    @property
+    def duration(self):
+        return self.header['duration']
+
+    @property
+    def timestamps(self):
+        """the time (seconds) of each spike, read the first time it is needed"""
+        if self._timestamps is None:
+            self._timestamps = np.asarray(self.records['channel0']['t']) / self.timebase
+            self._timestamps_sorted = bool(np.all(np.diff(self._timestamps) >= 0))
+        return self._timestamps
+
+    @property
+    def cut(self):
+        """the cell of each spike (from the .cut file), read the first time it is needed"""
+        if self._cut is None:
+            cut = read_cut(self.cut_filename)
+
+            if cut is None:
+                raise FileNotFoundError('Could not find the following filename: %s' % self.cut_filename)
+
+            if len(cut) != self.num_spikes:
+                raise ValueError('The cut file (%d spikes) does not match the tetrode file (%d spikes): %s' % (
+                    len(cut), self.num_spikes, self.cut_filename))
+
+            self._cut = cut
+        return self._cut
+
+    def get_spike_indices(self, cells=None, t_start=None, t_stop=None):
+        """
+        Returns the index of the spikes that belong to the cells (all if None) and occur within
+        t_start <= t < t_stop (seconds).
+        """
+
+        timestamps = self.timestamps
+
+        if self._timestamps_sorted:
+            start = 0 if t_start is None else np.searchsorted(timestamps, t_start, side='left')
+            stop = len(timestamps) if t_stop is None else np.searchsorted(timestamps, t_stop, side='left')
+            indices = np.arange(start, stop)
+        else:
+            window = np.ones(len(timestamps), dtype=bool)
+            if t_start is not None:
+                window &= timestamps >= t_start
+            if t_stop is not None:
+                window &= timestamps < t_stop
+            indices = np.where(window)[0]
+
+        if cells is not None:
+            indices = indices[np.isin(self.cut[indices], np.asarray(cells).flatten())]
+
+        return indices
+
+    def waveforms(self, cells=None, t_start=None, t_stop=None):
+        """
+        Returns the int8 waveforms (4, n spikes, samples_per_spike) of the spikes that belong to the cells (all if
+        None) and occur within t_start <= t < t_stop (seconds), only these spikes are read from the file.
+        """
+
+        records = self.records[self.get_spike_indices(cells=cells, t_start=t_start, t_stop=t_stop)]
+
+        return np.stack([records['channel%d' % chan]['w'] for chan in range(4)])
 
 
 def speed2D(x, y, t):
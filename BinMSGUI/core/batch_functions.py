@@ -3,7 +3,8 @@ import json
 from PyQt5 import QtWidgets
 
 from core.intan_mountainsort import convert_bin_mountainsort, validate_session
-from core.default_parameters import mask_num_write_chunks, clip_size, freq_min, freq_max, notch_filter
+from core.default_parameters import mask_num_write_chunks, clip_size, freq_min, freq_max, notch_filter, bin_cache, \
+    tetrode_workers, tetrode_memory_budget, sort_backend, sort_workers, sort_core_budget, sort_memory_budget
 
 
 def raise_error(main_window, error_action):
@@ -197,6 +198,13 @@ def BatchAnalyze(main_window, directory):
                                                  mask_num_write_chunks=mask_num_write_chunks,
                                                  clip_size=clip_size,
                                                  notch_filter=notch_filter,
+                                                 bin_cache=bin_cache,
+                                                 tetrode_workers=tetrode_workers,
+                                                 tetrode_memory_budget=tetrode_memory_budget,
+                                                 sort_backend=sort_backend,
+                                                 sort_workers=sort_workers,
+                                                 sort_core_budget=sort_core_budget,
+                                                 sort_memory_budget=sort_memory_budget,
                                                  pre_spike=pre_spike,
                                                  post_spike=post_spike,
                                                  num_features=num_features,
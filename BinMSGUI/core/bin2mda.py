@@ -1,9 +1,10 @@
 import os
 import numpy as np
-from core.readBin import get_bin_data, get_active_tetrode
+from core.readBin import get_bin_data, get_active_tetrode, bytes_per_packet
 import datetime
 from core.mountainsort_functions import _writemda
 from core.filtering import notch_filt
+from core.bin_demux import demux_bin, TetrodeMdaConsumer
 
 
 def bin2mda(bin_filename, set_filename, Fs=48e3, notch_filter=True, notch_freq=60, self=None):
@@ -40,50 +41,66 @@ def bin2mda(bin_filename, set_filename, Fs=48e3, notch_filter=True, notch_freq=6
 
     active_tetrodes = get_active_tetrode(set_filename)
 
-    for tetrode in active_tetrodes:
+    n_packets = int(os.path.getsize(bin_filename) / bytes_per_packet)
+    consumers = []
 
-        msg = '[%s %s]: Converting the following tetrode: %d!' % \
-              (str(datetime.datetime.now().date()),
-               str(datetime.datetime.now().time())[:8], tetrode)
-        if self:
-            self.LogAppend.myGUI_signal_str.emit(msg)
-        else:
-            print(msg)
+    # the streamed .mda files are created as their consumers are built, remove them if the conversion doesn't finish
+    try:
+        for tetrode in active_tetrodes:
+
+            msg = '[%s %s]: Converting the following tetrode: %d!' % \
+                  (str(datetime.datetime.now().date()),
+                   str(datetime.datetime.now().time())[:8], tetrode)
+            if self:
+                self.LogAppend.myGUI_signal_str.emit(msg)
+            else:
+                print(msg)
 
-        # get_tetrode_data
-        data = get_bin_data(bin_filename, tetrode=tetrode)
+            # check if the data has been filtered already
 
-        # check if the data has been filtered already
+            # TODO: add some methods to find out if the data has been filtered or not
+            data_filtered = True
 
-        # TODO: add some methods to find out if the data has been filtered or not
-        data_filtered = True
+            if data_filtered:
+                mda_filename = '%s_T%d_filt.mda' % (os.path.join(directory, tint_basename), tetrode)
+            else:
+                # the data has not been filtered
+                mda_filename = '%s_T%d_raw.mda' % (os.path.join(directory, tint_basename), tetrode)
 
-        if data_filtered:
-            mda_filename = '%s_T%d_filt.mda' % (os.path.join(directory, tint_basename), tetrode)
-        else:
-            # the data has not been filtered
-            mda_filename = '%s_T%d_raw.mda' % (os.path.join(directory, tint_basename), tetrode)
+            mda_filenames.append(mda_filename)
 
-        mda_filenames.append(mda_filename)
+            if os.path.exists(mda_filename):
+                msg = '[%s %s]: The following filename already exists: %s, skipping conversion!#Red' % \
+                      (str(datetime.datetime.now().date()),
+                       str(datetime.datetime.now().time())[:8], mda_filename)
 
-        if os.path.exists(mda_filename):
-            msg = '[%s %s]: The following filename already exists: %s, skipping conversion!#Red' % \
-                  (str(datetime.datetime.now().date()),
-                   str(datetime.datetime.now().time())[:8], mda_filename)
+                if self:
+                    self.LogAppend.myGUI_signal_str.emit(msg)
+                else:
+                    print(msg)
+                continue
 
-            if self:
-                self.LogAppend.myGUI_signal_str.emit(msg)
-            else:
-                print(msg)
-            continue
+            if not notch_filter:
+                # the tetrode will be streamed to the .mda file below
+                consumers.append(TetrodeMdaConsumer(mda_filename, tetrode, n_packets))
+                continue
+
+            # get_tetrode_data, the notch filter is applied to the whole recording so this tetrode can't be streamed
+            data = get_bin_data(bin_filename, tetrode=tetrode)
 
-        if notch_filter:
             data = notch_filt(data, Fs, freq=notch_freq)
 
-        # append any values if we want to make the duration even
-        data = np.int16(data)
+            # append any values if we want to make the duration even
+            data = np.int16(data)
+
+            _writemda(data, mda_filename, 'int16')
+    except BaseException:
+        for consumer in consumers:
+            consumer.abort()
+        raise
 
-        _writemda(data, mda_filename, 'int16')
+    # stream all the un-filtered tetrodes with a single pass through the .bin file
+    demux_bin(bin_filename, consumers)
 
     return mda_filenames
 
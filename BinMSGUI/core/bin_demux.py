@@ -0,0 +1,280 @@
+import os
+import datetime
+import functools
+import concurrent.futures
+import numpy as np
+from core.readBin import get_active_tetrode, get_active_eeg, get_channel_from_tetrode, format_raw_pos, \
+    iter_bin_packets, packets_to_array, bytes_per_packet, samples_per_packet, default_chunk_packets
+from core.mountainsort_functions import MdaWriter
+from core.Tint_Matlab import get_setfile_parameter
+from core.eeg_conversion import create_eeg, create_egf, get_eeg_filenames, get_egf_decimator, to_int16
+from core.convert_position import create_pos
+
+
+class SessionFileWriter:
+    """
+    Writes the .eeg/.egf/.pos files of a demux (see convert_bin_demux) in a background thread once the .bin file has
+    been read, so the tetrodes can be sorted while they are written.
+
+    Example:
+        session_writer = SessionFileWriter()
+        convert_bin_demux(tint_fullpath, output_basename, session_writer=session_writer)
+        # sort the tetrodes
+        session_writer.join()
+    """
+
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def submit(self, function):
+        self.futures.append(self.executor.submit(function))
+
+    def join(self):
+        """waits for the files to be written, raising the error of the first file that could not be written"""
+        self.executor.shutdown(wait=True)
+
+        for future in self.futures:
+            future.result()
+
+
+class TetrodeMdaConsumer:
+    """
+    Streams the channels of a tetrode into an int16 .mda file.
+    """
+
+    def __init__(self, mda_filename, tetrode, n_packets):
+        self.filename = mda_filename
+        self.channels = get_channel_from_tetrode(tetrode).tolist()
+
+        self.writer = MdaWriter(mda_filename, 'int16', (len(self.channels),),
+                                num_columns=n_packets * samples_per_packet)
+
+    def consume(self, data, packets, packet_offset):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+
+class EEGConsumer:
+    """
+    Keeps the EGF rate (4.8 kHz) samples of an EEG channel so that the .eeg and .egf files can be created once
+    the .bin file has been read. The samples are low-pass filtered and decimated as they are read (see
+    get_egf_decimator), only the decimated (int16) samples are kept to save memory. If a writer (see SessionFileWriter) is
+    given the files are written in its background thread.
+    """
+
+    def __init__(self, eeg_filename, egf_filename, channel, Fs, set_filename, Fs_EGF=int(4.8e3), writer=None):
+        self.eeg_filename = eeg_filename
+        self.egf_filename = egf_filename
+        self.channels = [channel]
+        self.decimator = get_egf_decimator(Fs, Fs_EGF)
+        self.Fs_EGF = Fs_EGF
+        self.set_filename = set_filename
+        self.writer = writer
+        self.chunks = []
+
+    def consume(self, data, packets, packet_offset):
+        # the files are written as int16 values, so there is no need to buffer the filtered values as floats
+        self.chunks.append(to_int16(self.decimator.decimate(data)))
+
+    def close(self):
+        data = np.hstack(self.chunks + [to_int16(self.decimator.flush())])
+        self.chunks = []
+
+        if self.writer is not None:
+            self.writer.submit(functools.partial(self.write, data))
+        else:
+            self.write(data)
+
+    def write(self, data):
+        if not os.path.exists(self.eeg_filename):
+            create_eeg(self.eeg_filename, data, self.Fs_EGF, self.set_filename, DC_Blocker=False)
+
+        if not os.path.exists(self.egf_filename):
+            create_egf(self.egf_filename, data, self.Fs_EGF, self.set_filename, DC_Blocker=False)
+
+    def abort(self):
+        self.chunks = []
+
+
+class PositionConsumer:
+    """Collects the ADU2 (valid position) packets and writes the .pos file once the .bin file has been read (in the
+    background thread of the writer, if given)."""
+
+    def __init__(self, pos_filename, set_filename, n_packets, writer=None):
+        self.filename = pos_filename
+        self.set_filename = set_filename
+        self.n_packets = n_packets
+        self.writer = writer
+        self.channels = []
+        self.rows = []
+
+    def consume(self, data, packets, packet_offset):
+        pos_bool = np.where(packets['id'] == b'ADU2')[0]
+
+        # packet #, video timestamp, y1, x1, y2, x2, numpix1, numpix2, total_pix, unused value
+        self.rows.append(np.hstack(((pos_bool + packet_offset).reshape((-1, 1)),
+                                    packets['timestamp'][pos_bool].reshape((-1, 1)),
+                                    packets['position'][pos_bool])).astype(float))
+
+    def close(self):
+        raw_pos = format_raw_pos(np.vstack(self.rows), self.n_packets)
+        self.rows = []
+
+        if self.writer is not None:
+            self.writer.submit(functools.partial(create_pos, self.filename, self.set_filename, raw_pos))
+        else:
+            create_pos(self.filename, self.set_filename, raw_pos)
+
+    def abort(self):
+        self.rows = []
+
+
+def demux_bin(bin_filename, consumers, chunk_packets=default_chunk_packets, channel_map=None):
+    """
+    This function will walk through the packets of a .bin file a single time, and hand each chunk of packets to
+    every consumer (tetrode .mda writers, EEG buffers, the position extractor, etc.).
+
+    Args:
+        bin_filename (str): the fullpath of the .bin file
+        consumers (list): objects with a channels attribute (the channels from 1-64 that they need), a
+            consume(data, packets, packet_offset) method and close/abort methods. data will be a (channels, samples)
+            int16 array, and packets the raw packets of the chunk (see packet_dtype).
+        chunk_packets (int): the number of packets to read at a time, this determines the memory used.
+        channel_map (ChannelMap): the channel re-mapping of the headstage, defaults to the Axona re-mapping.
+    """
+
+    if len(consumers) == 0:
+        return
+
+    # read each channel once per chunk, even if multiple consumers need it
+    channels = sorted(set(channel for consumer in consumers for channel in consumer.channels))
+    channel_rows = {channel: i for i, channel in enumerate(channels)}
+    consumer_rows = [[channel_rows[channel] for channel in consumer.channels] for consumer in consumers]
+
+    try:
+        for packet_offset, packets in iter_bin_packets(bin_filename, chunk_packets=chunk_packets):
+            data = packets_to_array(packets, channels, channel_map=channel_map)
+
+            for consumer, rows in zip(consumers, consumer_rows):
+                consumer.consume(data[rows, :], packets, packet_offset)
+
+        for consumer in consumers:
+            consumer.close()
+
+    except BaseException:
+        for consumer in consumers:
+            consumer.abort()
+        raise
+
+
+def convert_bin_demux(tint_fullpath, output_basename, tetrodes=True, session_files=True,
+                      chunk_packets=default_chunk_packets, session_writer=None, self=None):
+    """
+    This will create the tetrode .mda files, the .eeg/.egf files and the .pos file for a session while reading the
+    .bin file a single time. Any of the files that already exist will not be re-created. The products are chosen
+    from the collectMask_X (tetrodes) and saveEEG_ch_X (eeg) values of the .set file.
+
+    Args:
+        tint_fullpath (str): the fullpath of the session without the extension (the .bin/.set files)
+        output_basename (str): the fullpath basename for the converted Tint files (the converted .set file must
+            already exist as it is used for the .eeg/.egf/.pos headers)
+        tetrodes (bool): if False the tetrode .mda files will not be created (i.e. if they need to be notch filtered)
+        session_files (bool): if False the .eeg/.egf/.pos files will not be created
+        chunk_packets (int): the number of packets to process at a time.
+        session_writer (SessionFileWriter): if given, the .eeg/.egf/.pos files are written in its background thread
+            (join it to wait for them) instead of before returning, so the tetrodes can be sorted in the meantime.
+        self (object): the main window of the GUI (for the LogAppend signal).
+
+    Returns:
+        mda_filenames (list): a list of the tetrode .mda files for this session
+    """
+
+    bin_filename = '%s.bin' % tint_fullpath
+    set_filename = '%s.set' % tint_fullpath
+    converted_set_filename = '%s.set' % output_basename
+    pos_filename = '%s.pos' % output_basename
+
+    if not os.path.exists(bin_filename) or not os.path.exists(set_filename):
+
+        msg = '[%s %s]: either of the two following files does not exist, skipping conversion: %s\n%s\n' % \
+              (str(datetime.datetime.now().date()),
+               str(datetime.datetime.now().time())[:8], bin_filename, set_filename)
+
+        if self:
+            self.LogAppend.myGUI_signal_str.emit(msg)
+        else:
+            print(msg)
+
+        raise FileNotFoundError('missing conversion files (.set or .bin)')
+
+    n_packets = int(os.path.getsize(bin_filename) / bytes_per_packet)
+
+    consumers = []
+    mda_filenames = []
+    products = []
+
+    # the .mda files are created as the consumers are built, any that were created are removed if the conversion
+    # doesn't finish
+    try:
+        if tetrodes:
+            for tetrode in get_active_tetrode(set_filename):
+                mda_filename = '%s_T%d_filt.mda' % (tint_fullpath, tetrode)
+                mda_filenames.append(mda_filename)
+
+                if os.path.exists(mda_filename):
+                    msg = '[%s %s]: The following filename already exists: %s, skipping conversion!#Red' % \
+                          (str(datetime.datetime.now().date()),
+                           str(datetime.datetime.now().time())[:8], mda_filename)
+
+                    if self:
+                        self.LogAppend.myGUI_signal_str.emit(msg)
+                    else:
+                        print(msg)
+                    continue
+
+                consumers.append(TetrodeMdaConsumer(mda_filename, tetrode, n_packets))
+                products.append('T%d' % tetrode)
+
+        if session_files:
+            Fs = int(get_setfile_parameter('rawRate', set_filename))
+
+            for eeg_number, eeg_channel in sorted(get_active_eeg(set_filename).items()):
+                eeg_filename, egf_filename = get_eeg_filenames(output_basename, eeg_number)
+
+                if os.path.exists(eeg_filename) and os.path.exists(egf_filename):
+                    continue
+
+                consumers.append(EEGConsumer(eeg_filename, egf_filename, eeg_channel + 1, Fs, converted_set_filename,
+                                             writer=session_writer))
+                products.append(os.path.basename(eeg_filename))
+
+            if not os.path.exists(pos_filename):
+                consumers.append(PositionConsumer(pos_filename, converted_set_filename, n_packets,
+                                                  writer=session_writer))
+                products.append(os.path.basename(pos_filename))
+    except BaseException:
+        for consumer in consumers:
+            consumer.abort()
+        raise
+
+    if len(consumers) == 0:
+        return mda_filenames
+
+    msg = '[%s %s]: Reading the following bin file once for: %s!' % \
+          (str(datetime.datetime.now().date()),
+           str(datetime.datetime.now().time())[:8], ', '.join(products))
+
+    if self:
+        self.LogAppend.myGUI_signal_str.emit(msg)
+    else:
+        print(msg)
+
+    demux_bin(bin_filename, consumers, chunk_packets=chunk_packets)
+
+    return mda_filenames
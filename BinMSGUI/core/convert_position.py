@@ -1,8 +1,8 @@
 import os
 import datetime
 from core.readBin import get_raw_pos
-from core.Tint_Matlab import get_setfile_parameter
-import struct
+from core.Tint_Matlab import get_setfile_parameter, get_pos_record_dtype
+import numpy as np
 
 
 def get_set_header(set_filename):
@@ -15,6 +15,26 @@ def get_set_header(set_filename):
     return header
 
 
+def get_pos_records(pos_data):
+    """
+    This will create the structured array (see get_pos_record_dtype) of the (n, 9) position data (vid time, x1, y1,
+    x2, y2, numpix1, numpix2, total_pix, unused) so it can be written with a single write.
+    """
+    pos_data = np.asarray(pos_data).astype(int)
+
+    records = np.zeros(pos_data.shape[0], dtype=get_pos_record_dtype())
+
+    for field, values in (('t', pos_data[:, 0]), ('coords', pos_data[:, 1:])):
+        field_info = np.iinfo(records.dtype[field].base)
+        if values.size > 0 and (values.min() < field_info.min or values.max() > field_info.max):
+            raise ValueError('The position values must be within the %d -> %d range!' % (
+                field_info.min, field_info.max))
+
+        records[field] = values
+
+    return records
+
+
 def create_pos(pos_filename, set_filename, pos_data):
     n = int(pos_data.shape[0])
 
@@ -86,9 +106,7 @@ def create_pos(pos_filename, set_filename, pos_data):
         onespot = 1  # this is just in case we decide to add other modes.
 
         if onespot:
-            position_format_string = 'i8h'
-            position_format_string = '>%s' % (n * position_format_string)
-            write_list.append(struct.pack(position_format_string, *pos_data.astype(int).flatten()))
+            write_list.append(get_pos_records(pos_data).tobytes())
 
         write_list.append(bytes('\r\ndata_end\r\n', 'utf-8'))
         f.writelines(write_list)
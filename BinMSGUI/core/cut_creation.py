@@ -4,6 +4,47 @@ import json
 import datetime
 
 
+def iter_formatted_values(values, fmt, values_per_line=25, trailing_newline=False, lines_per_block=40000):
+    """
+    This will yield the text of the values (each formatted with fmt, values_per_line values per line)
+    lines_per_block lines at a time so large files can be written without creating the entire string. There are
+    only a few cells, so each unique value is formatted once and the text is created by indexing these strings.
+
+    Args:
+        values (ndarray): the values to format, i.e. the cut
+        fmt (str): the format of a single value, i.e. '%3u'
+        values_per_line (int): the number of values on each line
+        trailing_newline (bool): if True the last line (if it has fewer values) also ends with a new line
+        lines_per_block (int): the number of lines to yield at a time
+    """
+
+    values = np.asarray(values).flatten()
+
+    unique_values, inverse = np.unique(values, return_inverse=True)
+
+    # the last string is the new line
+    strings = np.array([fmt % value for value in unique_values.tolist()] + ['\n'], dtype=object)
+    newline = len(strings) - 1
+
+    block_size = values_per_line * lines_per_block
+
+    for start in range(0, len(values), block_size):
+        block = inverse[start:start + block_size]
+
+        n_lines = len(block) // values_per_line
+        n_full = n_lines * values_per_line
+
+        lines = np.hstack((block[:n_full].reshape((n_lines, values_per_line)),
+                           np.full((n_lines, 1), newline, dtype=block.dtype)))
+
+        text = ''.join(strings[lines.flatten()].tolist()) + ''.join(strings[block[n_full:]].tolist())
+
+        if trailing_newline and n_full < len(block):
+            text += '\n'
+
+        yield text
+
+
 def write_cut(cut_filename, cut, basename=None):
     if basename is None:
         basename = os.path.basename(os.path.splitext(cut_filename)[0])
@@ -36,17 +77,13 @@ def write_cut(cut_filename, cut, basename=None):
         write_list.append('%smax:%s' % (empty_space, zero_string))
     write_list.append('\nExact_cut_for: %s spikes: %d\n' % (basename, n_spikes))
 
-    # now the cut file lists 25 values per row
-    n_rows = int(np.floor(n_spikes / 25))  # number of full rows
-
-    remaining = int(n_spikes - n_rows * 25)
-    cut_string = ('%3u' * 25 + '\n') * n_rows + '%3u' * remaining
-
-    write_list.append(cut_string % (tuple(cut)))
-
     with open(cut_filename, 'w') as f:
         f.writelines(write_list)
 
+        # now the cut file lists 25 values per row, the last row has no new line
+        for text in iter_formatted_values(cut, '%3u', values_per_line=25):
+            f.write(text)
+
 
 def write_clu(clu_filename, data):
 
@@ -58,8 +95,10 @@ def write_clu(clu_filename, data):
 
     data += 1  # making the data 1-based instead of 0-based
 
-    # saving the data as a column (delimter='\n') and integer format.
-    np.savetxt(clu_filename, data, fmt='%d', delimiter='\n')
+    # saving the data as a column (a value per line) and integer format.
+    with open(clu_filename, 'w') as f:
+        for text in iter_formatted_values(data, '%d', values_per_line=1, trailing_newline=True):
+            f.write(text)
 
 
 def is_json(file):
@@ -95,50 +134,76 @@ def get_mua_cells(metrics_filename):
     return mua_list
 
 
-def get_tint_cut(cut, mua_cells):
+def get_tint_cut(cut, mua_cells, always_gap=False):
     """This will make it so that the good cells are consecutive and in the beginning of the cut file, and the
     MUA (noise + cells that just didn't meet our criteria), will be in the back, separated by an emtpy cell.
-    It will also sort the mua cells from most least to most spikes."""
-    from operator import itemgetter
+    It will also sort the mua cells from most least to most spikes.
+
+    Args:
+        cut (ndarray): the cell number of each spike
+        mua_cells (list): the cell numbers that are MUA
+        always_gap (bool): if False there is no gap when every cell is MUA
 
-    mua_cells = np.asarray(mua_cells)
+    Returns:
+        cut (ndarray): the new (int) cell number of each spike
+        cut_dict (dict): cut_value, new_consecutive_cut_value
+    """
+
+    cut = np.asarray(cut).flatten()
+    mua_cells = np.asarray(mua_cells).flatten()
+
+    # the cut values, the index of each spike's value, and the number of spikes of each value
+    values, inverse = np.unique(cut, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(values))
 
     cut_dict = {0: 0}  # cut_value, new_consecutive_cut_value
 
     # for the curated the cut values might not be consecutive numbers, lets turn these values
     # into consecutive numbers
 
-    if 0 in cut:
+    if 0 in values:
         add_one = 0
     else:
         add_one = 1
 
-    cells = np.setdiff1d(np.unique(cut), mua_cells)
+    cells = np.setdiff1d(values, mua_cells)
 
-    i = 0  # initialize i, if all the cells are mua, it will skip the next for loop and i will not be initialized
-    for i, cut_value in enumerate(np.unique(cells)):
+    for cut_value, new_value in zip(cells.tolist(), np.arange(len(cells)) + add_one):
         if cut_value == 0:
             continue
 
-        cut_dict[cut_value] = i + add_one  # +1 because we already have zero
+        cut_dict[cut_value] = int(new_value)
+
+    # if all the cells are mua, the last index will be 0
+    i = max(len(cells) - 1, 0)
 
-    if len(mua_cells) != len(np.unique(cut)):
+    if always_gap or len(mua_cells) != len(values):
         i_offset = i + 1 + 1  # +1 for the gap as well as incrementing +1 from what we have already done above
     else:
         i_offset = i + 1  # +1 for the gap as well as incrementing +1 from what we have already done above
 
-    count_dict = {}
-    for cut_value in mua_cells:
-        count_dict[cut_value] = sum(cut.flatten() == cut_value)
+    # the mua cells (without repeats, in the order given) and their number of spikes
+    _, first_index = np.unique(mua_cells, return_index=True)
+    mua_cells = mua_cells[np.sort(first_index)]
 
-    for i, cut_value in enumerate(sorted(count_dict.items(), key=lambda x: x[1])):
-        cut_value = cut_value[0]
+    value_index = np.minimum(np.searchsorted(values, mua_cells), max(len(values) - 1, 0))
+    if len(values) > 0:
+        mua_counts = np.where(values[value_index] == mua_cells, counts[value_index], 0)
+    else:
+        mua_counts = np.zeros(len(mua_cells), dtype=int)
+
+    # a stable sort so the cells with the same number of spikes stay in the order given
+    mua_order = np.argsort(mua_counts, kind='stable')
+    for cut_value, new_value in zip(mua_cells[mua_order].tolist(), np.arange(len(mua_order)) + i_offset + add_one):
         if cut_value == 0:
             continue
 
-        cut_dict[cut_value] = i + i_offset + add_one  # +1 because we already have zero
+        cut_dict[cut_value] = int(new_value)
+
+    # re-number every spike at once with a lookup table of the cut values
+    lookup = np.array([cut_dict[cut_value] for cut_value in values.tolist()], dtype=int)
 
-    return itemgetter(*list(cut))(cut_dict), cut_dict
+    return lookup[inverse], cut_dict
 
 
 def create_cut(cut_filename, clu_filename, cell_numbers, tetrode, tint_basename, output_basename, self=None):
@@ -65,6 +65,13 @@ max_num_clips_for_pca = 1000
 
 clip_size = 50  # this needs to be left at 50 for Tint, Tint only likes 50 samples
 notch_filter = False  # the data is already notch filtered likely
+bin_cache = False  # keep a channel-major copy of the .bin file (as large as the .bin) for the notch filtered reads
+tetrode_workers = 1  # the number of tetrodes to convert to Tint at once (each in its own process)
+tetrode_memory_budget = None  # the memory (bytes) the tetrode conversions can use at once, None for no limit
+sort_backend = None  # how ml-run-process is launched: 'wsl' or 'native', None uses WSL on Windows and native otherwise
+sort_workers = 1  # the number of tetrodes to sort at once
+sort_core_budget = None  # the cores (num_workers) the sorts share, None uses all of them
+sort_memory_budget = None  # the memory (bytes) the sorts can use at once, None for no limit
 self = None  # don't worry about this, this is for objective oriented programming (my GUIs)
 
 default_settings = {'pre_spike': pre_spike, 'post_spike': post_spike, 'detect_sign': detect_sign,
@@ -1,13 +1,24 @@
 import os
 from core.Tint_Matlab import int16toint8, get_setfile_parameter, get_active_eeg
-from core.readBin import get_bin_data, get_active_eeg
+from core.readBin import iter_bin_chunks, get_active_eeg, default_chunk_packets, bytes_per_packet, \
+    samples_per_packet
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.signal
-import struct
+import locale
 import datetime
 
 
+# the EGF (4.8 kHz) samples that make up the EEG (250 Hz), 5 samples of every 96
+eeg_period = 96
+eeg_offsets = (18, 37, 56, 75, 95)
+
+# the raw data is low-pass filtered below the EGF's Nyquist frequency (2.4 kHz) before it is down-sampled to the EGF,
+# so the content above 2.4 kHz does not alias into the EGF
+egf_cutoff = 2200
+egf_n_taps = 201
+
+
 def create_eeg(filename, data, Fs, set_filename, DC_Blocker=True):
     # data is given in int16
 
@@ -17,7 +28,7 @@ def create_eeg(filename, data, Fs, set_filename, DC_Blocker=True):
     Fs_EGF = int(4.8e3)  # sampling rate of .EGF files
     Fs_EEG = int(250)
 
-    data = data[:, 0::int(Fs / Fs_EGF)]
+    data = get_egf_decimator(Fs, Fs_EGF).decimate_all(data)
 
     # append zeros to make the duration a round number
     duration_round = np.ceil(data.shape[1] / Fs_EGF)  # the duration should be rounded up to the nearest integer
@@ -38,12 +49,11 @@ def create_eeg(filename, data, Fs, set_filename, DC_Blocker=True):
     data[np.where(data > 32767)] = 32767
     data[np.where(data < -32768)] = -32768
 
-    data, N = fir_hann(data, Fs_EGF, 125, n_taps=101, showresponse=0)  # FIR filter to remove anti aliasing
+    # FIR filter to remove anti aliasing while down-sampling to 250 Hz, only the 250 Hz samples are filtered
+    data = egf_to_eeg(data.reshape((1, -1)), Fs_EGF)
 
     data = int16toint8(data)
 
-    data = EEG_downsample(data)
-
     # append 1 second of 0's like tint does
     data = np.hstack((data.flatten(), np.zeros((250, 1)).flatten()))
     ##################################################################################################
@@ -57,21 +67,147 @@ def EEG_downsample(EEG):
     """The EEG data is created from the EGF files which involves a 4.8k to 250 Hz conversion"""
     EEG = EEG.flatten()
 
-    i = -1
-    # i = 0
+    return EEG[get_decimation_indices(0, len(EEG), eeg_period, eeg_offsets)]
+
+
+def get_decimation_indices(start, stop, period, offsets=(0,)):
+    """
+    Returns the indices (start <= index < stop) of the samples that are kept when the given offsets of every period
+    of samples are kept, i.e. period=10, offsets=(0,) keeps every 10th sample.
+    """
+    offsets = np.asarray(offsets, dtype=int)
+
+    periods = np.arange(start // period, -(-stop // period), dtype=int)
+
+    indices = (periods.reshape((-1, 1)) * period + offsets).flatten()
+
+    return indices[(indices >= start) & (indices < stop)]
+
+
+class Decimator:
+    """
+    A multi-rate decimator, it will apply the FIR filter (taps) and keep the samples at the given offsets of every
+    period, only the kept samples are filtered (like a polyphase filter). The data of all the channels is decimated
+    at once, and it can be given chunk by chunk as the end of the previous chunk is kept, the results will match
+    decimating the entire recording at once (the filter matches scipy.signal.lfilter with zero initial conditions).
+
+    The filter delays the data by (len(taps) - 1) / 2 samples, if delay is given the kept samples are instead taken
+    delay samples later, so the decimated data lines up with the original (and the other files of the session). The
+    last kept samples are then only known once the end of the recording is reached, see flush.
+
+    Example:
+        decimator = get_egf_decimator(48000)  # 48 kHz -> 4.8 kHz
+        chunks = [decimator.decimate(chunk) for chunk in iter_bin_chunks(bin_filename, channels=[1, 2])]
+        egf = np.hstack(chunks + [decimator.flush()])
+
+    Args:
+        period (int): the number of samples in each period
+        offsets (tuple): the samples (within each period) that are kept
+        taps (ndarray): (optional) the FIR filter coefficients, without taps the samples are only selected (and keep
+            their data type).
+        delay (int): (optional) the number of samples to compensate for, i.e. the group delay of the filter.
+    """
+
+    def __init__(self, period, offsets=(0,), taps=None, delay=0):
+        self.period = int(period)
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.taps = None if taps is None else np.asarray(taps, dtype=float)
+        self.delay = int(delay) if taps is not None else 0
+
+        self.sample_offset = 0  # the sample index (of the recording) of the next chunk
+        self.history = None  # the last len(taps) - 1 samples of the previous chunks
+
+    def get_n_samples(self, n):
+        """the number of samples that a recording of n samples is decimated to"""
+        return len(get_decimation_indices(0, n, self.period, self.offsets))
+
+    def decimate(self, data, n_recording=None):
+        """decimates the next (channels, samples) chunk of the recording, returning a (channels, kept samples) array.
+        n_recording is the length of the recording, only needed once its end has been reached (see flush)"""
+        data = np.asarray(data)
+
+        start = self.sample_offset
+        n = data.shape[1]
+        self.sample_offset += n
+
+        # the samples (of the recording) that are kept, each is filtered from the samples up to delay samples after it
+        kept_stop = start + n - self.delay
+        if n_recording is not None:
+            kept_stop = min(kept_stop, n_recording)
+        kept = get_decimation_indices(max(0, start - self.delay), max(0, kept_stop), self.period, self.offsets)
+        indices = kept + self.delay - start
+
+        if self.taps is None:
+            return data[:, indices]
+
+        n_history = len(self.taps) - 1
+        if self.history is None:
+            self.history = np.zeros((data.shape[0], n_history))
+
+        data = np.hstack((self.history, data))
+        self.history = data[:, data.shape[1] - n_history:].copy()
+
+        if len(indices) == 0:
+            return np.zeros((data.shape[0], 0))
 
-    # indices = [i]
-    indices = []
-    while i < len(EEG) - 1:
-        indices.extend([(i + 19), (i + 19 * 2), (i + 19 * 3), (i + 19 * 4), (i + 19 * 4 + 20)])
-        # indices.extend([(i+20), (i+20+19), (i+20+19*2), (i+20+19*3), (i+20+19*4)])
-        i += (19 * 4 + 20)
+        # the samples that each kept sample is filtered from (sample - len(taps) + 1 -> sample)
+        windows = np.lib.stride_tricks.sliding_window_view(data, len(self.taps), axis=1)[:, indices, :]
 
-    indices = np.asarray(indices)
+        return windows @ self.taps[::-1]
 
-    indices = indices[np.where(indices <= len(EEG) - 1)]
+    def flush(self):
+        """returns the last kept samples of the recording (those within delay samples of its end), the recording is
+        padded with zeros to filter them"""
+        n_recording = self.sample_offset
+        n_channels = 0 if self.history is None else self.history.shape[0]
 
-    return EEG[indices]
+        if self.delay == 0 or self.history is None:
+            return np.zeros((n_channels, 0))
+
+        return self.decimate(np.zeros((n_channels, self.delay)), n_recording=n_recording)
+
+    def decimate_all(self, data, chunk_size=eeg_period * 10000):
+        """decimates the entire (channels, samples) recording, chunk_size samples at a time to limit the memory"""
+        data = np.asarray(data)
+
+        chunks = [self.decimate(data[:, i:i + chunk_size]) for i in range(0, max(data.shape[1], 1), chunk_size)]
+
+        if self.delay == 0:
+            return np.hstack(chunks)
+
+        return np.hstack(chunks + [self.flush()])
+
+
+def to_int16(data):
+    """truncates the (filtered) data to int16 values, clipping them to the int16 range"""
+    return np.clip(np.trunc(data), -32768, 32767).astype(np.int16)
+
+
+def get_egf_decimator(Fs, Fs_EGF=int(4.8e3), cutoff=egf_cutoff, n_taps=egf_n_taps):
+    """
+    returns the Decimator that filters (anti aliasing, see fir_hann) and down-samples the raw data (Fs) to the EGF,
+    if the data is already at the EGF sampling rate it is left as is.
+    """
+    period = int(Fs / Fs_EGF)
+
+    if period == 1:
+        return Decimator(period)
+
+    # the filter's group delay is compensated so the EGF stays aligned with the spikes and positions
+    return Decimator(period, taps=get_fir_hann_taps(Fs, cutoff, n_taps=n_taps), delay=(n_taps - 1) // 2)
+
+
+def get_eeg_decimator(Fs_EGF=int(4.8e3), cutoff=125, n_taps=101):
+    """returns the Decimator that filters (anti aliasing, see fir_hann) and down-samples the EGF data to the EEG"""
+    return Decimator(eeg_period, offsets=eeg_offsets, taps=get_fir_hann_taps(Fs_EGF, cutoff, n_taps=n_taps))
+
+
+def egf_to_eeg(data, Fs_EGF=int(4.8e3), chunk_size=eeg_period * 10000):
+    """
+    This will filter and down-sample the (channels, samples) EGF data to the 250 Hz EEG data, chunk_size samples at a
+    time.
+    """
+    return get_eeg_decimator(Fs_EGF).decimate_all(data, chunk_size=chunk_size)
 
 
 def write_eeg(filepath, data, Fs, set_filename=None):
@@ -109,45 +245,59 @@ def write_eeg(filepath, data, Fs, set_filename=None):
         data = np.hstack((data, np.zeros((1, missing_samples)).flatten()))
         num_samples = EEG_expected_num
 
-    with open(filepath, 'w') as f:
+    num_chans = 'num_chans 1'
 
-        num_chans = 'num_chans 1'
+    if egf:
+        sample_rate = '\nsample_rate %d Hz' % (int(Fs))
+        data_dtype = '<i2'
+        b_p_sample = '\nbytes_per_sample 2'
+        num_EEG_samples = '\nnum_EGF_samples %d' % (num_samples)
 
-        if egf:
-            sample_rate = '\nsample_rate %d Hz' % (int(Fs))
-            data = struct.pack('<%dh' % (num_samples), *[np.int(data_value) for data_value in data.tolist()])
-            b_p_sample = '\nbytes_per_sample 2'
-            num_EEG_samples = '\nnum_EGF_samples %d' % (num_samples)
+    else:
+        sample_rate = '\nsample_rate %d.0 hz' % (int(Fs))
+        data_dtype = '>i1'
+        b_p_sample = '\nbytes_per_sample 1'
+        num_EEG_samples = '\nnum_EEG_samples %d' % (num_samples)
 
-        else:
-            sample_rate = '\nsample_rate %d.0 hz' % (int(Fs))
-            data = struct.pack('>%db' % (num_samples), *[np.int(data_value) for data_value in data.tolist()])
-            b_p_sample = '\nbytes_per_sample 1'
-            num_EEG_samples = '\nnum_EEG_samples %d' % (num_samples)
+    eeg_p_position = '\nEEG_samples_per_position %d' % (5)
 
-        eeg_p_position = '\nEEG_samples_per_position %d' % (5)
+    start = '\ndata_start'
 
-        start = '\ndata_start'
+    if egf:
+        write_order = [header, num_chans, sample_rate,
+                       b_p_sample, num_EEG_samples, start]
+    else:
+        write_order = [header, num_chans, sample_rate, eeg_p_position,
+                       b_p_sample, num_EEG_samples, start]
 
-        if egf:
-            write_order = [header, num_chans, sample_rate,
-                           b_p_sample, num_EEG_samples, start]
-        else:
-            write_order = [header, num_chans, sample_rate, eeg_p_position,
-                           b_p_sample, num_EEG_samples, start]
+    # the values are truncated towards zero (like int()), and must fit within the data type
+    data = np.trunc(data)
+    data_info = np.iinfo(data_dtype)
+    if num_samples > 0 and (data.min() < data_info.min or data.max() > data_info.max):
+        raise ValueError('The %s data must be within the %d -> %d range!' % (
+            'EGF' if egf else 'EEG', data_info.min, data_info.max))
+
+    # the header has always been written in text mode, keep the platform's line endings and encoding
+    header = ''.join(write_order).replace('\n', os.linesep).encode(locale.getpreferredencoding(False))
+
+    with open(filepath, 'wb') as f:
+        f.write(header)
+        data.astype(data_dtype).tofile(f)
+        f.write(bytes('\r\ndata_end\r\n', 'utf-8'))
 
-        f.writelines(write_order)
 
-    with open(filepath, 'rb+') as f:
-        f.seek(0, 2)
-        f.writelines([data, bytes('\r\ndata_end\r\n', 'utf-8')])
+def get_fir_hann_taps(Fs, cutoff, n_taps=101):
+    # The Nyquist rate of the signal.
+    nyq_rate = Fs / 2
+
+    return scipy.signal.firwin(n_taps, cutoff / nyq_rate, window='hann')
 
 
 def fir_hann(data, Fs, cutoff, n_taps=101, showresponse=0):
     # The Nyquist rate of the signal.
     nyq_rate = Fs / 2
 
-    b = scipy.signal.firwin(n_taps, cutoff / nyq_rate, window='hann')
+    b = get_fir_hann_taps(Fs, cutoff, n_taps=n_taps)
 
     a = 1.0
     # Use lfilter to filter x with the FIR filter.
@@ -190,7 +340,7 @@ def create_egf(filename, data, Fs, set_filename, DC_Blocker=True):
 
     Fs_EGF = int(4.8e3)  # sampling rate of .EGF files
 
-    data = data[:, 0::int(Fs / Fs_EGF)]
+    data = get_egf_decimator(Fs, Fs_EGF).decimate_all(data)
 
     # notch filter the data
     # data = sp.Filtering().notch_filt(data, Fs_EGF, freq=60, band=10, order=3)
@@ -221,6 +371,38 @@ def create_egf(filename, data, Fs, set_filename, DC_Blocker=True):
     write_eeg(filename, data, Fs_EGF, set_filename=set_filename)
 
 
+def get_egf_data(bin_filename, channels, Fs, Fs_EGF=int(4.8e3), chunk_packets=default_chunk_packets):
+    """
+    This will read the given channels (from 1-64) from the .bin file and return them at the EGF sampling rate as a
+    (channels, samples) int16 array (low-pass filtered, see get_egf_decimator). The data is decimated as it is read
+    so the full rate data is never held in memory.
+    """
+    decimator = get_egf_decimator(Fs, Fs_EGF)
+
+    n_samples = int(os.path.getsize(bin_filename) / bytes_per_packet) * samples_per_packet
+
+    data = np.zeros((len(channels), decimator.get_n_samples(n_samples)), dtype=np.int16)
+
+    sample_offset = 0
+    for chunk in iter_bin_chunks(bin_filename, channels=channels, chunk_packets=chunk_packets):
+        chunk = to_int16(decimator.decimate(chunk))
+        data[:, sample_offset:sample_offset + chunk.shape[1]] = chunk
+        sample_offset += chunk.shape[1]
+
+    chunk = to_int16(decimator.flush())
+    data[:, sample_offset:sample_offset + chunk.shape[1]] = chunk
+
+    return data
+
+
+def get_eeg_filenames(output_basename, eeg_number):
+    """returns the (.eeg, .egf) filenames for a given eeg number, the first eeg has no numerical suffix"""
+    if eeg_number == 1:
+        return output_basename + '.eeg', output_basename + '.egf'
+
+    return output_basename + '.eeg%d' % eeg_number, output_basename + '.egf%d' % eeg_number
+
+
 def convert_eeg(set_filename, new_basename, self=None):
 
     if not os.path.exists(set_filename):
@@ -254,86 +436,67 @@ def convert_eeg(set_filename, new_basename, self=None):
         raise FileNotFoundError('The following filename was not found: %s!' % bin_filename)
 
     Fs = int(get_setfile_parameter('rawRate', set_filename))
+    Fs_EGF = int(4.8e3)  # the channels are read at the EGF sampling rate
 
     active_eeg_channels = get_active_eeg(set_filename)
-    active_eeg_channel_numbers = np.asarray(
-        list(active_eeg_channels.values())) + 1  # makes the eeg channels from 1-> 64
 
-    for channel in active_eeg_channel_numbers:
+    # find the .eeg/.egf files that need to be created, so all their channels can be read at once
+    conversions = []
+    for eeg_number, eeg_chan_value in sorted(active_eeg_channels.items()):
 
-        for eeg_number, eeg_chan_value in sorted(active_eeg_channels.items()):
-            if eeg_chan_value == channel - 1:
-                break
+        channel = eeg_chan_value + 1  # makes the eeg channels from 1-> 64
 
-        if eeg_number == 1:
-            eeg_str = ''
-        else:
-            eeg_str = str(eeg_number)
+        eeg_filename, egf_filename = get_eeg_filenames(os.path.join(directory, new_basename), eeg_number)
 
-        if eeg_number == 1:
-            eeg_filename = os.path.join(directory, new_basename + '.eeg')
-            egf_filename = os.path.join(directory, new_basename + '.egf')
-        else:
-            eeg_filename = os.path.join(directory, new_basename + '.eeg%d' % (eeg_number))
-            egf_filename = os.path.join(directory, new_basename + '.egf%d' % (eeg_number))
+        create_files = []
+        for filename, file_type in ((eeg_filename, 'EEG'), (egf_filename, 'EGF')):
+            if os.path.exists(filename):
+                msg = '[%s %s]: The following %s file has already been created, skipping: %s!' % \
+                      (str(datetime.datetime.now().date()),
+                       str(datetime.datetime.now().time())[:8], file_type, filename)
+                if self is not None:
+                    self.LogAppend.myGUI_signal_str.emit(msg)
+                else:
+                    print(msg)
+            else:
+                create_files.append((filename, file_type))
 
-        if os.path.exists(eeg_filename):
+        if len(create_files) > 0:
+            conversions.append((channel, create_files))
 
-            EEG = np.array([])
-            msg = '[%s %s]: The following EEG file has already been created, skipping: %s!' % \
-                  (str(datetime.datetime.now().date()),
-                   str(datetime.datetime.now().time())[:8], eeg_filename)
-            if self is not None:
-                self.LogAppend.myGUI_signal_str.emit(msg)
-            else:
-                print(msg)
-        else:
-            msg = '[%s %s]: Creating the following EEG file: .eeg%s!' % \
-                  (str(datetime.datetime.now().date()),
-                   str(datetime.datetime.now().time())[:8], eeg_str)
+    if len(conversions) == 0:
+        return
 
-            if self is not None:
-                self.LogAppend.myGUI_signal_str.emit(msg)
-            else:
-                print(msg)
+    channels = sorted(set(channel for channel, _ in conversions))
 
-            # load data
-            EEG = get_bin_data(bin_filename, channels=[channel])
+    msg = '[%s %s]: Reading the following EEG channels from the bin file: %s!' % \
+          (str(datetime.datetime.now().date()),
+           str(datetime.datetime.now().time())[:8], ', '.join(str(channel) for channel in channels))
 
-            create_eeg(eeg_filename, EEG, Fs, converted_set_filename, DC_Blocker=False)
-            # EEG = None
+    if self is not None:
+        self.LogAppend.myGUI_signal_str.emit(msg)
+    else:
+        print(msg)
+
+    # load the data of every channel with a single read of the .bin file
+    EGF = get_egf_data(bin_filename, channels, Fs, Fs_EGF=Fs_EGF)
 
-        if os.path.exists(egf_filename):
+    for channel, create_files in conversions:
+        data = EGF[[channels.index(channel)], :]
 
-            msg = '[%s %s]: The following EGF file has already been created, skipping: %s!' % \
+        for filename, file_type in create_files:
+            msg = '[%s %s]: Creating the following %s file: %s!' % \
                   (str(datetime.datetime.now().date()),
-                   str(datetime.datetime.now().time())[:8], eeg_filename)
+                   str(datetime.datetime.now().time())[:8], file_type, filename)
+
             if self is not None:
                 self.LogAppend.myGUI_signal_str.emit(msg)
             else:
                 print(msg)
 
-        else:
-
-            if len(EEG) != 0:
-                # then the EEG has already been loaded in
-                create_egf(egf_filename, EEG, Fs, converted_set_filename, DC_Blocker=False)
-                EEG = None
+            if file_type == 'EEG':
+                create_eeg(filename, data, Fs_EGF, converted_set_filename, DC_Blocker=False)
             else:
+                create_egf(filename, data, Fs_EGF, converted_set_filename, DC_Blocker=False)
 
-                msg = '[%s %s]: Creating the following EGF file: .egf%s!' % \
-                      (str(datetime.datetime.now().date()),
-                       str(datetime.datetime.now().time())[:8], eeg_str)
-
-                if self is not None:
-                    self.LogAppend.myGUI_signal_str.emit(msg)
-                else:
-                    print(msg)
-
-                # then the EEG hasn't been read in (EEG was already created), read the data
-                EGF = get_bin_data(bin_filename, channels=[channel])
-
-                create_egf(egf_filename, EGF, Fs, converted_set_filename, DC_Blocker=False)
-                EGF = None
-
-        EEG = None
\ No newline at end of file
+    EGF = None
@@ -1,13 +1,16 @@
 import os
 import datetime
+import functools
 from core.readBin import get_active_tetrode, get_active_eeg
-from core.tetrode_conversion import batch_basename_tetrodes
-from core.convert_position import convert_position
-from core.eeg_conversion import convert_eeg
+from core.tetrode_conversion import convert_sorted_tetrode, get_tetrode_workers, get_process_executor
 from core.utils import find_sub
 from core.bin2mda import convert_bin2mda
-from core.mdaSort import sort_bin
+from core.bin_demux import convert_bin_demux, SessionFileWriter
+from core.readBin import create_bin_cache
+from core.Tint_Matlab import get_setfile_parameter
+from core.mdaSort import get_sort_backend, get_sort_jobs, SortScheduler
 from core.set_conversion import convert_setfile
+from core.task_graph import TaskGraph
 
 
 def validate_session(directory, tint_basename, output_basename, self=None, verbose=True):
@@ -213,7 +216,8 @@ def convert_bin_mountainsort(directory, tint_basename, whiten='true', detect_int
                              detect_threshold=3, freq_min=300, freq_max=6000, mask_threshold=6,
                              masked_chunk_size=None, mask_num_write_chunks=100, clip_size=50, notch_filter=False,
                              pre_spike=15, post_spike=35, mask=True, num_features=10, max_num_clips_for_pca=1000,
-                             self=None, verbose=True):
+                             bin_cache=False, tetrode_workers=1, tetrode_memory_budget=None, sort_backend=None,
+                             sort_workers=1, sort_core_budget=None, sort_memory_budget=None, self=None, verbose=True):
 
     tint_fullpath = os.path.join(directory, tint_basename)
 
@@ -230,42 +234,102 @@ def convert_bin_mountainsort(directory, tint_basename, whiten='true', detect_int
         else:
             print(msg)
 
-    pos_filename = output_basename + '.pos'
     set_filename = tint_fullpath + '.set'
     bin_filename = tint_fullpath + '.bin'
 
     converted_set_filename = output_basename + '.set'
 
-    convert_setfile(set_filename, converted_set_filename, self=self)
-
-    # convert data to mda
-    convert_bin2mda(tint_fullpath, notch_filter=notch_filter, self=self)
-
-    # sort the mda data
-    sort_bin(directory, tint_fullpath, whiten=whiten, detect_interval=detect_interval,
-             detect_sign=detect_sign,
-             detect_threshold=detect_threshold,
-             freq_min=freq_min,
-             freq_max=freq_max,
-             mask_threshold=mask_threshold,
-             masked_chunk_size=masked_chunk_size,
-             mask_num_write_chunks=mask_num_write_chunks,
-             clip_size=clip_size,
-             mask=mask,
-             num_features=num_features,
-             max_num_clips_for_pca=max_num_clips_for_pca,
-             self=self,
-             verbose=verbose)
-
-    # create positions
-    convert_position(bin_filename, pos_filename, converted_set_filename, self=self)
-
-    # create tetrodes / cut
-    batch_basename_tetrodes(directory, tint_basename, output_basename,  pre_spike=pre_spike, post_spike=post_spike,
-                            mask=mask, self=self)
-
-    # create eeg / egf
-    convert_eeg(set_filename, output_basename, self=self)
+    # the session is run as a graph of tasks, each task starts as soon as the tasks it depends on have finished: a
+    # tetrode is exported to Tint as soon as its own sort has finished, while the others are still sorting.
+    filt_fnames = ['%s_T%d_filt.mda' % (tint_fullpath, tetrode) for tetrode in get_active_tetrode(set_filename)]
+
+    backend = get_sort_backend(sort_backend, self=self)
+
+    sort_jobs = get_sort_jobs(filt_fnames, set_filename, backend, whiten=whiten, detect_interval=detect_interval,
+                              detect_sign=detect_sign, detect_threshold=detect_threshold, freq_min=freq_min,
+                              freq_max=freq_max, mask_threshold=mask_threshold, masked_chunk_size=masked_chunk_size,
+                              mask_num_write_chunks=mask_num_write_chunks, clip_size=clip_size,
+                              mask='true' if mask else 'false', num_features=num_features,
+                              max_num_clips_for_pca=max_num_clips_for_pca, self=self)
+    sort_jobs = {job.filename: job for job in sort_jobs}
+
+    scheduler = SortScheduler(backend, max_concurrent=sort_workers, core_budget=sort_core_budget,
+                              memory_budget=sort_memory_budget, n_jobs=len(sort_jobs), verbose=verbose,
+                              main_window=self)
+
+    def get_export_limit():
+        # the firings (which determine the memory of an export) only exist once the tetrodes have been sorted
+        return get_tetrode_workers(filt_fnames, tetrode_workers, memory_budget=tetrode_memory_budget)
+
+    graph = TaskGraph(pool_limits={'export': get_export_limit}, main_window=self)
+
+    graph.add('set', functools.partial(convert_setfile, set_filename, converted_set_filename, self=self))
+
+    def create_cache():
+        # transpose the .bin file once so any channel can be read as a contiguous slice
+        msg = '[%s %s]: Creating the channel-major cache of the following bin file: %s!' % \
+              (str(datetime.datetime.now().date()),
+               str(datetime.datetime.now().time())[:8], bin_filename)
+        if self:
+            self.LogAppend.myGUI_signal_str.emit(msg)
+        else:
+            print(msg)
+
+        create_bin_cache(bin_filename, Fs=int(get_setfile_parameter('rawRate', set_filename)))
+
+    # only the notch filtered conversion reads the channels through get_bin_data (which serves them from the cache),
+    # the demux reads the packets of the .bin file directly so the cache would not be used
+    use_bin_cache = bin_cache and notch_filter
+
+    if use_bin_cache:
+        graph.add('bin_cache', create_cache)
+
+    # the .pos/.eeg/.egf files don't depend on the sorts, they are written in a background thread (once the .bin file
+    # has been read) while the tetrodes are sorted
+    session_writer = SessionFileWriter()
+
+    def convert_mda():
+        # convert the data to mda, while reading the .bin file once. The notch filter is applied to the entire
+        # recording at once so notch filtered tetrodes can't be streamed, the .bin file is still read once for the
+        # .pos/.eeg/.egf files.
+        convert_bin_demux(tint_fullpath, output_basename, tetrodes=not notch_filter, session_files=True,
+                          session_writer=session_writer, self=self)
+
+        if notch_filter:
+            convert_bin2mda(tint_fullpath, notch_filter=notch_filter, self=self)
+
+    # the converted .set file is the header of the .pos/.eeg/.egf files
+    graph.add('mda', convert_mda, dependencies=['set', 'bin_cache' if use_bin_cache else None])
+
+    graph.add('session_files', session_writer.join, dependencies=['mda'])
+
+    # the tetrodes are converted in separate processes if there are multiple workers
+    tetrode_executor = None
+    if tetrode_workers > 1:
+        tetrode_executor = get_process_executor(tetrode_workers)
+
+    for filt_filename in filt_fnames:
+        tetrode_name = os.path.basename(filt_filename)[len(tint_basename) + 1:-len('_filt.mda')]
+
+        # sort the mda data
+        sort_task = None
+        if filt_filename in sort_jobs:
+            sort_task = 'sort_%s' % tetrode_name
+            graph.add(sort_task, functools.partial(scheduler.sort, sort_jobs[filt_filename]), dependencies=['mda'])
+
+        # create tetrodes / cut
+        graph.add('export_%s' % tetrode_name,
+                  functools.partial(convert_sorted_tetrode, filt_filename, output_basename, pre_spike=pre_spike,
+                                    post_spike=post_spike, mask=mask, executor=tetrode_executor, self=self),
+                  dependencies=['set', 'mda', sort_task], pool='export')
+
+    # every task (including the background .pos/.eeg/.egf conversion) has finished before the clean up
+    try:
+        graph.run()
+    finally:
+        session_writer.executor.shutdown()
+        if tetrode_executor is not None:
+            tetrode_executor.shutdown()
 
     msg = '[%s %s]: Finished converting the following session: %s!' % \
           (str(datetime.datetime.now().date()),
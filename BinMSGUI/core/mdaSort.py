@@ -5,6 +5,18 @@ from core.Tint_Matlab import get_setfile_parameter
 from core.utils import find_sub
 import time
 import datetime
+import sys
+import signal
+import subprocess
+import threading
+import queue
+import collections
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
 
 
 def check_file_complete(filepath, delta_time=5):
@@ -66,29 +78,37 @@ def get_windows_filename(filename):
     return '%s:\\%s' % (drive_letter, remaining)
 
 
-def run_pipeline_js(pipeline, inputs, outputs, parameters=None, verbose=False, terminal_text_filename=None):
+def get_pipeline_args(pipeline, inputs, outputs, parameters=None):
+    """returns the ml-run-process command of the pipeline as a list of arguments (nothing is quoted)"""
 
-    command = 'ml-run-process %s ' % (pipeline)
+    args = ['ml-run-process', pipeline]
 
-    command += '--inputs '
+    args.append('--inputs')
 
     for key, value in inputs.items():
         if type(value) != list:
-            command += '%s:%s ' % (str(key), str(value))
+            args.append('%s:%s' % (str(key), str(value)))
         else:
             for x in value:
-                command += '%s:%s ' % (str(key), str(x))
+                args.append('%s:%s' % (str(key), str(x)))
 
-    command += '--outputs '
+    args.append('--outputs')
 
     for key, value in outputs.items():
-        command += '%s:%s ' % (str(key), str(value))
+        args.append('%s:%s' % (str(key), str(value)))
 
     if parameters is not None:
-        command += '--parameters '
+        args.append('--parameters')
 
         for key, value in parameters.items():
-            command += '%s:%s ' % (str(key), str(value))
+            args.append('%s:%s' % (str(key), str(value)))
+
+    return args
+
+
+def run_pipeline_js(pipeline, inputs, outputs, parameters=None, verbose=False, terminal_text_filename=None):
+
+    command = '%s ' % ' '.join(get_pipeline_args(pipeline, inputs, outputs, parameters=parameters))
 
     if terminal_text_filename is not None:
         # this will output the terminal text to the given filename
@@ -115,6 +135,241 @@ def run_pipeline_js(pipeline, inputs, outputs, parameters=None, verbose=False, t
             'sleep 2'], profile)
 
 
+class WSLSortProcess:
+    """A sort that was started in a WSL terminal, the only output is the terminal text file (see sort_finished)."""
+
+    def __init__(self, terminal_text_filename):
+        self.terminal_text_filename = terminal_text_filename
+
+    def wait(self, max_time=600, callback=None):
+        """waits for the sort to finish, returning (finished, sort_code) where sort_code is Complete/Retry/Abort,
+        callback (optional) is called with each SortEvent"""
+        return sort_finished(self.terminal_text_filename, max_time=max_time, callback=callback)
+
+
+class WSLBackend:
+    """
+    Runs the MountainSort pipelines within the Windows Subsystem for Linux. The command is written to a bash script
+    that is opened in a new terminal, with the output redirected to the terminal text file.
+    """
+    name = 'wsl'
+
+    # the bash scripts are named by the second they were created (see BashConfigure), so two sorts must not be
+    # started within the same second
+    min_start_interval = 1.0
+
+    def __init__(self, main_window=None):
+        self.main_window = main_window
+        self.last_start = None
+
+    def get_path(self, filepath):
+        """the path of the file as the pipeline sees it"""
+        return get_ubuntu_path(filepath)
+
+    def start(self, pipeline, inputs, outputs, parameters=None, terminal_text_filename=None, verbose=False):
+        """starts the pipeline (the inputs/outputs must already be converted with get_path)"""
+        if self.last_start is not None:
+            time.sleep(max(0, self.min_start_interval - (time.time() - self.last_start)))
+        self.last_start = time.time()
+
+        run_pipeline_js(pipeline, inputs, outputs, parameters, verbose=verbose,
+                        terminal_text_filename=self.get_path(terminal_text_filename))
+
+        return WSLSortProcess(terminal_text_filename)
+
+
+# the CPU time of the reaped child processes is only known for all of them (RUSAGE_CHILDREN), so the sorts are
+# reaped one at a time to know which sort the CPU time belongs to
+_reap_lock = threading.Lock()
+
+
+def wait_child_cpu_time(process):
+    """
+    Waits for the Popen process to exit, returning its exit code and CPU time (user + system, including the processes
+    it waited on), the CPU time is None where it can't be measured (i.e. Windows).
+    """
+    if resource is None or not hasattr(os, 'waitid'):
+        return process.wait(), None
+
+    # wait for the process to exit without reaping it, Popen still reaps it (and sets its returncode) below
+    try:
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    except ChildProcessError:
+        # it was already reaped by Popen
+        return process.wait(), None
+
+    with _reap_lock:
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        returncode = process.wait()
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return returncode, (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+
+class NativeSortProcess:
+    """
+    A sort that is running as a child process. The output is appended to the terminal text file as it is written
+    (the parsed SortEvents are what gets logged, see sort_event_logger), and the sort is finished when the process
+    exits. On POSIX the sort is started in its own session so that a stalled sort can be terminated along with the
+    processors it started.
+    """
+
+    def __init__(self, args, terminal_text_filename=None):
+        self.args = args
+        self.terminal_text_filename = terminal_text_filename
+        self.parser = SortOutputParser()
+        self.events = queue.Queue()  # the SortEvents from the output thread
+
+        self.start_time = time.time()
+        self.wall_time = None
+        self.cpu_time = None  # the CPU time (user + system) of the sort, once it has exited (not on Windows)
+
+        self.last_output = time.time()  # the time the last line was written
+
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        universal_newlines=True, bufsize=1, start_new_session=os.name == 'posix')
+
+        self.output_thread = threading.Thread(target=self._read_output, daemon=True)
+        self.output_thread.start()
+
+    def _read_output(self):
+        f = None
+        if self.terminal_text_filename is not None:
+            f = open(self.terminal_text_filename, 'a')
+
+        try:
+            for line in self.process.stdout:
+                self.last_output = time.time()
+
+                if f is not None:
+                    f.write(line)
+                    f.flush()
+
+                for event in self.parser.feed(line):
+                    self.events.put(event)
+        finally:
+            if f is not None:
+                f.close()
+
+            self.events.put(None)  # the output has ended
+
+    @property
+    def stage(self):
+        return self.parser.stage
+
+    def terminate(self, timeout=10):
+        """terminates the sort (and the processes it started), killing it if it doesn't exit within timeout seconds"""
+        if self.process.poll() is not None:
+            return
+
+        try:
+            if os.name == 'posix':
+                os.killpg(self.process.pid, signal.SIGTERM)
+            else:
+                self.process.terminate()
+
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            if os.name == 'posix':
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except ProcessLookupError:
+            # it has already exited
+            pass
+
+        self.process.wait()
+
+    def wait(self, max_time=600, callback=None):
+        """
+        waits for the sort to exit, returning (finished, sort_code) where sort_code is Complete, Retry or Abort,
+        callback (optional) is called with each SortEvent. The exit code decides the result, unless the sort stalls
+        (nothing is written for max_time seconds, None for no limit) as with the WSL backend, then it is terminated
+        and Retry is returned.
+        """
+        while True:
+            timeout = None
+            if max_time is not None:
+                timeout = max(0, max_time - (time.time() - self.last_output))
+
+            try:
+                event = self.events.get(timeout=timeout)
+            except queue.Empty:
+                if time.time() - self.last_output < max_time:
+                    continue
+
+                self.terminate()
+                self.output_thread.join()
+                self.wall_time = time.time() - self.start_time
+
+                if callback is not None:
+                    callback(SortEvent('stalled', self.stage, ''))
+
+                return False, 'Retry'
+
+            if event is None:
+                # the output has ended
+                break
+
+            if callback is not None:
+                callback(event)
+
+        returncode, self.cpu_time = wait_child_cpu_time(self.process)
+        self.wall_time = time.time() - self.start_time
+        self.output_thread.join()
+
+        if returncode == 0:
+            return True, 'Complete'
+
+        return False, 'Abort'
+
+
+class NativeBackend:
+    """
+    Runs the MountainSort pipelines by launching ml-run-process directly (i.e. on Linux), the arguments are given as
+    a list so the paths do not need any quoting.
+    """
+    name = 'native'
+
+    def __init__(self, main_window=None):
+        self.main_window = main_window
+
+    def get_path(self, filepath):
+        """the path of the file as the pipeline sees it"""
+        return filepath
+
+    def start(self, pipeline, inputs, outputs, parameters=None, terminal_text_filename=None, verbose=False):
+        """starts the pipeline (the inputs/outputs must already be converted with get_path)"""
+        args = get_pipeline_args(pipeline, inputs, outputs, parameters=parameters)
+
+        if verbose:
+            print(' '.join(args))
+
+        return NativeSortProcess(args, terminal_text_filename=terminal_text_filename)
+
+
+sort_backends = {'wsl': WSLBackend, 'native': NativeBackend}
+
+
+def get_sort_backend(backend=None, self=None):
+    """
+    Returns the backend that will run the sorts: 'wsl' (Windows Subsystem for Linux) or 'native' (ml-run-process is
+    launched directly). If backend is None, WSL is used on Windows and native otherwise.
+    """
+
+    if backend is None:
+        backend = 'wsl' if sys.platform[:3] == 'win' else 'native'
+
+    if not isinstance(backend, str):
+        # already a backend
+        return backend
+
+    if backend not in sort_backends:
+        raise ValueError('Unknown sort backend: %s, expected one of: %s' % (backend, ', '.join(sort_backends)))
+
+    return sort_backends[backend](main_window=self)
+
+
 def run_sort(*, raw_fname=None, filt_fname=None, pre_fname=None, geom_fname=None, params_fname=None,
              firings_out, filt_out_fname=None, pre_out_fname=None, metrics_out_fname=None, masked_out_fname=None,
              freq_min=300, freq_max=7000, samplerate=30000, detect_sign=1,
@@ -123,7 +378,7 @@ def run_sort(*, raw_fname=None, filt_fname=None, pre_fname=None, geom_fname=None
              peak_snr_thresh=1.5, mask_artifacts='true', whiten='true',
              mask_threshold=6, mask_chunk_size=2000, terminal_text_filename=None,
              mask_num_write_chunks=15, num_features=10, max_num_clips_for_pca=1000,
-             num_workers=os.cpu_count(), verbose=True):
+             num_workers=os.cpu_count(), backend=None, verbose=True):
     """
     Custom Sorting Pipeline. It will pre-process, sort, and curate (using ms_taggedcuration pipeline).
 
@@ -189,6 +444,13 @@ def run_sort(*, raw_fname=None, filt_fname=None, pre_fname=None, geom_fname=None
         (Optional) Number of simultaneous workers (or processes). The default is multiprocessing.cpu_count().
     terminal_text_filename: str
         (Optional) if you want to output the command prompt values to a text file, set this value to a filename you want it saved to.
+    backend : object
+        (Optional) the backend that runs the pipeline (see get_sort_backend), the paths must be as the backend sees
+        them (see backend.get_path) except for terminal_text_filename.
+
+    Returns
+    -------
+    process : the sort that was started, process.wait() returns (finished, sort_code) once it is finished.
     """
 
     # the name of the pipeline we will be using
@@ -248,132 +510,518 @@ def run_sort(*, raw_fname=None, filt_fname=None, pre_fname=None, geom_fname=None
                   'max_num_clips_for_pca': max_num_clips_for_pca,
                   }
 
-    run_pipeline_js(pipeline, inputs, outputs, parameters, verbose=verbose,
-                    terminal_text_filename=terminal_text_filename)
+    backend = get_sort_backend(backend)
 
+    return backend.start(pipeline, inputs, outputs, parameters, terminal_text_filename=terminal_text_filename,
+                         verbose=verbose)
 
-def sort_finished(terminal_output_filename, max_time=600):
-    # wait for the terminal output to exist
 
-    # max_time = max time in seconds to wait
+# the structured events of a sort: event is started, stage, stalled, complete or error, stage is the current stage
+# (the last [ ... ] status line of ml-run-process) and text the line that caused the event
+SortEvent = collections.namedtuple('SortEvent', ['event', 'stage', 'text'])
 
-    start_time = time.time()
-    while not os.path.exists(terminal_output_filename):
-        # this is for those odd times where you are the text file never is created due to some odd error. Usually
-        # is fixed by pressing enter on the terminal, but this should automate it.
-        if time.time() - start_time >= max_time:
-            # we've waited long enough for the file to sort.
-            return False, "Retry"
-        time.sleep(0.1)
+
+class SortOutputParser:
+    """
+    A state machine of the ml-run-process output, it is given the output one line at a time and keeps track of the
+    current stage and whether the sort has completed (a process cache hit, or saving to the process cache) or
+    returned an error (a non-zero exit code).
+    """
 
     sort_invalid_string = ['Process returned with non-zero exit code']
 
-    already_analyzed_string = '%s%s%s' % ('[ Checking process cache ... ]\n',
-                                          '[ Process ms4_geoff.sort already completed. ]\n',
-                                          '[ Done. ]\n')
+    already_analyzed_lines = ['[ Checking process cache ... ]\n',
+                              '[ Process ms4_geoff.sort already completed. ]\n',
+                              '[ Done. ]\n']
+
+    finished_lines = ['[ Saving to process cache ... ]\n',
+                      '[ Removing temporary directory ... ]\n',
+                      '[ Done. ]\n']
 
-    finished_string = '%s%s%s' % ('[ Saving to process cache ... ]\n',
-                                  '[ Removing temporary directory ... ]\n',
-                                  '[ Done. ]\n')
+    def __init__(self):
+        self.stage = None
+        self.finished = False
+        self.error = False
+        self.last_lines = []  # the last complete lines, to find the completion sequences
 
-    finished = False
+    def _ends_with(self, lines):
+        if len(self.last_lines) < len(lines):
+            return False
 
-    prev_last_line = ''
+        last_lines = self.last_lines[-len(lines):]
 
-    file_error = False
+        # the first line of the sequence may follow other text on the same line
+        return last_lines[0].endswith(lines[0]) and last_lines[1:] == lines[1:]
+
+    def feed(self, line):
+        """parses the next (complete) line of the output, returning a list of the events (see SortEvent)"""
+        events = []
+
+        self.last_lines = (self.last_lines + [line])[-3:]
+
+        text = line.strip()
+        if text.startswith('[') and text.endswith(']') and text != '[ Done. ]':
+            stage = text[1:-1].strip()
+            if stage != self.stage:
+                self.stage = stage
+                events.append(SortEvent('stage', self.stage, line))
+
+        for invalid_str in self.sort_invalid_string:
+            if invalid_str in line and not self.error:
+                self.error = True
+                events.append(SortEvent('error', self.stage, line))
+
+        if not self.finished and (self._ends_with(self.already_analyzed_lines) or
+                                  self._ends_with(self.finished_lines)):
+            self.finished = True
+            events.append(SortEvent('complete', self.stage, line))
+
+        return events
+
+
+class SortMonitor:
+    """
+    Follows the terminal text file of a sort (like tail -f), only the text that was appended since the last read is
+    parsed (see SortOutputParser). Between reads it sleeps, doubling the delay (up to max_delay) while nothing is
+    written. The sort has stalled if the file isn't created, or nothing is written, for max_time seconds.
+
+    Example:
+        monitor = SortMonitor(terminal_text_filename)
+        for event in monitor.events():
+            print(event.event, event.stage)
+        finished, sort_code = monitor.result
+    """
+
+    def __init__(self, terminal_output_filename, max_time=600, min_delay=0.05, max_delay=1.0):
+        self.filename = terminal_output_filename
+        self.max_time = max_time
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+        self.parser = SortOutputParser()
+        self.offset = 0  # the number of bytes that have been read
+        self.partial_line = b''  # the end of the file that isn't a complete line yet
+        self.started = False
+        self.file_error = False
+        self.stalled = False
+
+        self.last_update = time.time()
+
+    @property
+    def stage(self):
+        return self.parser.stage
+
+    @property
+    def done(self):
+        return self.stalled or self.parser.error or self.parser.finished
+
+    @property
+    def result(self):
+        """(finished, sort_code), the sort_code is Complete, Retry (stalled) or Abort (error), None if not done"""
+        if self.parser.error:
+            return False, 'Abort'
+        elif self.parser.finished:
+            return True, 'Complete'
+        elif self.stalled:
+            return False, 'Retry'
+        return False, None
+
+    def _stall(self):
+        self.stalled = True
+        return [SortEvent('stalled', self.stage, '')]
+
+    def poll(self):
+        """reads any new output once, returning the list of events (see SortEvent)"""
+        events = []
+
+        if self.done:
+            return events
 
-    while not finished:
         try:
-            with open(terminal_output_filename, 'r') as f:
-                data = f.readlines()
-                output_text = ''.join(data)  # want to make sure that the output is in text not a list
-                last_line = data[-1]
-
-                # we will update the next step, if the next step
-                # hangs for the max time it will restart
-                if last_line != prev_last_line:
-                    next_step_time = time.time()
-                    prev_last_line = last_line
-
-                if time.time() - next_step_time >= max_time:
-                    # we've waited long enough for the file to sort.
-                    return False, "Retry"
+            with open(self.filename, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
         except PermissionError:
-            continue
+            data = b''
         except FileNotFoundError:
-            if not file_error:
-                time.sleep(0.1)
-                file_error = True
-                continue
-            else:
-                return False, "Retry"
-        except IndexError:
-            continue
+            if not self.started:
+                # this is for those odd times where the text file is never created due to some odd error. Usually
+                # is fixed by pressing enter on the terminal, but this should automate it.
+                if time.time() - self.last_update >= self.max_time:
+                    return self._stall()
+                return events
 
-        if already_analyzed_string in output_text:
-            finished = True
+            if not self.file_error:
+                # the file was removed, give it one more read
+                self.file_error = True
+                return events
 
-        if finished_string in output_text:
-            finished = True
+            return self._stall()
 
-        # check if the sort was broken.
-        for invalid_str in sort_invalid_string:
-            if invalid_str in output_text:
-                return False, 'Abort'
+        if not self.started:
+            self.started = True
+            self.last_update = time.time()
+            events.append(SortEvent('started', self.stage, ''))
 
-    return True, 'Complete'
+        if len(data) == 0:
+            # we will update the next step, if the next step hangs for the max time it will restart
+            if time.time() - self.last_update >= self.max_time:
+                events.extend(self._stall())
+            return events
 
+        self.offset += len(data)
+        self.last_update = time.time()
 
-def sort_bin(directory, tint_fullpath, whiten='true', detect_interval=10, detect_sign=0, detect_threshold=3,
-             freq_min=300, freq_max=6000, mask_threshold=6, masked_chunk_size=None, mask_num_write_chunks=100,
-             clip_size=50, mask=True, num_features=10, max_num_clips_for_pca=1000, self=None, verbose=True):
+        lines = (self.partial_line + data).split(b'\n')
+        self.partial_line = lines.pop()
 
-    if mask:
-        mask = 'true'
-    else:
-        mask = 'false'
+        for line in lines:
+            line = (line + b'\n').decode('utf-8', errors='replace').replace('\r\n', '\n')
+            events.extend(self.parser.feed(line))
 
-    tint_basename = os.path.basename(tint_fullpath)
+        return events
 
-    set_filename = '%s.set' % tint_fullpath
+    def events(self):
+        """yields the events of the sort as they happen, until it has completed, returned an error, or stalled"""
+        delay = self.min_delay
 
-    filt_fnames = [os.path.join(directory, file) for file in os.listdir(
-        directory) if '_filt.mda' in file if tint_basename in file]
+        while True:
+            events = self.poll()
 
-    for file in filt_fnames:
+            for event in events:
+                yield event
+
+            if self.done:
+                return
+
+            # back off while nothing is happening
+            delay = self.min_delay if len(events) > 0 else min(delay * 2, self.max_delay)
+            time.sleep(delay)
 
-        msg = '[%s %s]: Sorting the following file: %s!' % \
-              (str(datetime.datetime.now().date()),
-               str(datetime.datetime.now().time())[:8], file)
+
+def sort_finished(terminal_output_filename, max_time=600, callback=None):
+    """
+    Waits for the sort that is writing to the terminal output file to finish (see SortMonitor), returning
+    (finished, sort_code) where sort_code is Complete, Retry (if it stalled for max_time seconds), or Abort.
+
+    callback (optional) is called with every SortEvent.
+    """
+
+    monitor = SortMonitor(terminal_output_filename, max_time=max_time)
+
+    for event in monitor.events():
+        if callback is not None:
+            callback(event)
+
+    return monitor.result
+
+
+def sort_event_logger(filename, verbose=True, self=None):
+    """
+    returns a callback for the SortEvents of a sort, the stages are logged if verbose and stalls are always logged.
+    Only these parsed events are logged, the raw output of the sort is only written to its terminal text file.
+    """
+
+    def log_event(event):
+        if event.event == 'stalled':
+            msg = '[%s %s]: The sort of the following file has stalled, retrying: %s!#Red' % \
+                  (str(datetime.datetime.now().date()),
+                   str(datetime.datetime.now().time())[:8], filename)
+        elif event.event == 'stage' and verbose:
+            msg = '[%s %s]: %s: %s' % \
+                  (str(datetime.datetime.now().date()),
+                   str(datetime.datetime.now().time())[:8], os.path.basename(filename), event.stage)
+        else:
+            return
 
         if self:
             self.LogAppend.myGUI_signal_str.emit(msg)
         else:
             print(msg)
 
+    return log_event
+
+
+class SortJob:
+    """
+    The sort of a single tetrode (_filt.mda file), run (with its retries) by a SortScheduler. memory is the estimate
+    of the RAM the sort will need (see get_sort_memory), None to estimate it once the sort is about to start (i.e. if
+    the _filt.mda file hasn't been created yet).
+    """
+
+    def __init__(self, filename, terminal_text_filename, sort_kwargs, memory=None):
+        self.filename = filename
+        self.terminal_text_filename = terminal_text_filename
+        self.sort_kwargs = sort_kwargs
+        self.memory = memory
+        self.num_workers = None
+
+
+def get_sort_memory(filt_filename, memory_factor=5):
+    """
+    Estimates the RAM a sort of the _filt.mda file will need. The int16 filtered data is converted to float32 and the
+    sort holds the pre-processed (whitened) and masked copies, so roughly memory_factor times the size of the file.
+    """
+    return memory_factor * os.path.getsize(filt_filename)
+
+
+class SortScheduler:
+    """
+    Runs the sorts of several tetrodes at a time. At most max_concurrent sorts are running, the num_workers of the
+    sorts are taken from a core budget, and a sort is only started if the estimated RAM of the running sorts
+    (see get_sort_memory) fits within the memory budget (one sort is always allowed to run).
+
+    Each sort gets at most an even share of the core budget. Once a sort has finished (on the native backend, where
+    the CPU time of the process is known) the next sorts are given the cores the previous sorts actually used, plus
+    one (still capped at the even share), so that sorts that could not use their share leave the cores to the others.
+    Sorts shorter than min_tune_time seconds (i.e. process cache hits) barely use any cores and are not counted.
+
+    Every sort keeps the retry logic of a single sort: a stalled sort is restarted (up to 5 attempts), and a sort
+    that returned an error is aborted (and logged).
+    """
+
+    max_sort_attempts = 5
+    min_tune_time = 5  # seconds
+
+    def __init__(self, backend, max_concurrent=1, core_budget=None, memory_budget=None, n_jobs=0, verbose=True,
+                 main_window=None):
+        self.backend = backend
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.core_budget = max(1, int(core_budget)) if core_budget is not None else os.cpu_count()
+        self.memory_budget = memory_budget
+        self.verbose = verbose
+        self.main_window = main_window
+
+        self.cpu_usage = []  # the average number of cores each finished sort used
+        self.start_lock = threading.Lock()
+
+        # the state of the sorts started with sort (see below)
+        self.condition = threading.Condition()
+        self.running = []
+        self.pending_jobs = n_jobs  # the number of jobs that will be given to sort, but haven't started yet
+
+    def log(self, msg):
+        if self.main_window:
+            self.main_window.LogAppend.myGUI_signal_str.emit(msg)
+        else:
+            print(msg)
+
+    def get_num_workers(self, running, remaining):
+        """the num_workers of the next sort, given the running jobs and the number of jobs (including it) left"""
+        free_cores = self.core_budget - sum(job.num_workers for job in running)
+        if free_cores < 1:
+            return None
+
+        if self.max_concurrent == 1:
+            # a single sort at a time gets all of the cores
+            return free_cores
+
+        # each sort gets at most an even share of the cores, so the running sorts never over-subscribe them
+        share = max(1, self.core_budget // min(self.max_concurrent, len(running) + remaining))
+
+        if len(self.cpu_usage) > 0:
+            # sorts that could not use their share leave the cores idle, only give them what they used
+            share = min(share, int(np.ceil(np.mean(self.cpu_usage))) + 1)
+
+        return max(1, min(share, free_cores))
+
+    def can_start(self, job, running):
+        if len(running) >= self.max_concurrent:
+            return False
+
+        if self.memory_budget is None:
+            return True
+
+        if job.memory is None:
+            job.memory = get_sort_memory(job.filename)
+
+        if len(running) == 0:
+            return True
+
+        return sum(running_job.memory for running_job in running) + job.memory <= self.memory_budget
+
+    def run_job(self, job):
+        """sorts the file of the job, retrying if the sort stalls"""
+        sorting = True
+        sorting_attempts = 0
+
+        msg = '[%s %s]: Sorting the following file: %s!' % \
+              (str(datetime.datetime.now().date()),
+               str(datetime.datetime.now().time())[:8], job.filename)
+        self.log(msg)
+
+        if os.path.exists(job.terminal_text_filename):
+            os.remove(job.terminal_text_filename)
+
+        while sorting:
+
+            # the WSL backend names the bash scripts by the time, so the sorts are started one at a time
+            with self.start_lock:
+                process = run_sort(num_workers=job.num_workers,
+                                   terminal_text_filename=job.terminal_text_filename,
+                                   backend=self.backend,
+                                   verbose=self.verbose,
+                                   **job.sort_kwargs)
+
+            # wait for the sort to finish before continuing
+            finished, sort_code = process.wait(callback=sort_event_logger(job.filename, verbose=self.verbose,
+                                                                          self=self.main_window))
+
+            cpu_time = getattr(process, 'cpu_time', None)
+            wall_time = getattr(process, 'wall_time', None)
+            if finished and cpu_time is not None and wall_time and wall_time >= self.min_tune_time:
+                self.cpu_usage.append(cpu_time / wall_time)
+
+            if sorting_attempts >= self.max_sort_attempts:
+                # we've tried to sort a bunch of times, doesn't seem to work
+                sorting = False
+
+            elif 'Abort' in sort_code:
+                # there's a problem with the sort,
+                sorting = False
+                msg = '[%s %s]: There was an error sorting the following file, consult terminal text file: %s!#Red' % \
+                      (str(datetime.datetime.now().date()),
+                       str(datetime.datetime.now().time())[:8], job.sort_kwargs['filt_fname'])
+
+                self.log(msg)
+
+            elif not finished:
+                os.remove(job.terminal_text_filename)
+                sorting_attempts += 1
+
+            else:
+                sorting = False
+
+    def _run_job_thread(self, job, finished_jobs):
+        try:
+            self.run_job(job)
+            finished_jobs.put((job, None))
+        except BaseException as e:
+            finished_jobs.put((job, e))
+
+    def sort(self, job):
+        """
+        Runs the sort of a single job once the budgets allow it, this is for sorts that are started from separate
+        threads (i.e. the tasks of a TaskGraph). Create the scheduler with n_jobs (the number of jobs that will be
+        sorted) so the cores are shared evenly from the start.
+        """
+        with self.condition:
+            while True:
+                num_workers = None
+                if self.can_start(job, self.running):
+                    num_workers = self.get_num_workers(self.running, max(1, self.pending_jobs))
+
+                if num_workers is not None:
+                    break
+
+                self.condition.wait()
+
+            job.num_workers = num_workers
+            self.running.append(job)
+            self.pending_jobs = max(0, self.pending_jobs - 1)
+
+        if self.verbose and self.max_concurrent > 1:
+            msg = '[%s %s]: Starting the sort of the following file with %d workers: %s!' % \
+                  (str(datetime.datetime.now().date()),
+                   str(datetime.datetime.now().time())[:8], num_workers, job.filename)
+            self.log(msg)
+
+        try:
+            self.run_job(job)
+        finally:
+            with self.condition:
+                self.running.remove(job)
+                self.condition.notify_all()
+
+    def run(self, jobs):
+        """runs all of the jobs, if any of the sorts raised an exception no more sorts are started and the first
+        exception is raised once the running sorts have finished"""
+        pending = list(jobs)
+        running = []
+        finished_jobs = queue.Queue()
+        error = None
+
+        if self.max_concurrent == 1:
+            # no need for any threads
+            for job in pending:
+                job.num_workers = self.get_num_workers(running, 1)
+                self.run_job(job)
+            return
+
+        while len(pending) > 0 or len(running) > 0:
+
+            while error is None and len(pending) > 0 and self.can_start(pending[0], running):
+                num_workers = self.get_num_workers(running, len(pending))
+                if num_workers is None:
+                    break
+
+                job = pending.pop(0)
+                job.num_workers = num_workers
+
+                if self.verbose:
+                    msg = '[%s %s]: Starting the sort of the following file with %d workers: %s!' % \
+                          (str(datetime.datetime.now().date()),
+                           str(datetime.datetime.now().time())[:8], num_workers, job.filename)
+                    self.log(msg)
+
+                running.append(job)
+                threading.Thread(target=self._run_job_thread, args=(job, finished_jobs), daemon=True).start()
+
+            if len(running) == 0:
+                # an error stopped the remaining sorts
+                break
+
+            job, job_error = finished_jobs.get()
+            running.remove(job)
+
+            if job_error is not None and error is None:
+                error = job_error
+
+                msg = '[%s %s]: The following error occurred sorting %s, no more sorts will be started: %s!#Red' % \
+                      (str(datetime.datetime.now().date()),
+                       str(datetime.datetime.now().time())[:8], job.filename, str(job_error))
+                self.log(msg)
+
+        if error is not None:
+            raise error
+
+
+def get_sort_jobs(filt_fnames, set_filename, backend, whiten='true', detect_interval=10, detect_sign=0,
+                  detect_threshold=3, freq_min=300, freq_max=6000, mask_threshold=6, masked_chunk_size=None,
+                  mask_num_write_chunks=100, clip_size=50, mask='true', num_features=10, max_num_clips_for_pca=1000,
+                  self=None):
+    """
+    Returns a SortJob for each of the _filt.mda files that haven't already been sorted (all of their outputs exist),
+    the _filt.mda files do not need to exist yet.
+    """
+
+    jobs = []
+
+    for file in filt_fnames:
+
         mda_basename = os.path.splitext(file)[0]
         mda_basename = mda_basename[:find_sub(mda_basename, '_')[-1]]
 
-        firings_out = get_ubuntu_path(mda_basename + '_firings.mda')
+        firings_out = mda_basename + '_firings.mda'
 
         if whiten == 'true':
-            pre_out_fname = get_ubuntu_path(mda_basename + '_pre.mda')
+            pre_out_fname = mda_basename + '_pre.mda'
         else:
             pre_out_fname = None
 
         if mask == 'true':
-            masked_out_fname = get_ubuntu_path(mda_basename + '_masked.mda')
+            masked_out_fname = mda_basename + '_masked.mda'
         else:
             masked_out_fname = None
 
-        metrics_out_fname = get_ubuntu_path(mda_basename + '_metrics.json')
+        metrics_out_fname = mda_basename + '_metrics.json'
 
         # check if these outputs have already been created, skip if they have
         existing_files = 0
         output_files = [masked_out_fname, firings_out, pre_out_fname, metrics_out_fname]
         for outfile in output_files:
             if outfile is not None:
-                if os.path.exists(get_windows_filename(outfile)):
+                if os.path.exists(outfile):
                     existing_files += 1
 
         if existing_files == len(output_files):
@@ -387,67 +1035,69 @@ def sort_bin(directory, tint_fullpath, whiten='true', detect_interval=10, detect
                 print(msg)
             continue
 
-        terminal_text_filename = get_ubuntu_path(mda_basename + '_terminal.txt')
-
-        filt_fname = get_ubuntu_path(file)
+        terminal_text_filename = mda_basename + '_terminal.txt'
 
         Fs = int(get_setfile_parameter('rawRate', set_filename))
 
         if masked_chunk_size is None:
             masked_chunk_size = int(Fs/20)
 
-        sorting = True
-        sorting_attempts = 0
+        sort_kwargs = {'filt_fname': backend.get_path(file),
+                       'pre_out_fname': backend.get_path(pre_out_fname),
+                       'metrics_out_fname': backend.get_path(metrics_out_fname),
+                       'firings_out': backend.get_path(firings_out),
+                       'masked_out_fname': backend.get_path(masked_out_fname),
+                       'samplerate': Fs,
+                       'detect_interval': detect_interval,
+                       'detect_sign': detect_sign,
+                       'detect_threshold': detect_threshold,
+                       'freq_min': freq_min,
+                       'freq_max': freq_max,
+                       'mask_threshold': mask_threshold,
+                       'mask_chunk_size': masked_chunk_size,
+                       'mask_num_write_chunks': mask_num_write_chunks,
+                       'whiten': whiten,
+                       'mask_artifacts': mask,
+                       'clip_size': clip_size,
+                       'num_features': num_features,
+                       'max_num_clips_for_pca': max_num_clips_for_pca}
+
+        jobs.append(SortJob(file, terminal_text_filename, sort_kwargs))
+
+    return jobs
 
-        if os.path.exists(get_windows_filename(terminal_text_filename)):
-            os.remove(get_windows_filename(terminal_text_filename))
 
-        while sorting:
+def sort_bin(directory, tint_fullpath, whiten='true', detect_interval=10, detect_sign=0, detect_threshold=3,
+             freq_min=300, freq_max=6000, mask_threshold=6, masked_chunk_size=None, mask_num_write_chunks=100,
+             clip_size=50, mask=True, num_features=10, max_num_clips_for_pca=1000, sort_backend=None,
+             sort_workers=1, sort_core_budget=None, sort_memory_budget=None, self=None, verbose=True):
+    """
+    Sorts each of the _filt.mda files of the session (skipping those that have already been sorted).
 
-            run_sort(filt_fname=filt_fname,
-                     pre_out_fname=pre_out_fname,
-                     metrics_out_fname=metrics_out_fname,
-                     firings_out=firings_out,
-                     masked_out_fname=masked_out_fname,
-                     samplerate=Fs,
-                     detect_interval=detect_interval,
-                     detect_sign=detect_sign,
-                     detect_threshold=detect_threshold,
-                     freq_min=freq_min,
-                     freq_max=freq_max,
-                     mask_threshold=mask_threshold,
-                     mask_chunk_size=masked_chunk_size,
-                     mask_num_write_chunks=mask_num_write_chunks,
-                     whiten=whiten,
-                     mask_artifacts=mask,
-                     clip_size=clip_size,
-                     num_features=num_features,
-                     max_num_clips_for_pca=max_num_clips_for_pca,
-                     terminal_text_filename=terminal_text_filename,
-                     verbose=verbose)
+    sort_workers is the number of tetrodes that are sorted at a time, the sorts share sort_core_budget cores
+    (default: all of them) and sort_memory_budget bytes of RAM (default: no limit), see SortScheduler.
+    """
 
-            # wait for the sort to finish before continuing
-            finished, sort_code = sort_finished(get_windows_filename(terminal_text_filename))
+    backend = get_sort_backend(sort_backend, self=self)
 
-            if sorting_attempts >= 5:
-                # we've tried to sort a bunch of times, doesn't seem to work
-                sorting = False
+    if mask:
+        mask = 'true'
+    else:
+        mask = 'false'
 
-            elif 'Abort' in sort_code:
-                # there's a problem with the sort,
-                sorting = False
-                msg = '[%s %s]: There was an error sorting the following file, consult terminal text file: %s!#Red' % \
-                      (str(datetime.datetime.now().date()),
-                       str(datetime.datetime.now().time())[:8], filt_fname)
+    tint_basename = os.path.basename(tint_fullpath)
+
+    set_filename = '%s.set' % tint_fullpath
 
-                if self:
-                    self.LogAppend.myGUI_signal_str.emit(msg)
-                else:
-                    print(msg)
+    filt_fnames = [os.path.join(directory, file) for file in os.listdir(
+        directory) if '_filt.mda' in file if tint_basename in file]
 
-            elif not finished:
-                os.remove(get_windows_filename(terminal_text_filename))
-                sorting_attempts += 1
+    jobs = get_sort_jobs(filt_fnames, set_filename, backend, whiten=whiten, detect_interval=detect_interval,
+                         detect_sign=detect_sign, detect_threshold=detect_threshold, freq_min=freq_min,
+                         freq_max=freq_max, mask_threshold=mask_threshold, masked_chunk_size=masked_chunk_size,
+                         mask_num_write_chunks=mask_num_write_chunks, clip_size=clip_size, mask=mask,
+                         num_features=num_features, max_num_clips_for_pca=max_num_clips_for_pca, self=self)
 
-            else:
-                sorting = False
+    scheduler = SortScheduler(backend, max_concurrent=sort_workers, core_budget=sort_core_budget,
+                              memory_budget=sort_memory_budget, verbose=verbose, main_window=self)
+    scheduler.run(jobs)
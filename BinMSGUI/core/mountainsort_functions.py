@@ -4,6 +4,7 @@ import os
 import struct
 import json
 from core.wsl_terminal import BashConfigure
+from core import cut_creation
 # from core.readMDA import readMDA
 # import datetime
 
@@ -28,34 +29,152 @@ class MSError(Error):
 
 
 def _writemda(X, fname, dt):
-    dt_code = 0
-    num_bytes_per_entry = get_num_bytes_per_entry_from_dt(dt)
-    dt_code = _dt_code_from_dt(dt)
-    if dt_code is None:
-        print("Unexpected data type: {}".format(dt))
-        return False
-
-    f = open(fname, 'wb')
-    try:
-        _write_int32(f, dt_code)
-        _write_int32(f, num_bytes_per_entry)
-        _write_int32(f, X.ndim)
-        for j in range(0, X.ndim):
-            _write_int32(f, X.shape[j])
-        # This is how I do column-major order
-        A = np.reshape(X, X.size, order='F').astype(dt)
-        A.tofile(f)
-    except Exception as e:  # catch *all* exceptions
-        print(e)
-    finally:
-        f.close()
-        return True
+    X = np.asarray(X)
+
+    if X.ndim == 0:
+        X = X.reshape((1,))
+
+    # MdaWriter raises a ValueError for an unexpected data type
+    with MdaWriter(fname, dt, X.shape[:-1], num_columns=X.shape[-1]) as writer:
+        # the last dimension is written in blocks (of ~16 MB) so that the column-major (Fortran order) copy is never
+        # the full size of the array
+        column_bytes = int(np.prod(X.shape[:-1])) * np.dtype(writer.dtype).itemsize
+        block_size = max(1, int(16 * 1024 * 1024 / max(1, column_bytes)))
+
+        for start in range(0, X.shape[-1], block_size):
+            writer.write(X[..., start:start + block_size])
+
+    return True
+
+
+class MdaWriter:
+    """
+    Writes an .mda file one block of columns at a time, so arbitrarily long recordings can be written with constant
+    memory. The header is written when the file is opened and the final dimension is fixed when it is closed. If an
+    error occurs within the with statement the partially written file is removed and the error is raised.
+
+    The data is written to fname.part, which only replaces fname once it is closed, so an interrupted write (i.e. the
+    process was killed) never leaves an incomplete fname behind that would be mistaken for a finished file.
+
+    Example:
+        with MdaWriter(mda_filename, 'int16', (4,)) as writer:
+            for chunk in iter_bin_chunks(bin_filename, tetrode=1):
+                writer.write(chunk)  # (4, n) blocks
+
+    Args:
+        fname (str): the filename of the .mda file
+        dt (str): the data type that will be stored, i.e. 'int16'
+        shape (tuple): the dimensions of the blocks besides the last (growing) dimension, i.e. (n_channels,)
+        num_columns (int): (optional) the expected length of the last dimension, used for the header that is written
+            before any of the data.
+        dim64 (bool): (optional) if True the dimensions are stored as 64 bit integers. By default this is decided
+            from num_columns, so num_columns (or dim64=True) must be given for files with more than 2^31 - 1 columns.
+    """
+
+    def __init__(self, fname, dt, shape, num_columns=0, dim64=None):
+        dt_code = _dt_code_from_dt(dt)
+        if dt_code is None:
+            raise ValueError("Unexpected data type: {}".format(dt))
+
+        self.fname = fname
+        self.dt = dt
+        self.dtype = get_np_dt_from_code(dt_code)
+        self.shape = tuple(int(dim) for dim in shape)
+        self.num_columns = 0
+
+        self.partial_fname = fname + '.part'
+
+        self.f = open(self.partial_fname, 'wb')
+        self.dim64 = _write_mda_header(self.f, dt, self.shape + (int(num_columns),), dim64=dim64)
+
+        # the position of the last dimension in the header so that it can be fixed on close
+        self.header_size = self.f.tell()
+        self.last_dim_offset = self.header_size - (8 if self.dim64 else 4)
+
+    def write(self, X):
+        """writes a block of columns, X.shape[:-1] must match the shape given to the writer"""
+        X = np.asarray(X)
+
+        if X.shape[:-1] != self.shape:
+            raise ValueError('Expected blocks with the leading dimensions %s, got an array of shape %s' % (
+                str(self.shape), str(X.shape)))
+
+        if not self.dim64 and self.num_columns + X.shape[-1] > max_int32_dim:
+            raise ValueError('The .mda header of %s only has room for 32 bit dimensions, provide num_columns or '
+                             'dim64=True when creating the MdaWriter!' % self.fname)
+
+        # column-major order, if the block is already Fortran ordered and of the correct type this won't copy
+        np.asfortranarray(X, dtype=self.dtype).T.tofile(self.f)
+
+        self.num_columns += X.shape[-1]
+
+    def close(self):
+        if self.f.closed:
+            return
+
+        try:
+            self.f.seek(self.last_dim_offset)
+            if self.dim64:
+                _write_int64(self.f, self.num_columns)
+            else:
+                _write_int32(self.f, self.num_columns)
+        except BaseException:
+            self.abort()
+            raise
+
+        self.f.close()
+        os.replace(self.partial_fname, self.fname)
+
+    def abort(self):
+        """closes the file and removes it, used when the file could not be fully written"""
+        self.f.close()
+        if os.path.exists(self.partial_fname):
+            os.remove(self.partial_fname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# the largest dimension that can be stored in the (default) 32 bit .mda header
+max_int32_dim = 2 ** 31 - 1
+
+
+def _write_mda_header(f, dt, shape, dim64=None):
+    """writes the .mda header (data type code, bytes per entry, number of dimensions and each dimension). The
+    dimensions are written as 64 bit integers (flagged by a negative number of dimensions) if dim64 is True, or if
+    dim64 is None and any of the dimensions are too large for 32 bits. Returns True if 64 bit dimensions were used."""
+    if dim64 is None:
+        dim64 = any(dim > max_int32_dim for dim in shape)
+
+    _write_int32(f, _dt_code_from_dt(dt))
+    _write_int32(f, get_num_bytes_per_entry_from_dt(dt))
+
+    if dim64:
+        _write_int32(f, -len(shape))
+        for dim in shape:
+            _write_int64(f, dim)
+    else:
+        _write_int32(f, len(shape))
+        for dim in shape:
+            _write_int32(f, dim)
+
+    return dim64
 
 
 def _write_int32(f, val):
     f.write(struct.pack('<i', val))
 
 
+def _write_int64(f, val):
+    f.write(struct.pack('<q', val))
+
+
 def get_num_bytes_per_entry_from_dt(dt):
     if dt == 'uint8':
         return 1
@@ -681,86 +800,11 @@ def get_mua_cells(metrics_filename):
 
 def get_tint_cut(cut, mua_cells):
     """This will make it so that the good cells are consecutive and in the beginning of the cut file, and the
-    MUA (noise + cells that just didn't meet our criteria), will be in the back, separated by an emtpy cell.
-    It will also sort the mua cells from most least to most spikes."""
-    from operator import itemgetter
-
-    mua_cells = np.asarray(mua_cells)
-
-    cut_dict = {0: 0}  # cut_value, new_consecutive_cut_value
-
-    # for the curated the cut values might not be consecutive numbers, lets turn these values
-    # into consecutive numbers
-
-    if 0 in cut:
-        add_one = 0
-    else:
-        add_one = 1
-
-    cells = np.setdiff1d(np.unique(cut), mua_cells)
-
-    i = 0  # initialize i, if all the cells are mua, it will skip the next for loop and i will not be initialized
-    for i, cut_value in enumerate(np.unique(cells)):
-        if cut_value == 0:
-            continue
-
-        cut_dict[cut_value] = i + add_one  # +1 because we already have zero
-
-    i_offset = i + 1 + 1  # +1 for the gap as well as incrementing +1 from what we have already done above
-
-    count_dict = {}
-    for cut_value in mua_cells:
-        count_dict[cut_value] = sum(cut.flatten() == cut_value)
-
-    for i, cut_value in enumerate(sorted(count_dict.items(), key=lambda x: x[1])):
-        cut_value = cut_value[0]
-        if cut_value == 0:
-            continue
-
-        cut_dict[cut_value] = i + i_offset + add_one  # +1 because we already have zero
-
-    return itemgetter(*list(cut))(cut_dict), cut_dict
+    MUA (noise + cells that just didn't meet our criteria), will be in the back, separated by an emtpy cell
+    (see cut_creation.get_tint_cut, here the gap is left even if all the cells are MUA)."""
+    return cut_creation.get_tint_cut(cut, mua_cells, always_gap=True)
 
 
 def write_cut(cut_filename, cut, basename=None):
-    if basename is None:
-        basename = os.path.basename(os.path.splitext(cut_filename)[0])
-
-    unique_cells = np.unique(cut)
-
-    if 0 not in unique_cells:
-        # if it happens that there is no zero cell, add it anyways
-        unique_cells = np.insert(unique_cells, 0, 0)  # object, index, value to insert
-
-    n_clusters = len(np.unique(cut))
-    n_spikes = len(cut)
-
-    write_list = []  # the list of values to write
-
-    tab = '    '  # the spaces didn't line up with my tab so I just created a string with enough spaces
-    empty_space = '               '  # some of the empty spaces don't line up to x tabs
-
-    # we add 1 to n_clusters because zero is the garbage cell that no one uses
-    write_list.append('n_clusters: %d\n' % (n_clusters))
-    write_list.append('n_channels: 4\n')
-    write_list.append('n_params: 2\n')
-    write_list.append('times_used_in_Vt:%s' % ((tab + '0') * 4 + '\n'))
-
-    zero_string = (tab + '0') * 8 + '\n'
-
-    for cell_i in np.arange(n_clusters):
-        write_list.append(' cluster: %d center:%s' % (cell_i, zero_string))
-        write_list.append('%smin:%s' % (empty_space, zero_string))
-        write_list.append('%smax:%s' % (empty_space, zero_string))
-    write_list.append('\nExact_cut_for: %s spikes: %d\n' % (basename, n_spikes))
-
-    # now the cut file lists 25 values per row
-    n_rows = int(np.floor(n_spikes / 25))  # number of full rows
-
-    remaining = int(n_spikes - n_rows * 25)
-    cut_string = ('%3u' * 25 + '\n') * n_rows + '%3u' * remaining
-
-    write_list.append(cut_string % (tuple(cut)))
-
-    with open(cut_filename, 'w') as f:
-        f.writelines(write_list)
+    """see cut_creation.write_cut"""
+    cut_creation.write_cut(cut_filename, cut, basename=basename)
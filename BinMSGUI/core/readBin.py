@@ -1,4 +1,5 @@
 import os
+import json
 import numpy as np
 import contextlib
 import mmap
@@ -60,70 +61,294 @@ def get_active_eeg(set_filename):
     return active_eeg_dict
 
 
-def get_bin_data(bin_filename, channels=None, tetrode=None):
+bytes_per_packet = 432
+samples_per_packet = 3  # each packet holds 3 samples of all 64 channels
+
+# the layout of a single 432 byte .bin packet: a 32 byte header (the 'ADU2' id, the video timestamp and the 8
+# position words), 3 samples of the 64 channels, and a 16 byte trailer
+packet_dtype = np.dtype([('id', 'S4'),
+                         ('unused', 'V8'),
+                         ('timestamp', '<i4'),
+                         ('position', '<i2', (8,)),
+                         ('samples', '<i2', (samples_per_packet, 64)),
+                         ('trailer', 'V16')])
+
+default_chunk_packets = 48000  # 3 seconds worth of packets (packets are acquired at 16 kHz)
+
+
+def get_bin_data(bin_filename, channels=None, tetrode=None, chunk_packets=default_chunk_packets, channel_map=None):
     """This function will be used to acquire the actual lfp data given the .bin filename,
-    and the tetrode or channels (from 1-64) that you want to get"""
+    and the tetrode or channels (from 1-64) that you want to get. The data is returned as a
+    (channels, samples) int16 array. A ChannelMap can be given for headstages with a different wiring.
+
+    If a fresh channel-major cache of the .bin file exists (see create_bin_cache) the data will be read
+    from the cache instead of the .bin file."""
 
     if tetrode is not None:
         channels = get_channel_from_tetrode(tetrode)
-    else:
-        channels = np.array(channels)  # just in case it isn't an np.array
+    elif channels is None:
+        channels = np.arange(64) + 1
 
-    bytes_per_iteration = 432
+    channels = np.asarray(channels).tolist()  # just in case it isn't a list
 
-    with open(bin_filename, 'rb') as f:
-        # pass
-        with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
-            num_iterations = int(len(m)/bytes_per_iteration)
+    cache = get_bin_cache(bin_filename, channel_map=channel_map)
+    if cache is not None:
+        # each channel is a contiguous row of the cache
+        return np.asarray(cache[np.asarray(channels) - 1, :])
+
+    n_packets = int(os.path.getsize(bin_filename) / bytes_per_packet)
+
+    data = np.zeros((len(channels), n_packets * samples_per_packet), dtype=np.int16)
 
-            data = np.ndarray((num_iterations,), (np.int16, (1,192)), m, 32, (bytes_per_iteration,)).reshape((-1, 1)).flatten()
-            data = samples_to_array(data, channels=channels.tolist())
+    sample_offset = 0
+    for chunk in iter_bin_chunks(bin_filename, channels=channels, chunk_packets=chunk_packets,
+                                 channel_map=channel_map):
+        data[:, sample_offset:sample_offset + chunk.shape[1]] = chunk
+        sample_offset += chunk.shape[1]
 
     return data
 
 
-def samples_to_array(A, channels=[]):
+def get_bin_cache_filenames(bin_filename):
+    """returns the filenames of the channel-major cache of a .bin file, and its .json header"""
+    cache_filename = '%s.chan' % os.path.splitext(bin_filename)[0]
+
+    return cache_filename, cache_filename + '.json'
+
+
+def create_bin_cache(bin_filename, Fs=48000, chunk_packets=default_chunk_packets, channel_map=None):
+    """
+    This will transpose the .bin file once into a channel-major int16 file (the .chan file) next to the session,
+    where each of the (re-mapped) channels is stored contiguously. A small .json header is written with the
+    re-mapping, sampling rate, packet count, and the size/modification time of the .bin file so that stale caches
+    can be detected. The cache is opt-in, once it exists get_bin_data will read from it.
+
+    Args:
+        bin_filename (str): the fullpath of the .bin file
+        Fs (int): the sampling rate of the .bin file
+        chunk_packets (int): the number of packets to transpose at a time.
+        channel_map (ChannelMap): the channel re-mapping, defaults to the Axona re-mapping.
+
+    Returns:
+        cache_filename (str): the filename of the channel-major cache
+    """
+
+    if channel_map is None:
+        channel_map = axona_channel_map
+
+    cache_filename, header_filename = get_bin_cache_filenames(bin_filename)
+
+    if get_bin_cache(bin_filename, channel_map=channel_map) is not None:
+        return cache_filename
+
+    # the header is written last, so remove any stale header before the cache is re-written
+    if os.path.exists(header_filename):
+        os.remove(header_filename)
+
+    n_packets = int(os.path.getsize(bin_filename) / bytes_per_packet)
+    n_channels = channel_map.n_channels
+
+    cache = np.memmap(cache_filename, dtype=np.int16, mode='w+',
+                      shape=(n_channels, n_packets * samples_per_packet))
+
+    sample_offset = 0
+    for chunk in iter_bin_chunks(bin_filename, channels=np.arange(n_channels) + 1, chunk_packets=chunk_packets,
+                                 channel_map=channel_map):
+        cache[:, sample_offset:sample_offset + chunk.shape[1]] = chunk
+        sample_offset += chunk.shape[1]
+
+    cache.flush()
+    cache = None
+
+    header = {'remap': channel_map.remap.tolist(),
+              'Fs': int(Fs),
+              'num_packets': n_packets,
+              'num_channels': n_channels,
+              'dtype': 'int16',
+              'bin_size': os.path.getsize(bin_filename),
+              'bin_mtime': os.path.getmtime(bin_filename)}
+
+    with open(header_filename, 'w') as f:
+        json.dump(header, f)
+
+    return cache_filename
+
+
+def get_bin_cache(bin_filename, channel_map=None):
+    """This will return the channel-major cache of the .bin file as a read-only (channels, samples) int16 memmap,
+    or None if the cache does not exist or is stale (the .bin file has changed since the cache was created)."""
+
+    if channel_map is None:
+        channel_map = axona_channel_map
+
+    cache_filename, header_filename = get_bin_cache_filenames(bin_filename)
+
+    if not os.path.exists(cache_filename) or not os.path.exists(header_filename):
+        return None
+
+    try:
+        with open(header_filename, 'r') as f:
+            header = json.load(f)
+    except ValueError:
+        return None
+
+    if header['bin_size'] != os.path.getsize(bin_filename) or header['bin_mtime'] != os.path.getmtime(bin_filename):
+        return None
+
+    if header['remap'] != channel_map.remap.tolist():
+        return None
+
+    shape = (header['num_channels'], header['num_packets'] * samples_per_packet)
+
+    if os.path.getsize(cache_filename) != shape[0] * shape[1] * np.dtype(header['dtype']).itemsize:
+        return None
+
+    return np.memmap(cache_filename, dtype=header['dtype'], mode='r', shape=shape)
+
+
+def iter_bin_packets(bin_filename, chunk_packets=default_chunk_packets):
+    """This generator will memory map the .bin file and yield (packet_offset, packets) for every chunk_packets
+    packets, where packets is a view (see packet_dtype) of the packets within the chunk and packet_offset is the
+    index of the first packet in the chunk. Only the current chunk needs to be paged into memory."""
+
+    n_packets = int(os.path.getsize(bin_filename) / bytes_per_packet)
+
+    if n_packets == 0:
+        return
+
+    packets = np.memmap(bin_filename, dtype=packet_dtype, mode='r', shape=(n_packets,))
+
+    for packet_offset in range(0, n_packets, chunk_packets):
+        yield packet_offset, packets[packet_offset:packet_offset + chunk_packets]
+
+
+def iter_bin_chunks(bin_filename, channels=None, tetrode=None, chunk_packets=default_chunk_packets,
+                    channel_map=None):
+    """This generator will yield the data of the given tetrode or channels (from 1-64) as (channels, samples)
+    int16 arrays, chunk_packets packets (3 samples per packet) at a time. The memory used is set by the chunk
+    size instead of the length of the recording. A fresh channel-major cache will be used if it exists."""
+
+    if tetrode is not None:
+        channels = get_channel_from_tetrode(tetrode)
+    elif channels is None:
+        channels = np.arange(64) + 1
+
+    channels = np.asarray(channels).tolist()
+
+    cache = get_bin_cache(bin_filename, channel_map=channel_map)
+    if cache is not None:
+        rows = np.asarray(channels) - 1
+        chunk_samples = chunk_packets * samples_per_packet
+        for sample_offset in range(0, cache.shape[1], chunk_samples):
+            yield np.asarray(cache[rows, sample_offset:sample_offset + chunk_samples])
+        return
+
+    for _, packets in iter_bin_packets(bin_filename, chunk_packets=chunk_packets):
+        yield packets_to_array(packets, channels, channel_map=channel_map)
+
+
+def packets_to_array(packets, channels, channel_map=None):
+    """This will take the packets (see packet_dtype) and return the re-mapped data of the given channels
+    (from 1-64) as a (channels, samples) int16 array"""
+
+    if channel_map is None:
+        channel_map = axona_channel_map
+
+    # (packets, 3, 64) -> (packets, 3 * 64), this is still a view of the packets
+    samples = packets['samples'].reshape((len(packets), -1))
+
+    return channel_map.extract(samples, channels)
+
+
+def samples_to_array(A, channels=[], channel_map=None):
     """This will take data matrix A, and convert it into a numpy array, there are three samples of
     64 channels in this matrix, however their channels do need to be re-mapped"""
 
-    if channels == []:
-        channels = np.arange(64) + 1
-    else:
-        channels = np.asarray(channels)
+    if channel_map is None:
+        channel_map = axona_channel_map
+
+    if len(channels) == 0:
+        channels = np.arange(channel_map.n_channels) + 1
 
     A = np.asarray(A)
 
-    sample_num = int(len(A) / 64)  # get the sample numbers
+    # each row will contain one sample of every channel
+    return channel_map.extract(A.reshape((-1, channel_map.n_channels)), channels, samples_per_row=1)
 
-    sample_array = np.zeros((len(channels), sample_num))  # creating a 64x3 array of zeros (64 channels, 3 samples)
 
-    for i, channel in enumerate(channels):
-        sample_array[i, :] = A[get_sample_indices(channel, sample_num)]
+def get_sample_indices(channel_number, samples):
+    return np.arange(samples) * 64 + get_remap_chan(channel_number)
 
-    return sample_array
 
+# the packets store the channels in a different order, axona_remap[chan_num - 1] is where the channel is stored
+axona_remap = np.array([32, 33, 34, 35, 36, 37, 38, 39, 0, 1, 2, 3, 4, 5,
+                        6, 7, 40, 41, 42, 43, 44, 45, 46, 47, 8, 9, 10, 11,
+                        12, 13, 14, 15, 48, 49, 50, 51, 52, 53, 54, 55, 16, 17,
+                        18, 19, 20, 21, 22, 23, 56, 57, 58, 59, 60, 61, 62, 63,
+                        24, 25, 26, 27, 28, 29, 30, 31])
 
-def get_sample_indices(channel_number, samples):
-    remap_channel = get_remap_chan(channel_number)
 
-    indices_scalar = np.multiply(np.arange(samples), 64)
-    sample_indices = indices_scalar + np.multiply(np.ones(samples), remap_channel)
+class ChannelMap:
+    """
+    The re-mapping between the channel numbers (from 1-64) and the order that the channels are stored within a
+    packet. The indices of a set of channels are computed once and cached, so repeatedly extracting the same
+    channels (i.e. every chunk of a .bin file) has no re-mapping cost.
+
+    Example:
+        channel_map = ChannelMap()  # the default Axona wiring
+        data = channel_map.extract(samples, [1, 2, 3, 4])
+
+    Args:
+        remap (ndarray): remap[chan_num - 1] is the index the channel is stored at within each sample of the packet,
+            defaults to the Axona re-mapping (axona_remap). Other headstage wirings can provide their own table.
+    """
+
+    def __init__(self, remap=None):
+        if remap is None:
+            remap = axona_remap
+
+        remap = np.asarray(remap, dtype=np.intp)
+
+        if not np.array_equal(np.sort(remap), np.arange(len(remap))):
+            raise ValueError('The remap table must contain each of the packet channels exactly once!')
+
+        self.remap = remap
+        self.n_channels = len(remap)
+
+        self._indices = {}
+
+    def get_indices(self, channels, samples_per_row=samples_per_packet):
+        """returns the (cached) indices of the given channels (from 1-64) within a row of samples_per_row samples,
+        ordered sample by sample"""
+        key = (tuple(int(channel) for channel in channels), samples_per_row)
+
+        indices = self._indices.get(key)
+        if indices is None:
+            columns = self.remap[np.asarray(key[0], dtype=np.intp) - 1]
+            indices = (np.arange(samples_per_row).reshape((-1, 1)) * self.n_channels + columns).flatten()
+            self._indices[key] = indices
+
+        return indices
+
+    def extract(self, samples, channels, samples_per_row=samples_per_packet):
+        """
+        This will take a 2-D (rows, samples_per_row * n_channels) int16 array (or view) of the samples and return
+        the given channels (from 1-64) as a (channels, samples) array, keeping the data type of the samples.
+        """
+        indices = self.get_indices(channels, samples_per_row=samples_per_row)
 
-    # return np.array([remap_channel, 64 + remap_channel, 64*2 + remap_channel])
-    return (indices_scalar + np.multiply(np.ones(samples), remap_channel)).astype(int)
+        # one gather for all of the channels: (rows, samples_per_row * channels) -> (samples, channels)
+        return samples[:, indices].reshape((-1, len(channels))).T
+
+
+axona_channel_map = ChannelMap()
 
 
 def get_remap_chan(chan_num):
     """There is re-mapping, thus to get the correct channel data, you need to incorporate re-mapping
     input will be a channel from 1 to 64, and will return the remapped channel"""
 
-    remap_channels = np.array([32, 33, 34, 35, 36, 37, 38, 39, 0, 1, 2, 3, 4, 5,
-                               6, 7, 40, 41, 42, 43, 44, 45, 46, 47, 8, 9, 10, 11,
-                               12, 13, 14, 15, 48, 49, 50, 51, 52, 53, 54, 55, 16, 17,
-                               18, 19, 20, 21, 22, 23, 56, 57, 58, 59, 60, 61, 62, 63,
-                               24, 25, 26, 27, 28, 29, 30, 31])
-
-    return remap_channels[chan_num - 1]
+    return axona_remap[chan_num - 1]
 
 
 def get_channel_from_tetrode(tetrode):
@@ -134,7 +359,7 @@ def get_channel_from_tetrode(tetrode):
     return np.arange(1, 5) + 4 * (tetrode - 1)
 
 
-def get_raw_pos(bin_filename, mode='mmap'):
+def get_raw_pos(bin_filename, mode='mmap', chunk_packets=1000000):
     """This will get the raw position data from the .bin file in the following format:
     video timestamp, x1, y1, x2, y2, numpix1, numpix2, total_pix, unused value
 
@@ -147,7 +372,8 @@ def get_raw_pos(bin_filename, mode='mmap'):
     A packet only has a valid position if it has an "ADU2" tag in the header. You'll notice that
     the positions are sampled at twice the normal rate to avoid aliasing.
 
-    There are two modes, one will use memory mapping, and the other will not: 'mmap' or 'non'
+    There are two modes, one will use memory mapping, and the other will not: 'mmap' or 'non'. The 'non' mode
+    reads chunk_packets packets at a time.
     """
     # pos_sample_num = 0
 
@@ -156,22 +382,6 @@ def get_raw_pos(bin_filename, mode='mmap'):
     iteration_count = int(byte_count / bytes_per_iteration)
     # sample_count = iteration_count * 192  # each iteration has 192 samples (64*3)
 
-    optimal_iteration = 1000000
-    if optimal_iteration >= iteration_count:
-        simul_iterations = iteration_count
-    else:
-        simul_iterations = find_n(iteration_count, optimal=optimal_iteration)
-
-    n = int(iteration_count / simul_iterations)  # finds how many loops to do
-    byte_chunksize = int(simul_iterations * bytes_per_iteration)
-
-    DaqFs = 48000
-    duration = iteration_count * 3 / DaqFs
-    duration = np.ceil(duration)
-
-    pos_Fs = 50
-    n_samples = int(duration * pos_Fs)
-
     # Reading the Data
 
     # header_byte_len = 32
@@ -212,10 +422,16 @@ def get_raw_pos(bin_filename, mode='mmap'):
 
             # in some cases using memory mapping will be slow, such as using 32 bit python
 
-            iteration_start = 0
-            # we will iterate
-            for i in range(n):
-                data = f.read(byte_chunksize)
+            # the positions are sampled at 100 Hz (double sampled) and the packets at 16 kHz, allocate for the
+            # expected number of positions and grow the array (doubling) if there are more
+            raw_pos = np.zeros((int(iteration_count / 160) + 1, 10), dtype=float)
+            n_positions = 0
+
+            # we will iterate, reading chunk_packets at a time (the last chunk has the remaining packets)
+            for iteration_start in range(0, iteration_count, chunk_packets):
+                simul_iterations = min(chunk_packets, iteration_count - iteration_start)
+
+                data = f.read(int(simul_iterations * bytes_per_iteration))
                 num_iterations = int(len(data) / bytes_per_iteration)
 
                 byte_ids = np.ndarray((num_iterations,), 'S4', data, 0, 432)
@@ -233,73 +449,74 @@ def get_raw_pos(bin_filename, mode='mmap'):
                 i = np.add(valid_iterations,
                            iteration_start)  # offsetting the samples depending on the chunk number (n)
 
-                positions = np.hstack((i.reshape((-1, 1)), time_stamp, positions)).astype(
-                    float)  # stacking all these values to create one matrix
-
-                iteration_start += simul_iterations
+                n_chunk = len(i)
+                if n_positions + n_chunk > raw_pos.shape[0]:
+                    raw_pos = np.vstack((raw_pos, np.zeros((max(raw_pos.shape[0], n_chunk), 10), dtype=float)))
 
-                if len(raw_pos) != 0:
+                # filling in all these values to create one matrix
+                raw_pos[n_positions:n_positions + n_chunk, 0] = i
+                raw_pos[n_positions:n_positions + n_chunk, 1] = time_stamp.flatten()
+                raw_pos[n_positions:n_positions + n_chunk, 2:] = positions
 
-                    raw_pos = np.vstack((raw_pos, positions))
+                n_positions += n_chunk
 
-                else:
+            raw_pos = raw_pos[:n_positions, :]
 
-                    raw_pos = positions
+    return format_raw_pos(raw_pos, iteration_count)
 
-        # raw_pos[:, 1] = np.divide(raw_pos[:, 1], 50)  # converting from a frame count to a time value in seconds
 
-        # raw_pos is structured as: packet #, video timestamp, y1, x1, y2, x2, numpix1, numpix2, total_pix, unused value
+def format_raw_pos(raw_pos, iteration_count):
+    """This will take the raw ADU2 packet rows (packet #, video timestamp, 8 position words) and convert them
+    into the 50 Hz position samples that the .pos file expects (see get_raw_pos for the output format)."""
 
-        # the X and Y values are reverse piece-wise so lets switch the format from
-        # packet #, video timestamp, y1, x1, y2, x2, numpix1, numpix2, total_pix, unused value
-        # to
-        # packet #, video timestamp, x1, y1, x2, y2, numpix1, numpix2, total_pix, unused value
-
-        raw_pos[:, 2:6] = raw_pos[:, [3, 2, 5, 4]]
+    DaqFs = 48000
+    duration = iteration_count * 3 / DaqFs
+    duration = np.ceil(duration)
 
-        # find the first valid sample, since the data is sampled at 48kHz, and there are 3 samples per packet, the packet
-        # rate is 16kHz. The positions are sampled at 50 Hz thus there is a valid position ever 320 packets. The valid position
-        # will essentially take the last ADU2 headered packet values
+    pos_Fs = 50
+    n_samples = int(duration * pos_Fs)
 
-        first_sample_index = len(
-            np.where(raw_pos[:, 0] <= 320 - 1)[0]) - 1  # subtract one since indices in python start at 0
+    # raw_pos[:, 1] = np.divide(raw_pos[:, 1], 50)  # converting from a frame count to a time value in seconds
 
-        raw_pos = raw_pos[first_sample_index:, :]
+    # raw_pos is structured as: packet #, video timestamp, y1, x1, y2, x2, numpix1, numpix2, total_pix, unused value
 
-        # there should be twice the number of samples since they double sampled to stop aliasing
-        # if there is not 2 * n_samples, append the last recorded sample to the end (we will assume the animal remained there
-        # for the rest of the time)
+    # the X and Y values are reverse piece-wise so lets switch the format from
+    # packet #, video timestamp, y1, x1, y2, x2, numpix1, numpix2, total_pix, unused value
+    # to
+    # packet #, video timestamp, x1, y1, x2, y2, numpix1, numpix2, total_pix, unused value
 
-        if raw_pos.shape[0] < 2 * n_samples:
-            missing_n = int(2 * n_samples - raw_pos.shape[0])
-            last_location = raw_pos[-1, :]
-            missing_samples = np.tile(last_location, (missing_n, 1))
+    raw_pos[:, 2:6] = raw_pos[:, [3, 2, 5, 4]]
 
-            raw_pos = np.vstack((raw_pos, missing_samples))
+    # find the first valid sample, since the data is sampled at 48kHz, and there are 3 samples per packet, the packet
+    # rate is 16kHz. The positions are sampled at 50 Hz thus there is a valid position ever 320 packets. The valid position
+    # will essentially take the last ADU2 headered packet values
 
-        # now we will set the oversampled data to 1023 (NaN) as that is how the converter treats the double sampled data
+    first_sample_index = len(
+        np.where(raw_pos[:, 0] <= 320 - 1)[0]) - 1  # subtract one since indices in python start at 0
 
-        # indices = np.arange(1,raw_pos.shape[0], 2)
-        indices = np.arange(0, raw_pos.shape[0], 2)
-        if indices[-1] >= raw_pos.shape[0]:
-            indices = indices[:-1]
+    raw_pos = raw_pos[first_sample_index:, :]
 
-        # raw_pos[indices, 2:4] = 1023
-        raw_pos = raw_pos[indices, :]
+    # there should be twice the number of samples since they double sampled to stop aliasing
+    # if there is not 2 * n_samples, append the last recorded sample to the end (we will assume the animal remained there
+    # for the rest of the time)
 
-        raw_pos = raw_pos[:, 1:]  # don't need the packet index anymore
+    if raw_pos.shape[0] < 2 * n_samples:
+        missing_n = int(2 * n_samples - raw_pos.shape[0])
+        last_location = raw_pos[-1, :]
+        missing_samples = np.tile(last_location, (missing_n, 1))
 
-    return raw_pos
+        raw_pos = np.vstack((raw_pos, missing_samples))
 
+    # now we will set the oversampled data to 1023 (NaN) as that is how the converter treats the double sampled data
 
-def find_n(iterations, optimal=1000):
-    n = optimal
+    # indices = np.arange(1,raw_pos.shape[0], 2)
+    indices = np.arange(0, raw_pos.shape[0], 2)
+    if indices[-1] >= raw_pos.shape[0]:
+        indices = indices[:-1]
 
-    while True:
-        if iterations % n == 0:
+    # raw_pos[indices, 2:4] = 1023
+    raw_pos = raw_pos[indices, :]
 
-            return n
-        else:
-            n -= 1
-    return 'abort'
+    raw_pos = raw_pos[:, 1:]  # don't need the packet index anymore
 
+    return raw_pos
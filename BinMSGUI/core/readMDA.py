@@ -3,77 +3,92 @@ import struct, os
 import core.intan_rhd_functions as f_intan
 
 
-def readMDA(filename):
+# the numpy data type (little endian) for each of the .mda data type codes
+mda_dtypes = {-1: '<c8',  # complex float
+              -2: '<u1',  # uint8
+              -3: '<f4',  # float, float32
+              -4: '<i2',  # short, int16
+              -5: '<i4',  # int, int32
+              -6: '<u2',  # uint16
+              -7: '<f8',  # double, float64
+              -8: '<u4',  # uint32
+              }
+
+
+def read_mda_header(f):
+    """
+    This function will read the header of an opened .mda file.
+
+    Returns:
+        code (int): the data type code of the file
+        shape (tuple): the dimensions of the data
+        offset (int): the number of bytes before the data begins
+    """
+
+    code = struct.unpack('<l', f.read(4))[0]
+
+    if code > 0:
+        num_dims = code
+        code = -1
+    else:
+        _ = struct.unpack('<l', f.read(4))[0]
+        num_dims = struct.unpack('<l', f.read(4))[0]
+
+    if num_dims < 0:
+        # a negative number of dimensions means that the dimensions are stored as 64 bit integers
+        num_dims = -num_dims
+        shape = tuple(struct.unpack('<q', f.read(8))[0] for _ in range(num_dims))
+    else:
+        shape = tuple(struct.unpack('<l', f.read(4))[0] for _ in range(num_dims))
+
+    return code, shape, f.tell()
+
+
+def readMDA(filename, mmap=False):
     """
     This function will read in the .mda file that MountainSort uses.
+
+    Args:
+        filename (str): the fullpath of the .mda file
+        mmap (bool): if True, the data will be returned as a read-only np.memmap (in the data type stored within the
+            file, and in Fortran order) instead of being read into memory. Slicing the memmap will only read the
+            requested channels/samples, i.e. data[:, start:stop].
+
+    Returns:
+        A (ndarray): the data
+        code (int): the data type code of the file
     """
 
     with open(filename, 'rb') as f:
 
-        code = struct.unpack('<l', f.read(4))[0]
-
-        if code > 0:
-            num_dims = code
-            code = -1
-        else:
-            _ = struct.unpack('<l', f.read(4))[0]
-            num_dims = struct.unpack('<l', f.read(4))[0]
-
-        S = np.zeros((1, num_dims))
-
-        for j in np.arange(num_dims):
-            S[0, j] = struct.unpack('<l', f.read(4))[0]
-
-        N = int(np.prod(S))  # number of spikes
-
-        # A = np.zeros((int(S[0, 0]), int(S[0, 1])))
-        A = np.zeros(tuple(S.flatten().astype(int)))
-
-        if code == -1:
-            # complex float
-            M = np.zeros((1, N * 2))
-            # there are N*2 samples, and 4 bytes per float
-            M[0, :] = np.asarray(struct.unpack('<%df' % (N * 2), f.read(N * 2 * 4)))
-            A = (M[0, 0:N * 2:2] + 1j * M[0, 1:N * 2:2]).reshape(
-                A.shape, order='F')
-        elif code == -2:
-            # uint8
-            A[0, :] = np.asarray(struct.unpack('<%dB' % (N), f.read(N)))
-        elif code == -3:
-            # float, float32
-            A = np.asarray(
-                struct.unpack('<%df' % (N), f.read(N * 4))).reshape(
-                A.shape, order='F')  # 4 bytes per float
-        elif code == -4:
-            # short, int16
-            A = np.asarray(
-                struct.unpack('<%dh' % (N), f.read(N * 2))).reshape(
-                A.shape, order='F')  # 2 bytes per short
-        elif code == -5:
-            # int, int32
-            A = np.asarray(
-                struct.unpack('<%di' % (N), f.read(N * 4))).reshape(
-                A.shape, order='F')  # 2 bytes per int
-        elif code == -6:
-            # uint16
-            A = np.asarray(
-                struct.unpack('<%dH' % (N), f.read(N * 2))).reshape(
-                A.shape, order='F')  # 2 bytes per uint16
-        elif code == -7:
-            # double, float64
-            # B = struct.unpack('<%dd' % (N), f.read(N*8))
-            A = np.asarray(
-                struct.unpack('<%dd' % (N), f.read(N * 8))).reshape(
-                A.shape, order='F')  # 8 bytes per double
-        elif code == -8:
-            # uint32
-            A = np.asarray(
-                struct.unpack('<%dI' % (N), f.read(N * 4))).reshape(
-                A.shape, order='F')  # 4 bytes per uint32
-        else:
+        code, shape, offset = read_mda_header(f)
+
+        if code not in mda_dtypes:
             print('Have not coded for this case yet!')
             return
 
+        dtype = np.dtype(mda_dtypes[code])
+
+        # python integers so that the number of values (and byte offsets) can't overflow
+        N = int(np.prod(shape, dtype=np.int64))
+
+        if mmap:
+            if N == 0:
+                # an empty file can't be memory mapped, it is returned in the same data type/order as a memmap
+                return np.zeros(shape, dtype=dtype, order='F'), code
+
+            return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape, order='F'), code
+
+        A = np.fromfile(f, dtype=dtype, count=N).reshape(shape, order='F')
+
+    # the values have previously been returned in the default (64 bit) data types
+    if dtype.kind == 'c':
+        A = A.astype(complex)
+    elif dtype.kind == 'f':
+        A = A.astype(float)
+    else:
+        A = A.astype(int)
+
     return A, code
 
 
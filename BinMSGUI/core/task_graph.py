@@ -0,0 +1,163 @@
+import datetime
+import threading
+import queue
+
+
+class Task:
+    """
+    A step of a TaskGraph, function is called (without arguments) once all of the tasks named in dependencies have
+    finished. Tasks of the same pool share the limit of the pool (the number of them that can run at once, or a
+    function returning it if it changes as the tasks run).
+    """
+
+    def __init__(self, name, function, dependencies=(), pool=None):
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.pool = pool
+        self.state = 'pending'  # pending, running, done, failed or skipped
+        self.error = None
+
+
+class TaskGraph:
+    """
+    Runs a set of tasks that depend on each other, each task is started (in its own thread) as soon as the tasks it
+    depends on have finished, so independent steps overlap (i.e. a tetrode is exported as soon as its sort finishes
+    while the other tetrodes are still sorting).
+
+    If a task raises an exception, the tasks that depend on it are skipped while the other tasks continue, and the
+    first exception is raised once every task has either finished or been skipped.
+
+    Example:
+        graph = TaskGraph(pool_limits={'export': 2})
+        graph.add('mda', convert)
+        graph.add('sort_T1', sort_1, dependencies=['mda'])
+        graph.add('export_T1', export_1, dependencies=['sort_T1'], pool='export')
+        graph.run()
+    """
+
+    def __init__(self, pool_limits=None, main_window=None):
+        self.tasks = {}
+        self.pool_limits = pool_limits if pool_limits is not None else {}
+        self.main_window = main_window
+
+    def add(self, name, function, dependencies=(), pool=None):
+        """adds a task, the dependencies are the names of tasks that must finish first (None values are ignored)"""
+        if name in self.tasks:
+            raise ValueError('There is already a task named: %s' % name)
+
+        task = Task(name, function, [dependency for dependency in dependencies if dependency is not None], pool)
+        self.tasks[name] = task
+
+        return task
+
+    def log(self, msg):
+        if self.main_window:
+            self.main_window.LogAppend.myGUI_signal_str.emit(msg)
+        else:
+            print(msg)
+
+    def validate(self):
+        """makes sure every dependency exists and that there are no cycles"""
+        for task in self.tasks.values():
+            for dependency in task.dependencies:
+                if dependency not in self.tasks:
+                    raise ValueError('The task %s depends on a task that does not exist: %s' % (task.name, dependency))
+
+        visited = {}
+
+        def visit(name):
+            if visited.get(name) == 'visiting':
+                raise ValueError('The tasks have a circular dependency: %s' % name)
+            if name in visited:
+                return
+
+            visited[name] = 'visiting'
+            for dependency in self.tasks[name].dependencies:
+                visit(dependency)
+            visited[name] = 'visited'
+
+        for name in self.tasks:
+            visit(name)
+
+    def _ready(self, task, running_pools):
+        if task.state != 'pending':
+            return False
+
+        if any(self.tasks[dependency].state != 'done' for dependency in task.dependencies):
+            return False
+
+        if task.pool is not None and task.pool in self.pool_limits:
+            limit = self.pool_limits[task.pool]
+            if callable(limit):
+                limit = limit()
+
+            # a pool can always run at least one task
+            return running_pools.get(task.pool, 0) < max(1, limit)
+
+        return True
+
+    def _skip_dependents(self, task):
+        for dependent in self.tasks.values():
+            if dependent.state == 'pending' and task.name in dependent.dependencies:
+                dependent.state = 'skipped'
+
+                msg = '[%s %s]: Skipping %s since %s did not finish!#Red' % \
+                      (str(datetime.datetime.now().date()),
+                       str(datetime.datetime.now().time())[:8], dependent.name, task.name)
+                self.log(msg)
+
+                self._skip_dependents(dependent)
+
+    def _run_task(self, task, finished_tasks):
+        try:
+            task.function()
+        except BaseException as e:
+            task.error = e
+
+        finished_tasks.put(task)
+
+    def run(self):
+        """runs all of the tasks, returning once they have all finished (raising the first error, if any)"""
+        self.validate()
+
+        finished_tasks = queue.Queue()
+        running_pools = {}
+        n_running = 0
+        error = None
+
+        while True:
+            # tasks are started in the order they were added
+            for task in self.tasks.values():
+                if self._ready(task, running_pools):
+                    task.state = 'running'
+                    running_pools[task.pool] = running_pools.get(task.pool, 0) + 1
+                    n_running += 1
+
+                    threading.Thread(target=self._run_task, args=(task, finished_tasks), daemon=True).start()
+
+            if n_running == 0:
+                break
+
+            task = finished_tasks.get()
+            running_pools[task.pool] -= 1
+            n_running -= 1
+
+            if task.error is None:
+                task.state = 'done'
+                continue
+
+            task.state = 'failed'
+
+            msg = '[%s %s]: The following error occurred in %s: %s!#Red' % \
+                  (str(datetime.datetime.now().date()),
+                   str(datetime.datetime.now().time())[:8], task.name, str(task.error))
+            self.log(msg)
+
+            if error is None:
+                error = task.error
+
+            self._skip_dependents(task)
+
+        if error is not None:
+            raise error
@@ -4,8 +4,20 @@ import os
 from core.utils import find_sub
 from core.Tint_Matlab import get_setfile_parameter
 from core.cut_creation import create_cut
-import struct
+import locale
 import datetime
+import concurrent.futures
+import multiprocessing
+
+
+def get_process_executor(max_workers):
+    """
+    A ProcessPoolExecutor for the tetrode conversions. The conversions are started from threads (the GUI thread, and
+    the tasks of a TaskGraph), and forking a process while other threads hold locks can deadlock the child, so the
+    workers are spawned instead.
+    """
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                  mp_context=multiprocessing.get_context('spawn'))
 
 
 def get_tetrode_parameters(set_filename, samples_per_spike=50, rawRate=48e3):
@@ -20,52 +32,65 @@ def get_tetrode_parameters(set_filename, samples_per_spike=50, rawRate=48e3):
     return tetrode_parameters
 
 
-def write_tetrode(filepath, spike_times, spike_data, tetrode_parameters):
-    # Note, this can be optimized instead of writing each tetrode one at a time
+def get_tetrode_record_dtype(samples_per_spike=50):
+    """The structured data type of a single channel of a spike within a Tint tetrode file: a big-endian 4 byte
+    timestamp followed by samples_per_spike 1 byte samples. Each spike is 4 of these records (t,ch1,...,t,ch4)"""
+    return np.dtype([('t', '>i4'), ('waveform', 'i1', (samples_per_spike,))])
+
+
+def get_tetrode_header(tetrode_parameters, num_spikes):
+    """returns the header of the tetrode file (up to and including data_start) as bytes"""
+    date = 'trial_date %s' % (tetrode_parameters['trial_date'])
+    time_head = '\ntrial_time %s' % (tetrode_parameters['trial_time'])
+    experimenter = '\nexperimenter %s' % (tetrode_parameters['experimenter'])
+    comments = '\ncomments %s' % (tetrode_parameters['comments'])
 
-    with open(filepath, 'w') as f:
-        date = 'trial_date %s' % (tetrode_parameters['trial_date'])
-        time_head = '\ntrial_time %s' % (tetrode_parameters['trial_time'])
-        experimenter = '\nexperimenter %s' % (tetrode_parameters['experimenter'])
-        comments = '\ncomments %s' % (tetrode_parameters['comments'])
+    duration = '\nduration %s' % (int(tetrode_parameters['duration']))
 
-        duration = '\nduration %s' % (int(tetrode_parameters['duration']))
+    sw_vers = '\nsw_version %s' % (tetrode_parameters['sw_version'])
+    num_chans = '\nnum_chans 4'
+    timebase_head = '\ntimebase %d hz' % (96000)
+    bp_timestamp = '\nbytes_per_timestamp %d' % (4)
+    # samps_per_spike = '\nsamples_per_spike %d' % (int(Fs*1e-3))
+    samps_per_spike = '\nsamples_per_spike %d' % (int(tetrode_parameters['samples_per_spike']))
+    sample_rate = '\nsample_rate %d hz' % (int(tetrode_parameters['rawRate']))
+    b_p_sample = '\nbytes_per_sample %d' % (1)
+    # b_p_sample = '\nbytes_per_sample %d' % (4)
+    spike_form = '\nspike_format t,ch1,t,ch2,t,ch3,t,ch4'
 
-        sw_vers = '\nsw_version %s' % (tetrode_parameters['sw_version'])
-        num_chans = '\nnum_chans 4'
-        timebase_head = '\ntimebase %d hz' % (96000)
-        bp_timestamp = '\nbytes_per_timestamp %d' % (4)
-        # samps_per_spike = '\nsamples_per_spike %d' % (int(Fs*1e-3))
-        samps_per_spike = '\nsamples_per_spike %d' % (int(tetrode_parameters['samples_per_spike']))
-        sample_rate = '\nsample_rate %d hz' % (int(tetrode_parameters['rawRate']))
-        b_p_sample = '\nbytes_per_sample %d' % (1)
-        # b_p_sample = '\nbytes_per_sample %d' % (4)
-        spike_form = '\nspike_format t,ch1,t,ch2,t,ch3,t,ch4'
+    num_spikes = '\nnum_spikes %d' % (num_spikes)
+    start = '\ndata_start'
 
-        num_spikes = '\nnum_spikes %d' % (spike_data.shape[1])
-        start = '\ndata_start'
+    write_order = [date, time_head, experimenter, comments, duration, sw_vers, num_chans, timebase_head,
+                   bp_timestamp,
+                   samps_per_spike, sample_rate, b_p_sample, spike_form, num_spikes, start]
 
-        write_order = [date, time_head, experimenter, comments, duration, sw_vers, num_chans, timebase_head,
-                       bp_timestamp,
-                       samps_per_spike, sample_rate, b_p_sample, spike_form, num_spikes, start]
+    # the header has always been written in text mode, keep the platform's line endings and encoding
+    header = ''.join(write_order).replace('\n', os.linesep)
 
-        f.writelines(write_order)
+    return header.encode(locale.getpreferredencoding(False))
+
+
+def get_tetrode_records(spike_times, spike_data):
+    """
+    This will create the (n spikes, n channels) structured array (see get_tetrode_record_dtype) of the spikes so
+    they can be written to the tetrode file with a single write.
+
+    Args:
+        spike_times (ndarray): the spike times in the 96000 Hz timebase (n spikes)
+        spike_data (ndarray): the int8 values of the spikes (n channels, n spikes, samples per spike)
+    """
 
-    spike_data = np.swapaxes(spike_data, 0, 1)
+    spike_data = np.asarray(spike_data)
 
-    n, n_channels, clip_size = spike_data.shape  # n spikes
+    n_channels, n, clip_size = spike_data.shape  # n spikes
 
-    # re-shaping the data so that the channels are concatenated such that
-    # the 0th dimension is n_channels * n_spikes, and the 1st dimension of the array
-    # is the clip size (samples per spike).
-    spike_data = spike_data.reshape((n_channels * n, clip_size))
+    spike_data = np.swapaxes(spike_data, 0, 1).astype(int)  # (n, n_channels, clip_size)
 
-    # when writing the spike times we write it for each channel, so lets tile
-    spike_times = np.tile(spike_times, (n_channels, 1))
-    spike_times = spike_times.flatten(order='F')
+    if spike_data.size > 0 and (spike_data.min() < -128 or spike_data.max() > 127):
+        raise ValueError('The spike data must be within the int8 range (-128 -> 127)!')
 
-    # this will create a (n_samples, n_channels, n_samples_per_spike) => (n, 4, 50) sized matrix, we will create a
-    # matrix of all the samples and channels going from ch1 -> ch4 for each spike time
+    # this will create a (n_samples, n_channels) matrix of records, with a record for each spike time/channel pair
     # time1 ch1_data
     # time1 ch2_data
     # time1 ch3_data
@@ -75,37 +100,92 @@ def write_tetrode(filepath, spike_times, spike_data, tetrode_parameters):
     # .
     # .
     # .
-    spike_array = np.hstack((spike_times.reshape(len(spike_times), 1), spike_data))
+    records = np.zeros((n, n_channels), dtype=get_tetrode_record_dtype(clip_size))
 
-    spike_times = None
-    spike_values = None
+    # when writing the spike times we write it for each channel
+    records['t'] = np.asarray(spike_times).astype(int).reshape((-1, 1))
+    records['waveform'] = spike_data
 
-    spike_n = spike_array.shape[0]
-    t_packed = struct.pack('>%di' % spike_n, *spike_array[:, 0].astype(int))
-    spike_array = spike_array[:, 1:]  # removing time data from this matrix to save memory
+    return records
 
-    spike_data_pack = struct.pack('<%db' % (spike_n * clip_size), *spike_array.astype(int).flatten())
 
-    spike_array = None
+def write_tetrode(filepath, spike_times, spike_data, tetrode_parameters):
+
+    records = get_tetrode_records(spike_times, spike_data)
 
-    # now we need to combine the lists by alternating
+    with open(filepath, 'wb') as f:
+        f.write(get_tetrode_header(tetrode_parameters, records.shape[0]))
+        records.tofile(f)
+        f.write(bytes('\r\ndata_end\r\n', 'utf-8'))
 
-    comb_list = [None] * (2 * spike_n)
-    comb_list[::2] = [t_packed[i:i + 4] for i in range(0, len(t_packed), 4)]  # breaks up t_packed into a list,
-    # each timestamp is one 4 byte integer
-    comb_list[1::2] = [spike_data_pack[i:i + 50] for i in range(0, len(spike_data_pack), 50)]  # breaks up spike_data_
-    # pack and puts it into a list, each spike is 50 one byte integers
 
-    t_packed = None
-    spike_data_pack = None
+def get_clips(data, spike_times, pre_spike=15, post_spike=35):
+    """
+    This will return the int8 valued clips (n channels, n spikes, pre_spike + post_spike) of the spikes. The data
+    can be memory mapped (see readMDA), in which case only the samples of the clips are read.
+
+    Args:
+        data (ndarray): the (n channels, n samples) int16 scaled data
+        spike_times (ndarray): the sample index of each spike
+    """
+    clip_indices = np.asarray(spike_times).reshape((-1, 1)) + np.arange(-pre_spike, post_spike)
+
+    return np.divide(data[:, clip_indices], 256).astype(int)  # converting from int16 back to int8
+
+
+def write_tetrode_clips(filepath, data, spike_times, cell_times, tetrode_parameters, pre_spike=15, post_spike=35,
+                        batch_size=10000):
+    """
+    This will write the tetrode file while extracting the clips from the data batch_size spikes at a time, so the
+    memory used does not depend on the number of spikes (or the length of the session). The batches are taken in
+    spike time order so that a memory mapped file is read sequentially, the spikes are written in the order given.
+
+    Args:
+        filepath (str): the fullpath of the tetrode file to create
+        data (ndarray): the (n channels, n samples) int16 scaled data, preferably memory mapped (see readMDA)
+        spike_times (ndarray): the sample index of each spike
+        cell_times (ndarray): the spike times in the 96000 Hz timebase that will be written to the file
+        tetrode_parameters (dict): see get_tetrode_parameters
+        batch_size (int): the number of spikes to extract at a time
+    """
 
-    write_order = []
-    with open(filepath, 'rb+') as f:
-        write_order.extend(comb_list)
-        write_order.append(bytes('\r\ndata_end\r\n', 'utf-8'))
+    spike_times = np.asarray(spike_times)
+    cell_times = np.asarray(cell_times)
 
-        f.seek(0, 2)
-        f.writelines(write_order)
+    n_channels = data.shape[0]
+    n = len(spike_times)
+
+    record_dtype = get_tetrode_record_dtype(pre_spike + post_spike)
+
+    header = get_tetrode_header(tetrode_parameters, n)
+
+    # the number of spikes is already known so the header and data_end can be written first, and the records filled
+    with open(filepath, 'wb') as f:
+        f.write(header)
+        f.seek(n * n_channels * record_dtype.itemsize, os.SEEK_CUR)
+        f.write(bytes('\r\ndata_end\r\n', 'utf-8'))
+
+    if n == 0:
+        return
+
+    records = np.memmap(filepath, dtype=record_dtype, mode='r+', offset=len(header), shape=(n, n_channels))
+
+    try:
+        order = np.argsort(spike_times, kind='stable')
+
+        for start in range(0, n, batch_size):
+            batch = order[start:start + batch_size]
+            records[batch, :] = get_tetrode_records(cell_times[batch],
+                                                    get_clips(data, spike_times[batch], pre_spike=pre_spike,
+                                                              post_spike=post_spike))
+        records.flush()
+
+    except BaseException:
+        del records
+        os.remove(filepath)
+        raise
+
+    del records
 
 
 def convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=15, post_spike=35, self=None):
@@ -191,7 +271,7 @@ def convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=15,
         else:
             self.LogAppend.myGUI_signal_str.emit(msg)
 
-        A, _ = readMDA(firings_out)
+        A, _ = readMDA(firings_out, mmap=True)
 
         # spike_channel = A[0, :].astype(int)
         spike_times = A[1, :].astype(int)  # at this stage it is in index values (0-based)
@@ -222,9 +302,9 @@ def convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=15,
         else:
             self.LogAppend.myGUI_signal_str.emit(msg)
 
-        # read in masked data
+        # read in masked data, the data is memory mapped so only the clips are read
         # data_masked, _ = readMDA(masked_out_fname)
-        data_out, _ = readMDA(data_filename)
+        data_out, _ = readMDA(data_filename, mmap=True)
 
         # get the tint spike information, placing the event at the 11th index
         clip_size = pre_spike + post_spike
@@ -245,15 +325,6 @@ def convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=15,
 
         spike_bool = None
 
-        clip_indices = np.tile(spike_times, (clip_size, 1)).T + np.arange(-pre_spike, post_spike)
-
-        # getting the clip values
-
-        # cell_data = data_masked[:, clip_indices]
-        cell_data = data_out[:, clip_indices]
-
-        # data_masked = None
-        data_out = None
         # ------------------- getting spike times --------------------------------- #
 
         Fs = int(get_setfile_parameter('rawRate', set_filename))
@@ -261,8 +332,6 @@ def convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=15,
         cell_times = (spike_times * (96000 / Fs)).astype(
             int)  # need to convert to the 96000 Hz timebase that Tint has, time occurs at the 12th value
 
-        cell_data = np.divide(cell_data, 256).astype(int)  # converting from int16 back to int8
-
         tetrode_parameters = get_tetrode_parameters(set_filename, samples_per_spike=50, rawRate=Fs)
 
         msg = '[%s %s]: Creating the following tetrode file: %s!' % (
@@ -275,7 +344,11 @@ def convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=15,
         else:
             self.LogAppend.myGUI_signal_str.emit(msg)
 
-        write_tetrode(tetrode_filepath, cell_times, cell_data, tetrode_parameters)
+        # the clips are read from the memory mapped data in batches, so the whole clip matrix is never in memory
+        write_tetrode_clips(tetrode_filepath, data_out, spike_times, cell_times, tetrode_parameters,
+                            pre_spike=pre_spike, post_spike=post_spike)
+
+        data_out = None
 
     # ------------ creating the cut file ----------------------- #
 
@@ -309,7 +382,7 @@ def convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=15,
             firings_out = mda_basename + '_firings.mda'
             # masked_out_fname = mda_basename + '_masked.mda'
 
-            A, _ = readMDA(firings_out)
+            A, _ = readMDA(firings_out, mmap=True)
 
             spike_times = (A[1, :]).astype(int)  # at this stage it is in index values (0-based)
             cell_numbers = A[2, :].astype(int)
@@ -317,9 +390,9 @@ def convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=15,
             pre_spike = 11
             post_spike = 39
 
-            # max sample index
+            # max sample index, the data is memory mapped so only the header is needed for the shape
 
-            data_out, _ = readMDA(data_filename)
+            data_out, _ = readMDA(data_filename, mmap=True)
             # data_masked, _ = readMDA(masked_out_fname)
 
             # max_n = data_masked.shape[1] - 1
@@ -333,25 +406,175 @@ def convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=15,
         create_cut(cut_filename, clu_filename, cell_numbers, tetrode, tint_basename, output_basename, self=self)
 
 
+class TetrodeLog:
+    """
+    Collects the messages of convert_tetrode when it runs in a worker process (where the GUI is not available), it
+    has the same LogAppend.myGUI_signal_str.emit interface as the GUI so it can be passed as self.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.LogAppend = self
+        self.myGUI_signal_str = self
+
+    def emit(self, msg):
+        self.messages.append(msg)
+
+
+def _convert_tetrode_worker(filt_filename, data_filename, output_basename, pre_spike, post_spike):
+    """runs convert_tetrode in a worker process, returning the messages and the error (if any) of the conversion"""
+    log = TetrodeLog()
+
+    try:
+        convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=pre_spike, post_spike=post_spike,
+                        self=log)
+        error = None
+    except Exception as e:
+        error = e
+
+    return log.messages, error
+
+
+def get_tetrode_data_filename(filt_filename, mask=True):
+    """returns the .mda file that the spikes of the tetrode are taken from (the masked data if mask is True)"""
+    if mask:
+        # previously I made it so you only have the option of using the masked data as the output
+        mda_basename = os.path.splitext(filt_filename)[0]
+        mda_basename = mda_basename[:find_sub(mda_basename, '_')[-1]]
+        return mda_basename + '_masked.mda'
+
+    # if the user decides not to use the masked value, the filtered data will be used.
+    return filt_filename
+
+
+def convert_sorted_tetrode(filt_filename, output_basename, pre_spike=15, post_spike=35, mask=True, executor=None,
+                           self=None):
+    """
+    Converts a single sorted tetrode to Tint (see convert_tetrode), a tetrode that is missing any of its files is
+    skipped as in batch_basename_tetrodes. If executor (see get_process_executor) is given the conversion is run in one
+    of its processes.
+    """
+
+    data_filename = get_tetrode_data_filename(filt_filename, mask=mask)
+
+    if executor is None:
+        try:
+            convert_tetrode(filt_filename, data_filename, output_basename, pre_spike=pre_spike, post_spike=post_spike,
+                            self=self)
+        except FileNotFoundError:
+            pass
+        return
+
+    messages, error = executor.submit(_convert_tetrode_worker, filt_filename, data_filename, output_basename,
+                                      pre_spike, post_spike).result()
+
+    for msg in messages:
+        if self is None:
+            print(msg)
+        else:
+            self.LogAppend.myGUI_signal_str.emit(msg)
+
+    if error is not None and not isinstance(error, FileNotFoundError):
+        raise error
+
+
+def get_tetrode_workers(filt_fnames, n_workers, memory_budget=None, batch_size=10000):
+    """
+    This will determine the number of tetrodes to convert at once. The memory of a single conversion is mostly
+    the firings data (read as float64 along with the spike times/cell numbers) and a batch of clips.
+
+    Args:
+        filt_fnames (list): the filtered .mda files of the tetrodes to convert
+        n_workers (int): the maximum number of worker processes
+        memory_budget (int): the memory (in bytes) that the workers can use at once, None for no limit
+    """
+
+    n_workers = max(1, min(n_workers, len(filt_fnames)))
+
+    if memory_budget is None:
+        return n_workers
+
+    task_memory = 0
+    for file in filt_fnames:
+        firings_filename = file.replace('_filt.mda', '_firings.mda')
+        firings_size = os.path.getsize(firings_filename) if os.path.exists(firings_filename) else 0
+
+        task_memory = max(task_memory, 4 * firings_size + batch_size * 4 * 50 * 8 * 4)
+
+    return max(1, min(n_workers, int(memory_budget // task_memory)))
+
+
 def batch_basename_tetrodes(directory, tint_basename, output_basename,  pre_spike=15, post_spike=35, mask=True,
-                            self=None):
+                            n_workers=1, memory_budget=None, self=None):
+    """
+    This will convert the sorted tetrodes of the session to Tint (the tetrode and cut files).
+
+    Args:
+        n_workers (int): the number of tetrodes to convert at once (in separate processes), 1 converts them in this
+            process one after the other.
+        memory_budget (int): the memory (in bytes) the conversions can use at once, this can lower the number of
+            workers, None for no limit.
+    """
 
     # find the filenames that were used by MountainSort to be sorted.
     filt_fnames = [os.path.join(directory, file) for file in os.listdir(
         directory) if '_filt.mda' in file if os.path.basename(tint_basename) in file]
 
-    for file in filt_fnames:
-        try:
-            if mask:
-                # previously I made it so you only have the option of using the masked data as the output
-                mda_basename = os.path.splitext(file)[0]
-                mda_basename = mda_basename[:find_sub(mda_basename, '_')[-1]]
-                data_filename = mda_basename + '_masked.mda'
-            else:
-                # if the user decides not to use the masked value, the filtered data will be used.
-                data_filename = file
+    data_fnames = [get_tetrode_data_filename(file, mask=mask) for file in filt_fnames]
 
-            convert_tetrode(file, data_filename, output_basename,  pre_spike=pre_spike, post_spike=post_spike,
-                            self=self)
-        except FileNotFoundError:
-            continue
+    n_workers = get_tetrode_workers(filt_fnames, n_workers, memory_budget=memory_budget)
+
+    if n_workers == 1:
+        for file, data_filename in zip(filt_fnames, data_fnames):
+            try:
+                convert_tetrode(file, data_filename, output_basename,  pre_spike=pre_spike, post_spike=post_spike,
+                                self=self)
+            except FileNotFoundError:
+                continue
+        return
+
+    msg = '[%s %s]: Converting %d tetrodes using %d processes!' % (
+        str(datetime.datetime.now().date()),
+        str(datetime.datetime.now().time())[:8], len(filt_fnames), n_workers)
+
+    if self is None:
+        print(msg)
+    else:
+        self.LogAppend.myGUI_signal_str.emit(msg)
+
+    errors = []
+    with get_process_executor(n_workers) as executor:
+        futures = {executor.submit(_convert_tetrode_worker, file, data_filename, output_basename, pre_spike,
+                                   post_spike): file for file, data_filename in zip(filt_fnames, data_fnames)}
+
+        for future in concurrent.futures.as_completed(futures):
+            if future.cancelled():
+                continue
+
+            file = futures[future]
+
+            try:
+                messages, error = future.result()
+            except Exception as e:
+                # the worker itself failed (i.e. it ran out of memory)
+                messages, error = [], e
+
+            if error is not None and not isinstance(error, FileNotFoundError):
+                if len(errors) == 0:
+                    # the error is raised once the running conversions finish, the rest are not started
+                    for pending in futures:
+                        pending.cancel()
+
+                errors.append(error)
+                messages.append('[%s %s]: The following tetrode could not be converted: %s, error: %s!#Red' % (
+                    str(datetime.datetime.now().date()),
+                    str(datetime.datetime.now().time())[:8], file, str(error)))
+
+            for msg in messages:
+                if self is None:
+                    print(msg)
+                else:
+                    self.LogAppend.myGUI_signal_str.emit(msg)
+
+    if len(errors) > 0:
+        raise errors[0]
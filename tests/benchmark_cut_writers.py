@@ -0,0 +1,56 @@
+"""
+Times the .cut/.clu writers and get_tint_cut of core.cut_creation against the previous implementations (see
+cut_reference.py), and checks that they wrote the same files.
+
+    python tests/benchmark_cut_writers.py [n_spikes]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import conftest  # noqa: F401 (adds BinMSGUI to the path)
+from core import cut_creation
+
+import cut_reference
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main(n_spikes=1000000):
+    rng = np.random.default_rng(0)
+    cut = rng.integers(0, 20, n_spikes)
+    mua_cells = [3, 7, 11]
+
+    print('%d spikes' % n_spikes)
+    print('%-12s %10s %10s %8s' % ('', 'old (s)', 'new (s)', 'speedup'))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, new, old, args in (
+                ('get_tint_cut', cut_creation.get_tint_cut, cut_reference.get_tint_cut, (cut, mua_cells)),
+                ('write_cut', cut_creation.write_cut, cut_reference.write_cut, ('%s.cut', cut, 'session')),
+                ('write_clu', cut_creation.write_clu, cut_reference.write_clu, ('%s.clu', cut))):
+
+            new_args = [arg % os.path.join(directory, 'new') if isinstance(arg, str) and '%s' in arg else arg
+                        for arg in args]
+            old_args = [arg % os.path.join(directory, 'old') if isinstance(arg, str) and '%s' in arg else arg
+                        for arg in args]
+
+            old_time = timed(old, *old_args)
+            new_time = timed(new, *new_args)
+
+            print('%-12s %10.3f %10.3f %7.1fx' % (name, old_time, new_time, old_time / new_time))
+
+            if isinstance(args[0], str):
+                with open(new_args[0], 'rb') as f_new, open(old_args[0], 'rb') as f_old:
+                    assert f_new.read() == f_old.read(), '%s wrote a different file!' % name
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
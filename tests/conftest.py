@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are imported as core.<module> (as main.py does), so the BinMSGUI folder needs to be on the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'BinMSGUI'))
@@ -0,0 +1,90 @@
+"""
+The previous (loop based) implementations of the .cut/.clu writers and get_tint_cut, kept as a reference for the
+tests and the benchmark of the vectorized versions in core.cut_creation.
+"""
+import os
+from operator import itemgetter
+
+import numpy as np
+
+
+def get_tint_cut(cut, mua_cells):
+    mua_cells = np.asarray(mua_cells)
+
+    cut_dict = {0: 0}
+
+    if 0 in cut:
+        add_one = 0
+    else:
+        add_one = 1
+
+    cells = np.setdiff1d(np.unique(cut), mua_cells)
+
+    i = 0
+    for i, cut_value in enumerate(np.unique(cells)):
+        if cut_value == 0:
+            continue
+
+        cut_dict[cut_value] = i + add_one
+
+    if len(mua_cells) != len(np.unique(cut)):
+        i_offset = i + 1 + 1
+    else:
+        i_offset = i + 1
+
+    count_dict = {}
+    for cut_value in mua_cells:
+        count_dict[cut_value] = sum(cut.flatten() == cut_value)
+
+    for i, cut_value in enumerate(sorted(count_dict.items(), key=lambda x: x[1])):
+        cut_value = cut_value[0]
+        if cut_value == 0:
+            continue
+
+        cut_dict[cut_value] = i + i_offset + add_one
+
+    return itemgetter(*list(cut))(cut_dict), cut_dict
+
+
+def write_cut(cut_filename, cut, basename=None):
+    if basename is None:
+        basename = os.path.basename(os.path.splitext(cut_filename)[0])
+
+    n_clusters = len(np.unique(cut))
+    n_spikes = len(cut)
+
+    write_list = []
+
+    tab = '    '
+    empty_space = '               '
+
+    write_list.append('n_clusters: %d\n' % (n_clusters))
+    write_list.append('n_channels: 4\n')
+    write_list.append('n_params: 2\n')
+    write_list.append('times_used_in_Vt:%s' % ((tab + '0') * 4 + '\n'))
+
+    zero_string = (tab + '0') * 8 + '\n'
+
+    for cell_i in np.arange(n_clusters):
+        write_list.append(' cluster: %d center:%s' % (cell_i, zero_string))
+        write_list.append('%smin:%s' % (empty_space, zero_string))
+        write_list.append('%smax:%s' % (empty_space, zero_string))
+    write_list.append('\nExact_cut_for: %s spikes: %d\n' % (basename, n_spikes))
+
+    n_rows = int(np.floor(n_spikes / 25))
+
+    remaining = int(n_spikes - n_rows * 25)
+    cut_string = ('%3u' * 25 + '\n') * n_rows + '%3u' * remaining
+
+    write_list.append(cut_string % (tuple(cut)))
+
+    with open(cut_filename, 'w') as f:
+        f.writelines(write_list)
+
+
+def write_clu(clu_filename, data):
+    data = np.asarray(data).astype(int)
+
+    data += 1
+
+    np.savetxt(clu_filename, data, fmt='%d', delimiter='\n')
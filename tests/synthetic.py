@@ -0,0 +1,82 @@
+"""Small synthetic Axona sessions (.bin/.set files) for the tests."""
+import json
+import os
+
+import numpy as np
+
+from core.mountainsort_functions import _writemda
+
+
+def make_set_file(set_filename, duration, tetrodes=(1,), eegs=None, rawRate=48000):
+    """writes a minimal .set file, eegs is a dictionary of eeg number: channel (from 0-63)"""
+    if eegs is None:
+        eegs = {}
+
+    lines = ['trial_date Monday, 1 Jan 2019', 'trial_time 10:00:00', 'experimenter test', 'comments none',
+             'duration %d' % duration, 'sw_version 1.2.2.16', 'rawRate %d' % rawRate,
+             'xmin 0', 'xmax 700', 'ymin 0', 'ymax 600', 'tracker_pixels_per_metre 600']
+
+    for tetrode in range(1, 17):
+        lines.append('collectMask_%d %d' % (tetrode, 1 if tetrode in tetrodes else 0))
+
+    for eeg_number in range(1, 65):
+        lines.append('saveEEG_ch_%d %d' % (eeg_number, 1 if eeg_number in eegs else 0))
+        lines.append('EEG_ch_%d %d' % (eeg_number, eegs.get(eeg_number, 0) + 1))
+
+    with open(set_filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def make_session(directory, name='session', n_packets=16000 * 2 + 123, tetrodes=(1, 3), eegs=None, seed=0):
+    """
+    Writes a .bin file of random samples (every 160th packet is a position packet) and its .set file, returning the
+    fullpath of the session (without an extension) and the (n_packets, 3, 64) samples as they are stored.
+    """
+    if eegs is None:
+        eegs = {1: 0, 2: 9}
+
+    rng = np.random.default_rng(seed)
+
+    raw = np.zeros((n_packets, 432), np.uint8)
+
+    samples = rng.integers(-30000, 30000, size=(n_packets, 3, 64)).astype('<i2')
+    raw[:, 32:416] = samples.view(np.uint8).reshape(n_packets, 384)
+
+    position_packets = np.arange(n_packets) % 160 == 5
+    raw[position_packets, 0:4] = np.frombuffer(b'ADU2', np.uint8)
+    raw[:, 12:16] = np.arange(n_packets).astype('<i4').view(np.uint8).reshape(-1, 4)
+    raw[:, 16:32] = rng.integers(0, 700, size=(n_packets, 8)).astype('<i2').view(np.uint8).reshape(-1, 16)
+
+    session = os.path.join(directory, name)
+    raw.tofile(session + '.bin')
+
+    make_set_file(session + '.set', int(np.ceil(n_packets * 3 / 48000)), tetrodes=tetrodes, eegs=eegs)
+
+    return session, samples
+
+
+def make_sorted_tetrode(directory, name, tetrode, n_samples=48000, n_spikes=300, n_cells=4, seed=0):
+    """
+    Writes the MountainSort output of a tetrode (the filtered, masked, firings and metrics files) that
+    batch_basename_tetrodes converts to Tint.
+    """
+    rng = np.random.default_rng(seed)
+
+    mda_basename = os.path.join(directory, '%s_T%d' % (name, tetrode))
+
+    data = rng.integers(-30000, 30000, size=(4, n_samples)).astype(np.int16)
+    _writemda(data, mda_basename + '_filt.mda', 'int16')
+    _writemda(data, mda_basename + '_masked.mda', 'int16')
+
+    # the rows are the channel, the (0-based) sample index and the cell of each spike
+    firings = np.zeros((3, n_spikes))
+    firings[0] = rng.integers(1, 5, n_spikes)
+    firings[1] = np.sort(rng.integers(0, n_samples, n_spikes))
+    firings[2] = rng.integers(1, n_cells + 1, n_spikes)
+    _writemda(firings, mda_basename + '_firings.mda', 'float64')
+
+    clusters = [{'label': cell, 'tags': ['mua'] if cell == n_cells else []} for cell in range(1, n_cells + 1)]
+    with open(mda_basename + '_metrics.json', 'w') as f:
+        json.dump({'clusters': clusters}, f)
+
+    return mda_basename
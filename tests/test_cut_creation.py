@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from core import cut_creation
+
+import cut_reference
+
+
+def random_cut(n_spikes, n_cells=12, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, n_cells, n_spikes)
+
+
+@pytest.mark.parametrize('n_spikes', [0, 1, 24, 25, 26, 5000, 25 * 40000 + 7])
+def test_write_cut_matches_reference(tmp_path, n_spikes):
+    cut = random_cut(n_spikes)
+
+    cut_creation.write_cut(str(tmp_path / 'new.cut'), cut, basename='session')
+    cut_reference.write_cut(str(tmp_path / 'old.cut'), cut, basename='session')
+
+    assert (tmp_path / 'new.cut').read_bytes() == (tmp_path / 'old.cut').read_bytes()
+
+
+@pytest.mark.parametrize('n_spikes', [1, 2, 5000, 40000 + 3])
+def test_write_clu_matches_reference(tmp_path, n_spikes):
+    cut = random_cut(n_spikes)
+
+    cut_creation.write_clu(str(tmp_path / 'new.clu'), cut)
+    cut_reference.write_clu(str(tmp_path / 'old.clu'), cut)
+
+    assert (tmp_path / 'new.clu').read_bytes() == (tmp_path / 'old.clu').read_bytes()
+
+
+@pytest.mark.parametrize('cells, mua_cells', [
+    (range(0, 8), [2, 5, 7]),
+    (range(1, 8), [3]),
+    (range(1, 6), []),
+    (range(1, 6), [1, 2, 3, 4, 5]),
+    ([0, 3, 9, 14], [9, 3]),
+])
+def test_get_tint_cut_matches_reference(cells, mua_cells):
+    rng = np.random.default_rng(1)
+    cut = rng.choice(np.asarray(list(cells)), 3000)
+
+    new_cut, new_dict = cut_creation.get_tint_cut(cut, mua_cells)
+    old_cut, old_dict = cut_reference.get_tint_cut(cut, mua_cells)
+
+    assert np.array_equal(new_cut, np.asarray(old_cut))
+    assert new_dict == old_dict
@@ -0,0 +1,117 @@
+import numpy as np
+import scipy.signal
+
+from core import eeg_conversion
+from core.eeg_conversion import Decimator, egf_to_eeg, get_egf_decimator, get_fir_hann_taps
+
+from core.readBin import get_bin_data
+
+from synthetic import make_set_file, make_session
+
+
+def filter_egf(data):
+    """filters the whole (channels, samples) 48 kHz recording and down-samples it to the EGF, compensating for the
+    filter's delay by padding the end of the recording with zeros"""
+    delay = (eeg_conversion.egf_n_taps - 1) // 2
+    taps = get_fir_hann_taps(48000, eeg_conversion.egf_cutoff, n_taps=eeg_conversion.egf_n_taps)
+
+    padded = np.hstack((np.asarray(data, dtype=float), np.zeros((data.shape[0], delay))))
+
+    return scipy.signal.lfilter(taps, 1.0, padded, axis=1)[:, delay::10][:, :len(range(0, data.shape[1], 10))]
+
+
+def test_egf_decimator_matches_filtering_the_whole_recording():
+    rng = np.random.default_rng(0)
+    data = rng.integers(-30000, 30000, size=(2, 48000 + 17)).astype(np.int16)
+
+    decimator = get_egf_decimator(48000)
+    chunks = [decimator.decimate(data[:, i:i + 7919]) for i in range(0, data.shape[1], 7919)]
+
+    egf = np.hstack(chunks + [decimator.flush()])
+
+    assert egf.shape == (2, 4802)
+    assert np.allclose(egf, filter_egf(data))
+
+
+def test_egf_decimator_does_not_delay_the_data():
+    t = np.arange(48000) / 48000
+    tone = 10000 * np.sin(2 * np.pi * 400 * t).reshape((1, -1))
+
+    egf = get_egf_decimator(48000).decimate_all(tone)
+
+    # away from the ends of the recording the EGF samples match the tone at the same times
+    assert np.abs(egf[0, 100:-100] - tone[0, ::10][100:-100]).max() < 50
+
+
+def test_egf_decimator_removes_aliased_content():
+    t = np.arange(48000 * 2) / 48000
+
+    passed = get_egf_decimator(48000).decimate_all(10000 * np.sin(2 * np.pi * 1000 * t).reshape((1, -1)))
+    # 3 kHz is above the EGF's Nyquist frequency (2.4 kHz), without filtering it would alias to 1.8 kHz
+    aliased = get_egf_decimator(48000).decimate_all(10000 * np.sin(2 * np.pi * 3000 * t).reshape((1, -1)))
+
+    # skip the ends of the recording
+    assert np.abs(passed[0, 100:-100]).max() > 9000
+    assert np.abs(aliased[0, 100:-100]).max() < 100
+
+
+def test_egf_decimator_at_the_egf_rate_keeps_the_data():
+    data = np.arange(20, dtype=np.int16).reshape((2, 10))
+
+    assert np.array_equal(get_egf_decimator(4800, 4800).decimate_all(data), data)
+
+
+def test_egf_to_eeg_matches_filtering_the_whole_recording():
+    rng = np.random.default_rng(1)
+    egf = rng.integers(-30000, 30000, size=(1, 4800 * 3 + 5)).astype(float)
+
+    filtered = scipy.signal.lfilter(get_fir_hann_taps(4800, 125), 1.0, egf, axis=1)
+    expected = eeg_conversion.EEG_downsample(filtered)
+
+    assert np.allclose(egf_to_eeg(egf, 4800, chunk_size=96 * 7).flatten(), expected)
+
+
+def test_decimation_indices():
+    assert np.array_equal(eeg_conversion.get_decimation_indices(5, 35, 10), [10, 20, 30])
+    assert np.array_equal(eeg_conversion.get_decimation_indices(0, 192, 96, eeg_conversion.eeg_offsets),
+                          [18, 37, 56, 75, 95, 114, 133, 152, 171, 191])
+
+    decimator = Decimator(96, offsets=eeg_conversion.eeg_offsets)
+    data = np.arange(96 * 3).reshape((1, -1))
+    assert np.array_equal(np.hstack([decimator.decimate(data[:, :50]), decimator.decimate(data[:, 50:])]),
+                          eeg_conversion.EEG_downsample(data).reshape((1, -1)))
+
+
+def test_create_egf_pins_the_output(tmp_path):
+    set_filename = str(tmp_path / 'session.set')
+    make_set_file(set_filename, duration=3)
+
+    rng = np.random.default_rng(2)
+    data = rng.integers(-3000, 3000, size=(1, 48000 * 2 + 100)).astype(np.int16)
+
+    egf_filename = str(tmp_path / 'session.egf')
+    eeg_conversion.create_egf(egf_filename, data, 48000, set_filename)
+
+    with open(egf_filename, 'rb') as f:
+        contents = f.read()
+
+    start = contents.index(b'data_start') + len('data_start')
+    egf = np.frombuffer(contents[start:-len('\r\ndata_end\r\n')], dtype='<i2')
+
+    expected = filter_egf(data)[0].astype(np.int32)
+
+    # the recording is rounded up to 3 seconds, and the last second is zeroed (like Tint)
+    assert len(egf) == 4800 * 3
+    assert np.array_equal(egf[:4800 * 2], expected[:4800 * 2])
+    assert not egf[4800 * 2:].any()
+
+
+def test_get_egf_data_reads_int16_chunks(tmp_path):
+    session, _ = make_session(str(tmp_path))
+
+    egf = eeg_conversion.get_egf_data(session + '.bin', [1, 10], 48000, chunk_packets=1000)
+
+    expected = filter_egf(get_bin_data(session + '.bin', channels=[1, 10]))
+
+    assert egf.dtype == np.int16
+    assert np.array_equal(egf, eeg_conversion.to_int16(expected))
@@ -0,0 +1,110 @@
+import struct
+
+import numpy as np
+import pytest
+
+from core.mountainsort_functions import MdaWriter, _writemda
+from core.readMDA import readMDA, read_mda_header
+
+
+def test_mda_writer_round_trip(tmp_path):
+    filename = str(tmp_path / 'data.mda')
+    data = np.random.default_rng(0).integers(-30000, 30000, size=(4, 1000)).astype(np.int16)
+
+    # the number of columns isn't known when the header is written
+    with MdaWriter(filename, 'int16', (4,)) as writer:
+        for i in range(0, 1000, 300):
+            writer.write(data[:, i:i + 300])
+            # the data is written to a temporary file until it is closed
+            assert not (tmp_path / 'data.mda').exists()
+
+    assert not (tmp_path / 'data.mda.part').exists()
+
+    A, code = readMDA(filename)
+    assert code == -4
+    assert np.array_equal(A, data)
+
+    # the memory mapped data keeps the data type of the file
+    A, _ = readMDA(filename, mmap=True)
+    assert A.dtype == np.int16
+    assert np.array_equal(A[:, 250:750], data[:, 250:750])
+
+
+def test_mda_writer_matches_writemda(tmp_path):
+    data = np.random.default_rng(0).normal(size=(3, 500)).astype(np.float32)
+
+    _writemda(data, str(tmp_path / 'expected.mda'), 'float32')
+
+    with MdaWriter(str(tmp_path / 'written.mda'), 'float32', (3,), num_columns=500) as writer:
+        writer.write(data)
+
+    assert (tmp_path / 'expected.mda').read_bytes() == (tmp_path / 'written.mda').read_bytes()
+
+
+def test_writemda_rejects_unexpected_data_types(tmp_path):
+    filename = tmp_path / 'data.mda'
+
+    with pytest.raises(ValueError, match='Unexpected data type'):
+        _writemda(np.zeros((3, 10)), str(filename), 'float16')
+
+    assert not filename.exists()
+    assert not (tmp_path / 'data.mda.part').exists()
+
+
+def test_mda_64_bit_dimensions(tmp_path):
+    filename = str(tmp_path / 'data.mda')
+    data = np.arange(4 * 100, dtype=np.int16).reshape((4, 100))
+
+    with MdaWriter(filename, 'int16', (4,), dim64=True) as writer:
+        writer.write(data)
+
+    with open(filename, 'rb') as f:
+        header = f.read(28)
+
+        f.seek(0)
+        code, shape, offset = read_mda_header(f)
+
+    # a negative number of dimensions flags the 64 bit dimensions
+    assert struct.unpack('<iii', header[:12]) == (-4, 2, -2)
+    assert struct.unpack('<qq', header[12:]) == (4, 100)
+    assert (code, shape, offset) == (-4, (4, 100), 28)
+
+    assert np.array_equal(readMDA(filename)[0], data)
+    assert np.array_equal(readMDA(filename, mmap=True)[0], data)
+
+
+def test_mda_without_samples(tmp_path):
+    filename = str(tmp_path / 'firings.mda')
+
+    with MdaWriter(filename, 'float64', (3,)):
+        pass
+
+    A, _ = readMDA(filename)
+    assert A.shape == (3, 0)
+
+    # the empty data keeps the data type of the file, as a memmap would
+    A, _ = readMDA(filename, mmap=True)
+    assert A.shape == (3, 0)
+    assert A.dtype == np.float64
+
+    with MdaWriter(filename, 'int16', (4,)):
+        pass
+
+    A, _ = readMDA(filename, mmap=True)
+    assert A.shape == (4, 0)
+    assert A.dtype == np.int16
+    assert A.flags.f_contiguous
+
+
+def test_mda_writer_removes_aborted_files(tmp_path):
+    filename = tmp_path / 'data.mda'
+
+    try:
+        with MdaWriter(str(filename), 'int16', (4,)) as writer:
+            writer.write(np.zeros((4, 10), np.int16))
+            writer.write(np.zeros((3, 10), np.int16))
+    except ValueError:
+        pass
+
+    assert not filename.exists()
+    assert not (tmp_path / 'data.mda.part').exists()
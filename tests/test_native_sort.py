@@ -0,0 +1,115 @@
+import os
+import stat
+import sys
+import time
+
+import pytest
+
+from core.mdaSort import NativeSortProcess, NativeBackend, get_pipeline_args, run_sort
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='the native backend runs ml-run-process directly')
+
+
+def write_stub(path, code):
+    """writes an executable python script that stands in for ml-run-process"""
+    path.write_text('#!%s\nimport os, sys, time, subprocess\n%s\n' % (sys.executable, code))
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    return str(path)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+
+    # a zombie has exited, it just hasn't been reaped by its parent
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return True
+
+
+def test_pipeline_args():
+    args = get_pipeline_args('ms4_geoff.sort', {'filt_fname': '/data/a b_T1_filt.mda', 'geom': ['g1', 'g2']},
+                             {'firings_out': '/data/a b_T1_firings.mda'}, {'num_workers': 2, 'whiten': 'true'})
+
+    # a list of arguments so the paths with spaces aren't split
+    assert args == ['ml-run-process', 'ms4_geoff.sort',
+                    '--inputs', 'filt_fname:/data/a b_T1_filt.mda', 'geom:g1', 'geom:g2',
+                    '--outputs', 'firings_out:/data/a b_T1_firings.mda',
+                    '--parameters', 'num_workers:2', 'whiten:true']
+
+    assert '--parameters' not in get_pipeline_args('p', {}, {})
+
+
+def test_exit_code_zero_completes(tmp_path):
+    stub = write_stub(tmp_path / 'stub', 'print("[ Running ms4_geoff.sort ]")\nprint("[ Done. ]")')
+    terminal_text_filename = str(tmp_path / 'terminal.txt')
+
+    events = []
+    process = NativeSortProcess([stub], terminal_text_filename=terminal_text_filename)
+
+    assert process.wait(callback=events.append) == (True, 'Complete')
+    assert process.process.returncode == 0
+    assert process.wall_time is not None
+    assert process.cpu_time is not None
+
+    assert open(terminal_text_filename).read() == '[ Running ms4_geoff.sort ]\n[ Done. ]\n'
+    assert [(event.event, event.stage) for event in events] == [('stage', 'Running ms4_geoff.sort')]
+
+
+def test_non_zero_exit_code_aborts(tmp_path):
+    stub = write_stub(tmp_path / 'stub', 'print("error")\nsys.exit(3)')
+
+    process = NativeSortProcess([stub])
+
+    assert process.wait() == (False, 'Abort')
+    assert process.process.returncode == 3
+
+
+def test_stall_terminates_the_process_group(tmp_path):
+    pid_filename = tmp_path / 'child.pid'
+    stub = write_stub(tmp_path / 'stub', '\n'.join([
+        # a processor started by the sort, it has to be terminated along with the sort
+        'child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])',
+        'open(%r, "w").write(str(child.pid))' % str(pid_filename),
+        'print("[ Running ms4_geoff.sort ]", flush=True)',
+        'time.sleep(60)']))
+
+    events = []
+    process = NativeSortProcess([stub], terminal_text_filename=str(tmp_path / 'terminal.txt'))
+
+    start = time.time()
+    assert process.wait(max_time=1, callback=events.append) == (False, 'Retry')
+    assert time.time() - start < 30
+
+    assert [event.event for event in events] == ['stage', 'stalled']
+    assert process.process.returncode is not None
+
+    child_pid = int(pid_filename.read_text())
+    for _ in range(50):
+        if not is_running(child_pid):
+            break
+        time.sleep(0.1)
+    assert not is_running(child_pid)
+
+
+def test_native_backend_runs_ml_run_process(tmp_path, monkeypatch):
+    args_filename = tmp_path / 'args.txt'
+    bin_directory = tmp_path / 'bin'
+    bin_directory.mkdir()
+    write_stub(bin_directory / 'ml-run-process', 'open(%r, "w").write("\\n".join(sys.argv[1:]))' % str(args_filename))
+
+    monkeypatch.setenv('PATH', str(bin_directory) + os.pathsep + os.environ.get('PATH', ''))
+
+    process = run_sort(filt_fname='/data/session_T1_filt.mda', firings_out='/data/session_T1_firings.mda',
+                       num_workers=3, backend=NativeBackend(), verbose=False)
+
+    assert process.wait() == (True, 'Complete')
+
+    args = args_filename.read_text().split('\n')
+    assert args[:4] == ['ms4_geoff.sort', '--inputs', 'filt_fname:/data/session_T1_filt.mda', '--outputs']
+    assert 'firings_out:/data/session_T1_firings.mda' in args
+    assert 'num_workers:3' in args
@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+import pytest
+
+from core.readBin import packet_dtype, bytes_per_packet, axona_remap, get_bin_data, iter_bin_chunks, \
+    iter_bin_packets, get_channel_from_tetrode, create_bin_cache, get_raw_pos
+from core.readMDA import readMDA
+from core.bin2mda import convert_bin2mda
+from core import bin_demux
+from core.bin_demux import convert_bin_demux
+from core.convert_position import convert_position
+from core.eeg_conversion import convert_eeg, get_eeg_filenames
+
+from synthetic import make_session
+
+
+def get_expected_channels(samples, channels):
+    """the (channels, samples) data of the channels (from 1-64), re-mapped one sample at a time"""
+    samples = samples.reshape((-1, 64))
+    return np.vstack([samples[:, axona_remap[channel - 1]] for channel in channels])
+
+
+def test_packet_dtype_matches_the_packet_layout(tmp_path):
+    assert packet_dtype.itemsize == bytes_per_packet == 432
+    assert packet_dtype.fields['timestamp'][1] == 12
+    assert packet_dtype.fields['position'][1] == 16
+    assert packet_dtype.fields['samples'][1] == 32
+
+    session, samples = make_session(str(tmp_path), n_packets=500)
+
+    packets = np.concatenate([chunk for _, chunk in iter_bin_packets(session + '.bin', chunk_packets=77)])
+
+    assert len(packets) == 500
+    assert np.array_equal(packets['samples'], samples)
+    assert np.array_equal(packets['timestamp'], np.arange(500))
+    assert np.array_equal(np.where(packets['id'] == b'ADU2')[0], np.arange(5, 500, 160))
+
+
+def test_get_bin_data_remaps_the_channels(tmp_path):
+    session, samples = make_session(str(tmp_path), n_packets=1000)
+
+    data = get_bin_data(session + '.bin', tetrode=3)
+
+    assert data.dtype == np.int16
+    assert np.array_equal(data, get_expected_channels(samples, get_channel_from_tetrode(3)))
+
+    channels = [64, 1, 17, 40]
+    assert np.array_equal(get_bin_data(session + '.bin', channels=channels, chunk_packets=333),
+                          get_expected_channels(samples, channels))
+
+
+def test_iter_bin_chunks_matches_get_bin_data(tmp_path):
+    session, samples = make_session(str(tmp_path), n_packets=1000)
+
+    chunks = list(iter_bin_chunks(session + '.bin', tetrode=1, chunk_packets=300))
+
+    # the last chunk has the remaining packets
+    assert [chunk.shape[1] for chunk in chunks] == [900, 900, 900, 300]
+    assert np.array_equal(np.hstack(chunks), get_bin_data(session + '.bin', tetrode=1))
+
+
+def test_bin_cache_matches_the_bin_file(tmp_path):
+    session, samples = make_session(str(tmp_path), n_packets=1000)
+
+    create_bin_cache(session + '.bin', chunk_packets=300)
+
+    assert np.array_equal(get_bin_data(session + '.bin', tetrode=3),
+                          get_expected_channels(samples, get_channel_from_tetrode(3)))
+    assert np.array_equal(np.hstack(list(iter_bin_chunks(session + '.bin', channels=[2, 33], chunk_packets=300))),
+                          get_expected_channels(samples, [2, 33]))
+
+
+def test_demux_matches_the_separate_conversions(tmp_path):
+    demux_directory = tmp_path / 'demux'
+    separate_directory = tmp_path / 'separate'
+    demux_directory.mkdir()
+    separate_directory.mkdir()
+
+    demux_session, samples = make_session(str(demux_directory))
+    separate_session, _ = make_session(str(separate_directory))
+
+    for session in (demux_session, separate_session):
+        # the converted .set file is the header of the .pos/.eeg/.egf files
+        with open(session + '.set', 'rb') as f:
+            set_data = f.read()
+        with open(session + '_ms.set', 'wb') as f:
+            f.write(set_data)
+
+    mda_filenames = convert_bin_demux(demux_session, demux_session + '_ms', chunk_packets=5000)
+
+    assert mda_filenames == ['%s_T%d_filt.mda' % (demux_session, tetrode) for tetrode in (1, 3)]
+
+    for tetrode, mda_filename in zip((1, 3), mda_filenames):
+        assert np.array_equal(readMDA(mda_filename)[0],
+                              get_expected_channels(samples, get_channel_from_tetrode(tetrode)))
+
+    convert_bin2mda(separate_session)
+    for tetrode in (1, 3):
+        assert np.array_equal(readMDA('%s_T%d_filt.mda' % (demux_session, tetrode))[0],
+                              readMDA('%s_T%d_filt.mda' % (separate_session, tetrode))[0])
+
+    convert_position(separate_session + '.bin', separate_session + '_ms.pos', separate_session + '_ms.set')
+    with open(demux_session + '_ms.pos', 'rb') as f:
+        demux_pos = f.read()
+    with open(separate_session + '_ms.pos', 'rb') as f:
+        assert demux_pos == f.read()
+
+    convert_eeg(separate_session + '.set', separate_session + '_ms')
+    for eeg_number in (1, 2):
+        for demux_filename, separate_filename in zip(get_eeg_filenames(demux_session + '_ms', eeg_number),
+                                                     get_eeg_filenames(separate_session + '_ms', eeg_number)):
+            with open(demux_filename, 'rb') as f:
+                demux_eeg = f.read()
+            with open(separate_filename, 'rb') as f:
+                assert demux_eeg == f.read()
+
+
+def test_get_raw_pos_modes_match(tmp_path):
+    session, _ = make_session(str(tmp_path))
+
+    assert np.array_equal(get_raw_pos(session + '.bin', mode='mmap'),
+                          get_raw_pos(session + '.bin', mode='non', chunk_packets=1000))
+
+
+def test_demux_removes_the_mda_files_if_it_fails(tmp_path, monkeypatch):
+    session, _ = make_session(str(tmp_path))
+
+    def fail(*args, **kwargs):
+        raise MemoryError('no memory for the EEG')
+
+    # the tetrode .mda files have already been created when the EEG consumers are built
+    monkeypatch.setattr(bin_demux, 'EEGConsumer', fail)
+
+    with pytest.raises(MemoryError):
+        convert_bin_demux(session, session + '_ms')
+
+    assert [filename for filename in os.listdir(str(tmp_path)) if '.mda' in filename] == []
@@ -0,0 +1,162 @@
+from core import mdaSort
+from core.mdaSort import SortOutputParser, SortMonitor
+
+
+def feed_lines(parser, lines):
+    events = []
+    for line in lines:
+        events.extend(parser.feed(line))
+    return [(event.event, event.stage) for event in events]
+
+
+def test_parser_stages():
+    parser = SortOutputParser()
+
+    events = feed_lines(parser, ['[ Getting processor spec... ]\n', 'some output\n', '[ Running ms4_geoff.sort ]\n',
+                                 '[ Running ms4_geoff.sort ]\n'])
+
+    # repeated stages are only reported once
+    assert events == [('stage', 'Getting processor spec...'), ('stage', 'Running ms4_geoff.sort')]
+    assert not parser.finished and not parser.error
+
+
+def test_parser_process_cache_hit():
+    parser = SortOutputParser()
+
+    events = feed_lines(parser, ['[ Checking process cache ... ]\n',
+                                 '[ Process ms4_geoff.sort already completed. ]\n',
+                                 '[ Done. ]\n'])
+
+    # [ Done. ] is not a stage
+    assert events == [('stage', 'Checking process cache ...'),
+                      ('stage', 'Process ms4_geoff.sort already completed.'),
+                      ('complete', 'Process ms4_geoff.sort already completed.')]
+    assert parser.finished
+
+
+def test_parser_saving_to_the_process_cache():
+    parser = SortOutputParser()
+
+    # the first line of the sequence can follow other output on the same line
+    events = feed_lines(parser, ['[ Running ms4_geoff.sort ]\n',
+                                 'progress 100%[ Saving to process cache ... ]\n',
+                                 '[ Removing temporary directory ... ]\n',
+                                 '[ Done. ]\n'])
+
+    assert events[-1] == ('complete', 'Removing temporary directory ...')
+    assert parser.finished
+    assert not parser.error
+
+
+def test_parser_incomplete_sequences_do_not_complete():
+    parser = SortOutputParser()
+
+    feed_lines(parser, ['[ Saving to process cache ... ]\n', 'other output\n', '[ Done. ]\n'])
+
+    assert not parser.finished
+
+
+def test_parser_non_zero_exit_code():
+    parser = SortOutputParser()
+
+    events = feed_lines(parser, ['[ Running ms4_geoff.sort ]\n',
+                                 'Process returned with non-zero exit code (1)\n',
+                                 'Process returned with non-zero exit code (1)\n'])
+
+    assert events == [('stage', 'Running ms4_geoff.sort'), ('error', 'Running ms4_geoff.sort')]
+    assert parser.error
+
+
+def test_monitor_reads_the_file_in_pieces(tmp_path):
+    filename = tmp_path / 'terminal.txt'
+    monitor = SortMonitor(str(filename), max_time=600)
+
+    # the file hasn't been created yet
+    assert monitor.poll() == []
+
+    with open(str(filename), 'wb') as f:
+        f.write(b'[ Running ms4_')
+    events = monitor.poll()
+    assert [event.event for event in events] == ['started']
+
+    with open(str(filename), 'ab') as f:
+        f.write(b'geoff.sort ]\r\n[ Saving to process cache ... ]\n[ Removing temporary')
+    events = monitor.poll()
+    assert [(event.event, event.stage) for event in events] == [('stage', 'Running ms4_geoff.sort'),
+                                                                 ('stage', 'Saving to process cache ...')]
+    assert monitor.result == (False, None)
+
+    with open(str(filename), 'ab') as f:
+        f.write(b' directory ... ]\n[ Done. ]\n')
+    events = monitor.poll()
+    assert [event.event for event in events] == ['stage', 'complete']
+    assert monitor.result == (True, 'Complete')
+
+    # nothing more is read once the sort is done
+    assert monitor.poll() == []
+
+
+def test_monitor_backs_off_while_nothing_is_written(tmp_path, monkeypatch):
+    filename = tmp_path / 'terminal.txt'
+    filename.write_bytes(b'[ Running ms4_geoff.sort ]\n')
+
+    delays = []
+
+    def sleep(delay):
+        delays.append(delay)
+        if len(delays) == 7:
+            with open(str(filename), 'ab') as f:
+                f.write(b'[ Saving to process cache ... ]\n[ Removing temporary directory ... ]\n[ Done. ]\n')
+
+    monkeypatch.setattr(mdaSort.time, 'sleep', sleep)
+
+    monitor = SortMonitor(str(filename), max_time=600, min_delay=0.05, max_delay=1.0)
+    events = [event.event for event in monitor.events()]
+
+    assert events == ['started', 'stage', 'stage', 'stage', 'complete']
+    assert delays == [0.05, 0.1, 0.2, 0.4, 0.8, 1.0, 1.0]
+    assert monitor.result == (True, 'Complete')
+
+
+def test_monitor_stalls_if_the_file_is_never_created(tmp_path):
+    monitor = SortMonitor(str(tmp_path / 'terminal.txt'), max_time=0)
+
+    assert [event.event for event in monitor.poll()] == ['stalled']
+    assert monitor.result == (False, 'Retry')
+
+
+def test_monitor_stalls_if_nothing_is_written(tmp_path):
+    filename = tmp_path / 'terminal.txt'
+    filename.write_bytes(b'[ Running ms4_geoff.sort ]\n')
+
+    monitor = SortMonitor(str(filename), max_time=600)
+    assert [event.event for event in monitor.poll()] == ['started', 'stage']
+
+    # nothing has been written for max_time seconds
+    monitor.max_time = 0
+    assert [event.event for event in monitor.poll()] == ['stalled']
+    assert monitor.result == (False, 'Retry')
+
+
+def test_monitor_stalls_if_the_file_is_removed(tmp_path):
+    filename = tmp_path / 'terminal.txt'
+    filename.write_bytes(b'[ Running ms4_geoff.sort ]\n')
+
+    monitor = SortMonitor(str(filename), max_time=600)
+    monitor.poll()
+
+    filename.unlink()
+
+    # the file is given one more read before the sort is considered stalled
+    assert monitor.poll() == []
+    assert [event.event for event in monitor.poll()] == ['stalled']
+
+
+def test_monitor_aborts_on_errors(tmp_path):
+    filename = tmp_path / 'terminal.txt'
+    filename.write_bytes(b'[ Running ms4_geoff.sort ]\nProcess returned with non-zero exit code (1)\n')
+
+    monitor = SortMonitor(str(filename))
+
+    assert [event.event for event in monitor.events()] == ['started', 'stage', 'error']
+    assert monitor.result == (False, 'Abort')
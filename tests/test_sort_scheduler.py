@@ -0,0 +1,162 @@
+import threading
+import time
+
+from core.mdaSort import SortJob, SortScheduler
+
+
+class FakeProcess:
+    def __init__(self, backend, terminal_text_filename, result):
+        self.backend = backend
+        self.result = result
+
+        # the sort's output, which is removed before a retry
+        with open(terminal_text_filename, 'w') as f:
+            f.write('[ Running ms4_geoff.sort ]\n')
+
+    def wait(self, max_time=600, callback=None):
+        time.sleep(self.backend.duration)
+
+        with self.backend.lock:
+            self.backend.running -= 1
+
+        finished, sort_code = self.result
+        self.wall_time, self.cpu_time = self.backend.times
+        return finished, sort_code
+
+
+class FakeBackend:
+    """starts fake sorts that return the given result after duration seconds, reporting the given (wall, cpu) times"""
+    name = 'fake'
+
+    def __init__(self, result=(True, 'Complete'), duration=0.05, times=(10, 10)):
+        self.result = result
+        self.duration = duration
+        self.times = times
+
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.starts = []  # the (filt_fname, num_workers) of every sort that was started
+
+    def get_path(self, filepath):
+        return filepath
+
+    def start(self, pipeline, inputs, outputs, parameters=None, terminal_text_filename=None, verbose=False):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.starts.append((inputs['filt_fname'], parameters['num_workers']))
+
+        return FakeProcess(self, terminal_text_filename, self.result)
+
+
+def make_jobs(tmp_path, n, memory=None):
+    jobs = []
+    for tetrode in range(1, n + 1):
+        filename = str(tmp_path / ('session_T%d_filt.mda' % tetrode))
+        sort_kwargs = {'filt_fname': filename, 'firings_out': str(tmp_path / ('session_T%d_firings.mda' % tetrode))}
+        jobs.append(SortJob(filename, str(tmp_path / ('session_T%d_terminal.txt' % tetrode)), sort_kwargs,
+                            memory=memory))
+    return jobs
+
+
+def test_the_cores_are_split_evenly(tmp_path):
+    backend = FakeBackend()
+    scheduler = SortScheduler(backend, max_concurrent=4, core_budget=8, verbose=False)
+
+    scheduler.run(make_jobs(tmp_path, 4))
+
+    assert backend.max_running == 4
+    assert sorted(num_workers for _, num_workers in backend.starts) == [2, 2, 2, 2]
+
+
+def test_a_single_sort_gets_every_core(tmp_path):
+    backend = FakeBackend()
+    scheduler = SortScheduler(backend, max_concurrent=1, core_budget=8, verbose=False)
+
+    scheduler.run(make_jobs(tmp_path, 2))
+
+    assert backend.max_running == 1
+    assert [num_workers for _, num_workers in backend.starts] == [8, 8]
+
+
+def test_the_cores_are_tuned_to_the_measured_usage(tmp_path):
+    # the sorts only kept a single core busy
+    backend = FakeBackend(times=(10, 10))
+    scheduler = SortScheduler(backend, max_concurrent=2, core_budget=8, verbose=False)
+
+    scheduler.run(make_jobs(tmp_path, 4))
+
+    assert [num_workers for _, num_workers in backend.starts] == [4, 4, 2, 2]
+
+
+def test_short_sorts_are_not_tuned_to(tmp_path):
+    # process cache hits finish right away without using any cores
+    backend = FakeBackend(times=(0.5, 0.01))
+    scheduler = SortScheduler(backend, max_concurrent=2, core_budget=8, verbose=False)
+
+    scheduler.run(make_jobs(tmp_path, 4))
+
+    assert scheduler.cpu_usage == []
+    assert [num_workers for _, num_workers in backend.starts] == [4, 4, 4, 4]
+
+
+def test_the_memory_budget_limits_the_sorts(tmp_path):
+    backend = FakeBackend()
+    scheduler = SortScheduler(backend, max_concurrent=4, core_budget=8, memory_budget=250, verbose=False)
+
+    scheduler.run(make_jobs(tmp_path, 4, memory=100))
+
+    assert backend.max_running == 2
+    assert len(backend.starts) == 4
+
+
+def test_a_sort_larger_than_the_memory_budget_still_runs(tmp_path):
+    backend = FakeBackend()
+    scheduler = SortScheduler(backend, max_concurrent=4, core_budget=8, memory_budget=50, verbose=False)
+
+    scheduler.run(make_jobs(tmp_path, 2, memory=100))
+
+    assert backend.max_running == 1
+    assert len(backend.starts) == 2
+
+
+def test_stalled_sorts_are_retried_up_to_the_limit(tmp_path):
+    backend = FakeBackend(result=(False, 'Retry'), duration=0)
+    scheduler = SortScheduler(backend, verbose=False)
+
+    scheduler.run(make_jobs(tmp_path, 1))
+
+    assert len(backend.starts) == SortScheduler.max_sort_attempts + 1
+
+
+def test_failed_sorts_are_aborted(tmp_path, capsys):
+    backend = FakeBackend(result=(False, 'Abort'), duration=0)
+    scheduler = SortScheduler(backend, max_concurrent=2, core_budget=4, verbose=False)
+
+    jobs = make_jobs(tmp_path, 2)
+    scheduler.run(jobs)
+
+    # each sort is only started once, and the error is logged
+    assert len(backend.starts) == 2
+    output = capsys.readouterr().out
+    for job in jobs:
+        assert 'There was an error sorting the following file, consult terminal text file: %s' % job.filename in \
+               output
+
+
+def test_sorts_started_from_threads_share_the_budget(tmp_path):
+    backend = FakeBackend()
+    jobs = make_jobs(tmp_path, 4)
+    scheduler = SortScheduler(backend, max_concurrent=2, core_budget=8, n_jobs=len(jobs), verbose=False)
+
+    threads = [threading.Thread(target=scheduler.sort, args=(job,)) for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert backend.max_running == 2
+    assert len(backend.starts) == 4
+    assert scheduler.running == []
+    assert all(num_workers <= 4 for _, num_workers in backend.starts)
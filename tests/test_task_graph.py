@@ -0,0 +1,132 @@
+import threading
+import time
+
+import pytest
+
+from core.bin_demux import SessionFileWriter
+from core.task_graph import TaskGraph
+
+
+def test_dependencies_run_first():
+    finished = []
+    graph = TaskGraph()
+
+    graph.add('export', lambda: finished.append('export'), dependencies=['sort', 'set'])
+    graph.add('sort', lambda: finished.append('sort'), dependencies=['mda'])
+    graph.add('mda', lambda: finished.append('mda'))
+    graph.add('set', lambda: finished.append('set'), dependencies=[None])
+
+    graph.run()
+
+    assert finished.index('mda') < finished.index('sort') < finished.index('export')
+    assert finished.index('set') < finished.index('export')
+    assert all(task.state == 'done' for task in graph.tasks.values())
+
+
+def test_cycles_are_rejected():
+    graph = TaskGraph()
+    graph.add('a', lambda: None, dependencies=['c'])
+    graph.add('b', lambda: None, dependencies=['a'])
+    graph.add('c', lambda: None, dependencies=['b'])
+
+    with pytest.raises(ValueError, match='circular'):
+        graph.run()
+
+
+def test_missing_dependencies_are_rejected():
+    graph = TaskGraph()
+    graph.add('a', lambda: None, dependencies=['b'])
+
+    with pytest.raises(ValueError, match='does not exist'):
+        graph.run()
+
+    with pytest.raises(ValueError):
+        graph.add('a', lambda: None)
+
+
+def test_failed_tasks_skip_their_dependents():
+    finished = []
+
+    def fail():
+        raise RuntimeError('sort failed')
+
+    graph = TaskGraph()
+    graph.add('sort_T1', fail)
+    graph.add('export_T1', lambda: finished.append('export_T1'), dependencies=['sort_T1'])
+    graph.add('clean_T1', lambda: finished.append('clean_T1'), dependencies=['export_T1'])
+    graph.add('sort_T2', lambda: finished.append('sort_T2'))
+    graph.add('export_T2', lambda: finished.append('export_T2'), dependencies=['sort_T2'])
+
+    with pytest.raises(RuntimeError, match='sort failed'):
+        graph.run()
+
+    # the other tetrode still finishes
+    assert sorted(finished) == ['export_T2', 'sort_T2']
+    assert graph.tasks['sort_T1'].state == 'failed'
+    assert graph.tasks['export_T1'].state == 'skipped'
+    assert graph.tasks['clean_T1'].state == 'skipped'
+
+
+@pytest.mark.parametrize('limit', [2, lambda: 2])
+def test_pool_limits(limit):
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def export():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    graph = TaskGraph(pool_limits={'export': limit})
+    for tetrode in range(6):
+        graph.add('export_T%d' % tetrode, export, pool='export')
+
+    graph.run()
+
+    assert max_running[0] == 2
+
+
+def test_session_files_are_written_while_sorting():
+    sorting = threading.Event()
+    written = []
+
+    def write_pos():
+        # the sorts start while the files are being written
+        assert sorting.wait(timeout=10)
+        written.append('pos')
+
+    def write_eeg():
+        raise OSError('disk full')
+
+    session_writer = SessionFileWriter()
+
+    def convert_mda():
+        session_writer.submit(write_pos)
+        session_writer.submit(write_eeg)
+
+    sorted_tetrodes = []
+
+    def sort(tetrode):
+        sorting.set()
+        sorted_tetrodes.append(tetrode)
+
+    graph = TaskGraph()
+    graph.add('mda', convert_mda)
+    graph.add('session_files', session_writer.join, dependencies=['mda'])
+    graph.add('sort_T1', lambda: sort(1), dependencies=['mda'])
+    graph.add('sort_T2', lambda: sort(2), dependencies=['mda'])
+    graph.add('clean', lambda: None, dependencies=['session_files', 'sort_T1', 'sort_T2'])
+
+    # the error of the background write is raised by join
+    with pytest.raises(OSError, match='disk full'):
+        graph.run()
+
+    assert written == ['pos']
+    assert sorted(sorted_tetrodes) == [1, 2]
+    assert graph.tasks['session_files'].state == 'failed'
+    assert graph.tasks['sort_T1'].state == 'done'
+    assert graph.tasks['clean'].state == 'skipped'
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from core.tetrode_conversion import TetrodeLog, batch_basename_tetrodes
+
+from synthetic import make_set_file, make_sorted_tetrode
+
+
+def make_sorted_session(directory, tetrodes=(1, 2, 3, 4)):
+    """writes the sorted tetrodes of a session, the last tetrode is missing its firings (i.e. it wasn't sorted)"""
+    for tetrode in tetrodes:
+        mda_basename = make_sorted_tetrode(str(directory), 'session', tetrode, seed=tetrode)
+    os.remove(mda_basename + '_firings.mda')
+
+    output_basename = str(directory / 'session_ms')
+    make_set_file(output_basename + '.set', 1, tetrodes=tetrodes)
+
+    return output_basename
+
+
+def test_the_pool_matches_the_serial_conversion(tmp_path):
+    outputs = {}
+    logs = {}
+    for n_workers in [1, 2]:
+        directory = tmp_path / ('workers_%d' % n_workers)
+        directory.mkdir()
+
+        output_basename = make_sorted_session(directory)
+
+        logs[n_workers] = TetrodeLog()
+        batch_basename_tetrodes(str(directory), 'session', output_basename, n_workers=n_workers,
+                                self=logs[n_workers])
+
+        # the cut file headers include the directory of the session
+        outputs[n_workers] = {file: (directory / file).read_bytes().replace(str(directory).encode(), b'')
+                              for file in os.listdir(str(directory)) if file.startswith('session_ms')}
+
+    # the tetrode without firings is skipped
+    assert sorted(outputs[1]) == ['session_ms.1', 'session_ms.2', 'session_ms.3', 'session_ms.clu.1',
+                                  'session_ms.clu.2', 'session_ms.clu.3', 'session_ms.set', 'session_ms_1.cut',
+                                  'session_ms_2.cut', 'session_ms_3.cut']
+    assert outputs[2] == outputs[1]
+
+    # the messages of the worker processes are logged
+    for n_workers, log in logs.items():
+        created = [msg for msg in log.messages if 'Creating the following tetrode file' in msg]
+        assert len(created) == 3
+        assert any('The following spike filename does not exist' in msg for msg in log.messages)
+        assert not any('#Red' in msg for msg in log.messages)
+
+    assert 'Converting 4 tetrodes using 2 processes!' in logs[2].messages[0]
+
+
+def test_the_pool_stops_at_the_first_error(tmp_path):
+    output_basename = make_sorted_session(tmp_path, tetrodes=range(1, 10))
+
+    log = TetrodeLog()
+
+    # the clip size is invalid, so every conversion fails
+    with pytest.raises(ValueError, match='clip size'):
+        batch_basename_tetrodes(str(tmp_path), 'session', output_basename, pre_spike=10, post_spike=10,
+                                n_workers=2, self=log)
+
+    # the conversions that weren't started when the first error came back were cancelled
+    errors = [msg for msg in log.messages if msg.endswith('#Red')]
+    assert 1 <= len(errors) < 8
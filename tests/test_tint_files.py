@@ -0,0 +1,179 @@
+import numpy as np
+import pytest
+
+from core.tetrode_conversion import get_tetrode_record_dtype, write_tetrode, write_tetrode_clips, get_clips
+from core.cut_creation import write_cut
+from core.convert_position import create_pos
+from core.Tint_Matlab import importspikes, getspikes, get_pos_record_dtype, getpos, TetrodeFile, read_cut, read_clu
+
+from synthetic import make_set_file
+
+
+tetrode_parameters = {'trial_date': 'Monday, 1 Jan 2019', 'trial_time': '10:00:00', 'experimenter': 'test',
+                      'comments': 'none', 'duration': 10, 'sw_version': '1.2.2.16', 'samples_per_spike': 50,
+                      'rawRate': '48000'}
+
+
+def make_spikes(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+
+    spike_times = np.sort(rng.integers(0, 96000 * 10, n))
+    spike_data = rng.integers(-128, 128, size=(4, n, 50))
+
+    return spike_times, spike_data
+
+
+def test_tetrode_record_dtype():
+    dtype = get_tetrode_record_dtype(50)
+
+    # a big-endian timestamp followed by the 1 byte samples of a channel
+    assert dtype.itemsize == 54
+    assert dtype['t'] == np.dtype('>i4')
+    assert dtype.fields['waveform'][1] == 4
+
+
+def test_tetrode_round_trip(tmp_path):
+    filename = str(tmp_path / 'session.1')
+    spike_times, spike_data = make_spikes()
+
+    write_tetrode(filename, spike_times, spike_data, tetrode_parameters)
+
+    spikes, spikeparam = importspikes(filename)
+
+    assert spikeparam['num_spikes'] == 200
+    assert spikeparam['samples_per_spike'] == 50
+    assert np.allclose(spikes['t'].flatten(), spike_times / 96000)
+
+    for chan in range(4):
+        assert spikes['ch%d' % (chan + 1)].dtype == float
+        assert np.array_equal(spikes['ch%d' % (chan + 1)], spike_data[chan])
+
+    ts, ch1, ch2, ch3, ch4, _ = getspikes(filename, mmap=True)
+    assert ch1.dtype == np.int8
+    assert np.array_equal(np.stack((ch1, ch2, ch3, ch4)), spike_data)
+    assert np.array_equal(ts, spikes['t'])
+
+
+def make_filtered_data(n_samples=20000, seed=0):
+    return np.random.default_rng(seed).integers(-32768, 32768, size=(4, n_samples)).astype(np.int16)
+
+
+@pytest.mark.parametrize('batch_size', [7, 10000])
+def test_tetrode_clips_match_write_tetrode(tmp_path, batch_size):
+    data = make_filtered_data()
+
+    # the spikes are written in the order given, not in the order they are read
+    spike_times = np.random.default_rng(1).integers(15, data.shape[1] - 35, 50)
+    cell_times = spike_times * 2
+
+    write_tetrode(str(tmp_path / 'expected.1'), cell_times, get_clips(data, spike_times), tetrode_parameters)
+    write_tetrode_clips(str(tmp_path / 'written.1'), data, spike_times, cell_times, tetrode_parameters,
+                        batch_size=batch_size)
+
+    assert (tmp_path / 'written.1').read_bytes() == (tmp_path / 'expected.1').read_bytes()
+
+
+def test_tetrode_clips_without_spikes(tmp_path):
+    data = make_filtered_data(n_samples=100)
+
+    write_tetrode(str(tmp_path / 'expected.1'), [], np.zeros((4, 0, 50)), tetrode_parameters)
+    write_tetrode_clips(str(tmp_path / 'written.1'), data, [], [], tetrode_parameters)
+
+    assert (tmp_path / 'written.1').read_bytes() == (tmp_path / 'expected.1').read_bytes()
+
+
+def test_tetrode_clips_removes_the_file_on_errors(tmp_path):
+    data = make_filtered_data(n_samples=1000)
+
+    # the clip of the last spike runs past the end of the data, so the second batch fails
+    spike_times = np.array([100, 200, 300, 990])
+
+    with pytest.raises(IndexError):
+        write_tetrode_clips(str(tmp_path / 'session.1'), data, spike_times, spike_times * 2, tetrode_parameters,
+                            batch_size=2)
+
+    assert not (tmp_path / 'session.1').exists()
+
+
+def test_tetrode_file_windows(tmp_path):
+    filename = str(tmp_path / 'session.1')
+    spike_times, spike_data = make_spikes()
+    cells = np.arange(200) % 3
+
+    write_tetrode(filename, spike_times, spike_data, tetrode_parameters)
+    write_cut(str(tmp_path / 'session_1.cut'), cells)
+
+    tetrode = TetrodeFile(filename)
+
+    window = (spike_times >= 96000 * 2) & (spike_times < 96000 * 5) & np.isin(cells, [1, 2])
+    assert np.array_equal(tetrode.waveforms(cells=[1, 2], t_start=2, t_stop=5), spike_data[:, window, :])
+
+
+def test_read_cut(tmp_path):
+    filename = str(tmp_path / 'session_1.cut')
+    cells = np.random.default_rng(0).integers(0, 5, 1003)
+
+    write_cut(filename, cells, basename='session')
+
+    assert np.array_equal(read_cut(filename), cells)
+    assert read_cut(filename, header_only=True) == (5, 1003)
+
+    assert read_cut(str(tmp_path / 'missing.cut')) is None
+    assert read_cut(str(tmp_path / 'missing.cut'), header_only=True) == (None, None)
+
+
+def test_read_clu(tmp_path):
+    filename = tmp_path / 'session.clu.1'
+    cells = np.random.default_rng(0).integers(0, 5, 1003)
+
+    # Tint's .clu files start with the number of clusters, the cells are 1-based
+    filename.write_text('5\n' + ''.join('%d\n' % (cell + 1) for cell in cells))
+
+    assert np.array_equal(read_clu(str(filename)), cells)
+    assert read_clu(str(filename), header_only=True) == (5, 1003)
+
+    # without a trailing new line
+    filename.write_text(filename.read_text().rstrip('\n'))
+    assert read_clu(str(filename), header_only=True) == (5, 1003)
+
+
+def test_tetrode_header_is_not_utf8(tmp_path):
+    filename = tmp_path / 'session.1'
+    spike_times, spike_data = make_spikes(n=10)
+
+    write_tetrode(str(filename), spike_times, spike_data, tetrode_parameters)
+
+    # Axona writes the free text of the header (i.e. the comments) in the Windows code page
+    filename.write_bytes(filename.read_bytes().replace(b'comments none', 'comments caf\xe9'.encode('cp1252')))
+
+    spikes, spikeparam = importspikes(str(filename))
+
+    assert spikeparam['num_spikes'] == 10
+    assert np.array_equal(spikes['ch4'], spike_data[3])
+
+
+def test_pos_round_trip(tmp_path):
+    set_filename = str(tmp_path / 'session.set')
+    pos_filename = str(tmp_path / 'session.pos')
+    make_set_file(set_filename, 10)
+
+    rng = np.random.default_rng(0)
+    pos_data = np.hstack((np.arange(500).reshape((-1, 1)), rng.integers(0, 700, size=(500, 8))))
+
+    create_pos(pos_filename, set_filename, pos_data)
+
+    assert get_pos_record_dtype().itemsize == 20
+
+    data = (tmp_path / 'session.pos').read_bytes()
+    data_start = data.index(b'data_start') + len(b'data_start')
+    assert data[data_start + 500 * 20:] == b'\r\ndata_end\r\n'
+
+    records = np.frombuffer(data, dtype=get_pos_record_dtype(), count=500, offset=data_start)
+    assert np.array_equal(records['t'], pos_data[:, 0])
+    assert np.array_equal(records['coords'], pos_data[:, 1:])
+
+    x, y, t, sample_rate = getpos(pos_filename, None, method='raw')
+    assert sample_rate == 50
+    assert np.array_equal(t.flatten(), pos_data[:, 0])
+    assert np.array_equal(x.flatten(), pos_data[:, 1])
+    assert np.array_equal(y.flatten(), pos_data[:, 2])